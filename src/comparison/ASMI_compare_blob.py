@@ -4,10 +4,7 @@ import sys
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import cm
-from tqdm import tqdm
-import random
 import torch
-from sklearn.datasets import make_blobs
 
 os.environ["OMP_NUM_THREADS"] = "1"  # export OMP_NUM_THREADS=1
 os.environ["OPENBLAS_NUM_THREADS"] = "1"  # export OPENBLAS_NUM_THREADS=1
@@ -21,6 +18,10 @@ from dsmi import diffusion_spectral_mutual_information, adjacency_spectral_mutua
 
 sys.path.insert(0, import_dir + '/src/utils/')
 from attribute_hashmap import AttributeHashmap
+from experiment_grid import grid_array, grid_cells, run_grid
+
+sys.path.insert(0, import_dir + '/src/comparison/')
+from toy_data import generate_blobs, run_cell
 
 sys.path.insert(0, import_dir + '/src/comparison/MINE/')
 from mine.models.mine import MutualInformationEstimator
@@ -100,22 +101,57 @@ class ZipTwoDataset(torch.utils.data.Dataset):
         return self.N
 
 
-def corrupt_label(labels: np.array,
-                  corruption_ratio: float,
-                  random_seed: int = 1):
-    assert corruption_ratio >= 0 and corruption_ratio <= 1
-    if corruption_ratio == 0:
-        return labels
+def estimate_mi(method: str, data: np.array, labels: np.array, rep: int,
+                device: torch.device) -> float:
+    '''
+    Mutual information between `data` and `labels` estimated by `method`.
+    `rep` (the repetition index) seeds the estimators that take a random seed.
+    '''
+    dim = data.shape[1]
+    if method == 'DSMI':
+        return diffusion_spectral_mutual_information(
+            embedding_vectors=data,
+            reference_vectors=labels,
+            reference_discrete=True,
+            t=1,
+            gaussian_kernel_sigma=np.sqrt(dim),
+            chebyshev_approx=False,
+            random_seed=rep)[0]
+    elif method == 'DMEE':
+        return diffusion_spectral_mutual_information(
+            embedding_vectors=data,
+            reference_vectors=labels,
+            matrix_entry_entropy=True,
+            reference_discrete=True,
+            t=1,
+            gaussian_kernel_sigma=np.sqrt(dim),
+            chebyshev_approx=False,
+            random_seed=rep)[0]
+    elif method == 'ASMI_KNN':
+        return adjacency_spectral_mutual_information(
+            embedding_vectors=data,
+            reference_vectors=labels,
+            use_knn=True,
+            reference_discrete=True,
+            gaussian_kernel_sigma=np.sqrt(dim),
+            random_seed=rep)[0]
+    elif method == 'ASMI_Gaussian':
+        return adjacency_spectral_mutual_information(
+            embedding_vectors=data,
+            reference_vectors=labels,
+            reference_discrete=True,
+            gaussian_kernel_sigma=np.sqrt(dim),
+            random_seed=rep)[0]
+    elif method == 'ASMI_Anisotropic':
+        return adjacency_spectral_mutual_information(
+            embedding_vectors=data,
+            reference_vectors=labels,
+            anisotropic=True,
+            reference_discrete=True,
+            gaussian_kernel_sigma=np.sqrt(dim),
+            random_seed=rep)[0]
     else:
-        if random_seed is not None:
-            np.random.seed(random_seed)
-            random.seed(random_seed)
-        indices = random.sample(range(len(labels)),
-                                k=int(corruption_ratio * len(labels)))
-        permuted_indices = np.random.permutation(indices)
-        corrupted_labels = labels.copy()
-        corrupted_labels[indices] = corrupted_labels[permuted_indices]
-        return corrupted_labels
+        raise ValueError('`estimate_mi`: method %s not supported.' % method)
 
 
 if __name__ == '__main__':
@@ -125,6 +161,10 @@ if __name__ == '__main__':
                         help='Available GPU index.',
                         type=int,
                         default=0)
+    parser.add_argument('--num-workers',
+                        help='Number of processes computing the grid cells.',
+                        type=int,
+                        default=1)
     args = vars(parser.parse_args())
     args = AttributeHashmap(args)
 
@@ -137,7 +177,10 @@ if __name__ == '__main__':
                           args.gpu_id if torch.cuda.is_available() else 'cpu')
 
     dim_list = [20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000]
-    corruption_ratio_list = np.linspace(0.0, 1.0, 11)
+    # Rounded, so that the values match exactly in the result table.
+    corruption_ratio_list = [
+        round(c, 1) for c in np.linspace(0.0, 1.0, 11)
+    ]
     noise_level_list = [1e-2, 1e-1, 5e-1, 7e-1]
     num_repetition = 2
 
@@ -145,198 +188,63 @@ if __name__ == '__main__':
         'DSMI', 'DMEE', 'ASMI_KNN', 'ASMI_Gaussian', 'ASMI_Anisotropic'
     ]
 
+    cache_dir = '%s/data_cache/' % save_root
+    save_path_table = '%s/toy-MI-blob-ASMI.jsonl' % save_root
+
+    # Experiment 1: vary the label corruption (with d = 20 and d = 100).
+    # Experiment 2: vary the dimension.
+    # Each (dataset, estimator, repetition) cell is one task of the grid.
+    cells = grid_cells(dim=[20, 100],
+                       corruption_ratio=corruption_ratio_list,
+                       noise_level=noise_level_list,
+                       data_seed=[args.random_seed],
+                       method=method_list,
+                       rep=range(num_repetition)) + \
+            grid_cells(dim=dim_list,
+                       corruption_ratio=[0.0],
+                       noise_level=noise_level_list,
+                       data_seed=[args.random_seed],
+                       method=method_list,
+                       rep=range(num_repetition))
+    rows = run_grid(cells=cells,
+                    task_fn=run_cell,
+                    table_path=save_path_table,
+                    num_workers=args.num_workers,
+                    task_kwargs={
+                        'cache_dir': cache_dir,
+                        'device': str(device),
+                        'generate_fn': generate_blobs,
+                        'estimate_fn': estimate_mi,
+                    })
+
     mi_by_corruption_d_20_dict = {}
     mi_by_corruption_d_100_dict = {}
     mi_by_dim_dict = {}
 
     for m in method_list:
-        mi_by_corruption_d_20_dict[m] = [[
-            [] for _ in range(len(noise_level_list))
-        ] for _ in range(len(corruption_ratio_list))]
-        mi_by_corruption_d_100_dict[m] = [[
-            [] for _ in range(len(noise_level_list))
-        ] for _ in range(len(corruption_ratio_list))]
-        mi_by_dim_dict[m] = [[[] for _ in range(len(noise_level_list))]
-                             for _ in range(len(dim_list))]
-
-    # Experiment 1: vary the label corruption.
-    default_dim = 20
-    for i, corruption_ratio in enumerate(tqdm(corruption_ratio_list)):
-        blobs_data, blobs_label = make_blobs(n_samples=5000,
-                                             n_features=default_dim)
-        blobs_label = corrupt_label(blobs_label,
-                                    corruption_ratio=corruption_ratio)
-        for j, noise_level in enumerate(noise_level_list):
-            blobs_data += noise_level * np.random.uniform(
-                -1, 1, size=blobs_data.shape)
-            for rep in range(num_repetition):
-
-                mi_by_corruption_d_20_dict['DSMI'][i][j].append(
-                    diffusion_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        reference_discrete=True,
-                        t=1,
-                        gaussian_kernel_sigma=np.sqrt(default_dim),
-                        chebyshev_approx=False,
-                        random_seed=rep)[0])
-                
-                mi_by_corruption_d_20_dict['DMEE'][i][j].append(
-                    diffusion_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        matrix_entry_entropy=True,
-                        reference_discrete=True,
-                        t=1,
-                        gaussian_kernel_sigma=np.sqrt(default_dim),
-                        chebyshev_approx=False,
-                        random_seed=rep)[0])
-                
-                mi_by_corruption_d_20_dict['ASMI_KNN'][i][j].append(
-                    adjacency_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        use_knn=True,
-                        reference_discrete=True,
-                        gaussian_kernel_sigma=np.sqrt(default_dim),
-                        random_seed=rep)[0])
-                
-                mi_by_corruption_d_20_dict['ASMI_Gaussian'][i][j].append(
-                    adjacency_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        reference_discrete=True,
-                        gaussian_kernel_sigma=np.sqrt(default_dim),
-                        random_seed=rep)[0])
-                
-                mi_by_corruption_d_20_dict['ASMI_Anisotropic'][i][j].append(
-                    adjacency_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        anisotropic=True,
-                        reference_discrete=True,
-                        gaussian_kernel_sigma=np.sqrt(default_dim),
-                        random_seed=rep)[0])
-
-    default_dim = 100
-    for i, corruption_ratio in enumerate(tqdm(corruption_ratio_list)):
-        blobs_data, blobs_label = make_blobs(n_samples=5000,
-                                             n_features=default_dim)
-        blobs_label = corrupt_label(blobs_label,
-                                    corruption_ratio=corruption_ratio)
-        for j, noise_level in enumerate(noise_level_list):
-            blobs_data += noise_level * np.random.uniform(
-                -1, 1, size=blobs_data.shape)
-            for rep in range(num_repetition):
-
-                mi_by_corruption_d_100_dict['DSMI'][i][j].append(
-                    diffusion_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        reference_discrete=True,
-                        t=1,
-                        gaussian_kernel_sigma=np.sqrt(default_dim),
-                        chebyshev_approx=False,
-                        random_seed=rep)[0])
-                
-                mi_by_corruption_d_100_dict['DMEE'][i][j].append(
-                    diffusion_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        matrix_entry_entropy=True,
-                        reference_discrete=True,
-                        t=1,
-                        gaussian_kernel_sigma=np.sqrt(default_dim),
-                        chebyshev_approx=False,
-                        random_seed=rep)[0])
-                
-                mi_by_corruption_d_100_dict['ASMI_KNN'][i][j].append(
-                    adjacency_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        use_knn=True,
-                        reference_discrete=True,
-                        gaussian_kernel_sigma=np.sqrt(default_dim),
-                        random_seed=rep)[0])
-                
-                mi_by_corruption_d_100_dict['ASMI_Gaussian'][i][j].append(
-                    adjacency_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        reference_discrete=True,
-                        gaussian_kernel_sigma=np.sqrt(default_dim),
-                        random_seed=rep)[0])
-                
-                mi_by_corruption_d_100_dict['ASMI_Anisotropic'][i][j].append(
-                    adjacency_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        anisotropic=True,
-                        reference_discrete=True,
-                        gaussian_kernel_sigma=np.sqrt(default_dim),
-                        random_seed=rep)[0])
-
-
-    # Experiment 2: vary the dimension.
-    for i, dim in enumerate(tqdm(dim_list)):
-        blobs_data, blobs_label = make_blobs(n_samples=5000, n_features=dim)
-        for j, noise_level in enumerate(noise_level_list):
-            blobs_data += noise_level * np.random.uniform(
-                -1, 1, size=blobs_data.shape)
-            for rep in range(num_repetition):
-
-                mi_by_dim_dict['DSMI'][i][j].append(
-                    diffusion_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        reference_discrete=True,
-                        t=1,
-                        gaussian_kernel_sigma=np.sqrt(dim),
-                        chebyshev_approx=False,
-                        random_seed=rep)[0])
-                
-                mi_by_dim_dict['DMEE'][i][j].append(
-                    diffusion_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        matrix_entry_entropy=True,
-                        reference_discrete=True,
-                        t=1,
-                        gaussian_kernel_sigma=np.sqrt(dim),
-                        chebyshev_approx=False,
-                        random_seed=rep)[0])
-                
-                mi_by_dim_dict['ASMI_KNN'][i][j].append(
-                    adjacency_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        use_knn=True,
-                        reference_discrete=True,
-                        gaussian_kernel_sigma=np.sqrt(dim),
-                        random_seed=rep)[0])
-                
-                mi_by_dim_dict['ASMI_Gaussian'][i][j].append(
-                    adjacency_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        reference_discrete=True,
-                        gaussian_kernel_sigma=np.sqrt(dim),
-                        random_seed=rep)[0])
-                
-                mi_by_dim_dict['ASMI_Anisotropic'][i][j].append(
-                    adjacency_spectral_mutual_information(
-                        embedding_vectors=blobs_data,
-                        reference_vectors=blobs_label,
-                        anisotropic=True,
-                        reference_discrete=True,
-                        gaussian_kernel_sigma=np.sqrt(dim),
-                        random_seed=rep)[0])
-
-    for m in method_list:
-        mi_by_corruption_d_20_dict[m] = np.array(mi_by_corruption_d_20_dict[m])
-        mi_by_corruption_d_100_dict[m] = np.array(
-            mi_by_corruption_d_100_dict[m])
-        mi_by_dim_dict[m] = np.array(mi_by_dim_dict[m])
+        # [corruption ratio, noise level, repetition]
+        for default_dim, mi_dict in [(20, mi_by_corruption_d_20_dict),
+                                     (100, mi_by_corruption_d_100_dict)]:
+            mi_dict[m] = grid_array(rows,
+                                    axes={
+                                        'corruption_ratio':
+                                        corruption_ratio_list,
+                                        'noise_level': noise_level_list,
+                                        'rep': range(num_repetition)
+                                    },
+                                    method=m,
+                                    dim=default_dim,
+                                    data_seed=args.random_seed)
+        # [dim, noise level, repetition]
+        mi_by_dim_dict[m] = grid_array(rows,
+                                       axes={
+                                           'dim': dim_list,
+                                           'noise_level': noise_level_list,
+                                           'rep': range(num_repetition)
+                                       },
+                                       method=m,
+                                       corruption_ratio=0.0,
+                                       data_seed=args.random_seed)
 
     plt.rcParams['font.family'] = 'serif'
     plt.rcParams['legend.fontsize'] = 10
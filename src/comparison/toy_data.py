@@ -0,0 +1,118 @@
+import os
+import random
+import sys
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+import torch
+from sklearn.datasets import make_blobs
+
+import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-3])
+sys.path.insert(0, import_dir + '/src/utils/')
+from experiment_grid import cached_dataset
+
+# Part of the key of the cached datasets.
+# Bump it whenever the generated data change (e.g., `n_samples`, `num_branches`).
+TOY_DATA_VERSION = '1'
+
+
+def corrupt_label(labels: np.array,
+                  corruption_ratio: float,
+                  random_seed: int = 1):
+    assert corruption_ratio >= 0 and corruption_ratio <= 1
+    if corruption_ratio == 0:
+        return labels
+    else:
+        if random_seed is not None:
+            np.random.seed(random_seed)
+            random.seed(random_seed)
+        indices = random.sample(range(len(labels)),
+                                k=int(corruption_ratio * len(labels)))
+        permuted_indices = np.random.permutation(indices)
+        corrupted_labels = labels.copy()
+        corrupted_labels[indices] = corrupted_labels[permuted_indices]
+        return corrupted_labels
+
+
+def generate_blobs(dim: int, corruption_ratio: float,
+                   data_seed: int) -> Tuple[np.array, np.array]:
+    '''
+    Noiseless blobs with (partially) corrupted labels, deterministic given the arguments.
+    '''
+    blobs_data, blobs_label = make_blobs(n_samples=5000,
+                                         n_features=dim,
+                                         random_state=data_seed)
+    blobs_label = corrupt_label(blobs_label,
+                                corruption_ratio=corruption_ratio,
+                                random_seed=data_seed)
+    return blobs_data, blobs_label
+
+
+def generate_tree(num_points: int = 1000,
+                  dim: int = 100,
+                  num_branches: int = 10,
+                  rand_multiplier: float = 2,
+                  random_seed: int = 1):
+    '''
+    Adapated from
+    https://github.com/KrishnaswamyLab/PHATE/blob/8578022459060e8c29e9b37b537a2203e0c7fd6c/Python/phate/tree.py
+    '''
+    np.random.seed(random_seed)
+    branch_length = num_points // num_branches
+    M = np.cumsum(-1 + rand_multiplier * np.random.rand(branch_length, dim), 0)
+    for _ in range(num_branches - 1):
+        ind = np.random.randint(branch_length)
+        new_branch = np.cumsum(
+            -1 + rand_multiplier * np.random.rand(branch_length, dim), 0)
+        M = np.concatenate([M, new_branch + M[ind, :]])
+
+    C = np.array(
+        [i // branch_length for i in range(num_branches * branch_length)])
+
+    return M, C
+
+
+def generate_tree_dataset(dim: int, corruption_ratio: float,
+                          data_seed: int) -> Tuple[np.array, np.array]:
+    '''
+    Noiseless tree with (partially) corrupted labels, deterministic given the arguments.
+    '''
+    tree_data, tree_label = generate_tree(num_points=5000,
+                                          num_branches=5,
+                                          dim=dim,
+                                          random_seed=data_seed)
+    tree_label = corrupt_label(tree_label,
+                               corruption_ratio=corruption_ratio,
+                               random_seed=data_seed)
+    return tree_data, tree_label
+
+
+def load_cell_data(cell: Dict, cache_dir: str,
+                   generate_fn: Callable) -> Tuple[np.array, np.array]:
+    '''
+    Dataset of a grid cell: the cached noiseless dataset `generate_fn`, plus uniform noise of
+    amplitude `noise_level`, seeded by `data_seed` (same data for all estimators and repetitions).
+    '''
+    data, labels = cached_dataset(cache_dir,
+                                  generate_fn,
+                                  version=TOY_DATA_VERSION,
+                                  dim=cell['dim'],
+                                  corruption_ratio=cell['corruption_ratio'],
+                                  data_seed=cell['data_seed'])
+    rng = np.random.default_rng(cell['data_seed'])
+    data = data + cell['noise_level'] * rng.uniform(-1, 1, size=data.shape)
+    return data, labels
+
+
+def run_cell(cell: Dict, cache_dir: str, device: str, generate_fn: Callable,
+             estimate_fn: Callable) -> float:
+    '''
+    Task of `run_grid`: the MI of the cell dataset estimated by
+    `estimate_fn(method=..., data=..., labels=..., rep=..., device=...)`.
+    '''
+    data, labels = load_cell_data(cell, cache_dir, generate_fn)
+    return estimate_fn(method=cell['method'],
+                       data=data,
+                       labels=labels,
+                       rep=cell['rep'],
+                       device=torch.device(device))
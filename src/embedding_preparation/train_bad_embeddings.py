@@ -27,6 +27,8 @@ from models import get_model
 from path_utils import update_config_dirs
 from seed import seed_everything
 from save_utils import save_numpy
+from embedding_store import EmbeddingStoreWriter
+from fast_inference import accelerate_model, probe_batch
 from scheduler import LinearWarmupCosineAnnealingLR
 
 
@@ -393,13 +395,73 @@ def infer(config: AttributeHashmap) -> None:
         config.log_dir, config.dataset, config.bad_method, config.model,
         config.random_seed, '-zeroinit' if config.zero_init else '')
 
-    for checkpoint in tqdm(checkpoint_paths):
-        checkpoint_name = checkpoint.split('/')[-1].replace('.pth', '')
-        model.load_state_dict(torch.load(checkpoint))
-        model.eval()
-
-        total_by_class = {}
-        correct_by_class = {}
+    # Several checkpoints share each pass over the val set:
+    # every val batch is loaded once and run through each checkpoint of the group.
+    num_replicas = max(
+        1, min(config.infer_checkpoints_per_pass, len(checkpoint_paths)))
+    models = [model] + [
+        get_model(model_name=config.model,
+                  num_classes=config.num_classes,
+                  small_image=config.small_image).to(device)
+        for _ in range(num_replicas - 1)
+    ]
+
+    # CPU fast inference mode: each checkpoint is accelerated after loading,
+    # and only kept if the DSE of the probe set matches the fp32 one.
+    fast_inference = config.fast_inference != 'off' and device.type == 'cpu'
+    if fast_inference:
+        probe_x = probe_batch(val_loader, in_channels=config.in_channels)
+
+    for group_start in tqdm(range(0, len(checkpoint_paths), num_replicas)):
+        group_paths = checkpoint_paths[group_start:group_start + num_replicas]
+        checkpoint_names = [
+            checkpoint.split('/')[-1].replace('.pth', '')
+            for checkpoint in group_paths
+        ]
+        for replica, checkpoint in zip(models, group_paths):
+            replica.load_state_dict(torch.load(checkpoint))
+            replica.eval()
+        run_models = models
+        if fast_inference:
+            run_models = [
+                accelerate_model(replica,
+                                 probe_x=probe_x,
+                                 backend=config.fast_inference,
+                                 quantize_int8=config.fast_inference_int8,
+                                 with_logits=True,
+                                 tolerance=config.fidelity_tolerance,
+                                 log_fn=lambda s: log(
+                                     s, filepath=log_path, to_console=True))[0]
+                for replica in models[:len(group_paths)]
+            ]
+
+        store_writers = [None] * len(group_paths)
+        if config.embedding_format == 'store':
+            store_writers = [
+                EmbeddingStoreWriter(store_dir='%s/embeddings/' %
+                                     config.output_save_path,
+                                     name=checkpoint_name,
+                                     num_samples=len(val_loader.dataset),
+                                     split_signature={
+                                         'dataset':
+                                         config.dataset,
+                                         'split':
+                                         'val',
+                                         'transform':
+                                         repr(
+                                             getattr(val_loader.dataset,
+                                                     'transform', None)),
+                                     })
+                for checkpoint_name in checkpoint_names
+            ]
+
+        total_by_class = torch.zeros(config.num_classes,
+                                     dtype=torch.int64,
+                                     device=device)
+        correct_by_class = torch.zeros(
+            (len(group_paths), config.num_classes),
+            dtype=torch.int64,
+            device=device)
 
         with torch.no_grad():
             for batch_idx, (x, y_true) in enumerate(val_loader):
@@ -408,39 +470,55 @@ def infer(config: AttributeHashmap) -> None:
                     # Repeat the channel dimension: 1 channel -> 3 channels.
                     x = x.repeat(1, 3, 1, 1)
                 x, y_true = x.to(device), y_true.to(device)
-
-                h = model.encode(x)
-                y_pred = model(x)
-                y_correct = (torch.argmax(
-                    y_pred, dim=-1) == y_true).cpu().detach().numpy()
-
-                # Record per-class accuracy.
-                for i in range(y_true.shape[0]):
-                    class_true = y_true[i].item()
-                    is_correct = y_correct[i]
-                    if class_true not in total_by_class.keys():
-                        total_by_class[class_true] = 1
-                        assert class_true not in correct_by_class.keys()
-                        correct_by_class[class_true] = 0
+                total_by_class += torch.bincount(
+                    y_true, minlength=config.num_classes)
+
+                for j, (replica, checkpoint_name, store_writer) in enumerate(
+                        zip(run_models, checkpoint_names, store_writers)):
+                    y_pred, h, _ = replica.forward_with_latent(x)
+                    y_correct = torch.argmax(y_pred, dim=-1) == y_true
+
+                    # Record per-class accuracy.
+                    correct_by_class[j] += torch.bincount(
+                        y_true[y_correct], minlength=config.num_classes)
+
+                    if store_writer is not None:
+                        # The val images are the same for the whole group:
+                        # only the first checkpoint writes them.
+                        store_writer.append(
+                            image_batch=x if j == 0 else None,
+                            label_true_batch=y_true,
+                            embedding_batch=h)
                     else:
-                        total_by_class[class_true] += 1
-                    if is_correct:
-                        correct_by_class[class_true] += 1
-
-                save_numpy(config=config,
-                           batch_idx=batch_idx,
-                           numpy_filename=checkpoint_name,
-                           image_batch=x,
-                           label_true_batch=y_true,
-                           embedding_batch=h)
-
+                        save_numpy(config=config,
+                                   batch_idx=batch_idx,
+                                   numpy_filename=checkpoint_name,
+                                   image_batch=x,
+                                   label_true_batch=y_true,
+                                   embedding_batch=h)
+
+        # In order: the first writer holds the shared images.
+        for store_writer in store_writers:
+            if store_writer is not None:
+                store_writer.close(image_writer=store_writers[0])
+
+        total_by_class = total_by_class.cpu().numpy()
+        correct_by_class = correct_by_class.cpu().numpy()
+        observed_classes = np.flatnonzero(total_by_class)
+        for j, checkpoint_name in enumerate(checkpoint_names):
             log('\nCheckpoint: %s' % checkpoint_name,
                 filepath=log_path,
                 to_console=True)
             log('#total by class:', filepath=log_path, to_console=True)
-            log(str(total_by_class), filepath=log_path, to_console=True)
+            log(str({int(c): int(total_by_class[c])
+                     for c in observed_classes}),
+                filepath=log_path,
+                to_console=True)
             log('#correct by class:', filepath=log_path, to_console=True)
-            log(str(correct_by_class), filepath=log_path, to_console=True)
+            log(str({int(c): int(correct_by_class[j, c])
+                     for c in observed_classes}),
+                filepath=log_path,
+                to_console=True)
 
     return
 
@@ -460,12 +538,43 @@ if __name__ == '__main__':
         help='Random Seed. If not None, will overwrite config.random_seed.',
         type=int,
         default=None)
+    parser.add_argument(
+        '--infer-checkpoints-per-pass',
+        help='Number of checkpoints run on each val batch in a single pass over the val set '
+        '(one model replica per checkpoint on the device).',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--embedding-format',
+        help='`npz`: one npz file per val batch. '
+        '`store`: one memory-mappable npy file per field, val images shared across checkpoints.',
+        choices=['npz', 'store'],
+        default='npz')
+    parser.add_argument(
+        '--fast-inference',
+        help='Infer mode, CPU only. `trace`: torch.jit.trace + freeze, `compile`: torch.compile, '
+        'with channels_last and inference_mode. Falls back to the fp32 model '
+        'if the DSE of a probe set deviates by more than `--fidelity-tolerance`.',
+        choices=['off', 'trace', 'compile'],
+        default='off')
+    parser.add_argument('--fast-inference-int8',
+                        help='Also quantize the Linear layers to dynamic int8.',
+                        action='store_true')
+    parser.add_argument('--fidelity-tolerance',
+                        help='Max relative DSE deviation of the fast inference mode.',
+                        type=float,
+                        default=0.01)
     args = vars(parser.parse_args())
 
     args = AttributeHashmap(args)
     config = AttributeHashmap(yaml.safe_load(open(args.config)))
     config.config_file_name = args.config
     config.gpu_id = args.gpu_id
+    config.embedding_format = args.embedding_format
+    config.infer_checkpoints_per_pass = args.infer_checkpoints_per_pass
+    config.fast_inference = args.fast_inference
+    config.fast_inference_int8 = args.fast_inference_int8
+    config.fidelity_tolerance = args.fidelity_tolerance
     if args.random_seed is not None:
         config.random_seed = args.random_seed
     config = update_config_dirs(AttributeHashmap(config))
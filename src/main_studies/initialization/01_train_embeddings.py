@@ -3,7 +3,6 @@ import os
 import sys
 from typing import Tuple, Dict, Iterable
 from matplotlib import pyplot as plt
-from scipy.stats import pearsonr, spearmanr
 
 import numpy as np
 import torch
@@ -21,12 +20,21 @@ from dsmi import diffusion_spectral_mutual_information
 
 sys.path.insert(0, import_dir + '/src/nn/')
 sys.path.insert(0, import_dir + '/src/utils/')
+from activation_sketch import ActivationSketch
 from attribute_hashmap import AttributeHashmap
+from checkpoint_writer import CheckpointWriter
+from dataset_cache import cache_dataset
+from linear_probe import cached_linear_probing
 from log_utils import log
+from metrics_sink import MetricsSink, PlottingProcess, format_correlations
 from path_utils import update_config_dirs
+from reference_cache import ReferenceCache
+from reservoir import ReservoirMetrics, StratifiedReservoir
 from seed import seed_everything
-from simclr import NTXentLoss, SingleInstanceTwoView
+from simclr import NTXentLoss, VectorizedNTXentLoss, SingleInstanceTwoView, \
+    BatchedTwoView, BatchedTwoViewCollate
 from scheduler import LinearWarmupCosineAnnealingLR
+from train_engine import TrainEngine
 from extend import ExtendedDataset
 
 
@@ -222,11 +230,38 @@ def get_dataloaders(
                                           split='val',
                                           transform=transform_val)
 
+    # Two-view generation on whole uint8 batches, in the `collate_fn`.
+    batched_augmentation = config.method == 'simclr' and config.batched_augmentation
+    train_collate_fn = None
+    if batched_augmentation:
+        assert config.dataset_cache, \
+            '`--batched-augmentation` requires `--dataset-cache`.'
+        train_collate_fn = BatchedTwoViewCollate(
+            BatchedTwoView(imsize=imsize, mean=dataset_mean, std=dataset_std))
+
+    if config.dataset_cache:
+        # Decode and resize each split only once.
+        # The random augmentations then run on the cached uint8 tensors.
+        train_dataset = cache_dataset(train_dataset,
+                                      cache_dir=config.dataset_cache_dir,
+                                      name='%s-train' % config.dataset,
+                                      dataset_dir=config.dataset_dir,
+                                      imsize=imsize,
+                                      num_workers=config.num_workers,
+                                      keep_transform=not batched_augmentation)
+        val_dataset = cache_dataset(val_dataset,
+                                    cache_dir=config.dataset_cache_dir,
+                                    name='%s-val' % config.dataset,
+                                    dataset_dir=config.dataset_dir,
+                                    imsize=imsize,
+                                    num_workers=config.num_workers)
+
     train_loader = torch.utils.data.DataLoader(train_dataset,
                                                batch_size=config.batch_size,
                                                num_workers=config.num_workers,
                                                shuffle=True,
-                                               pin_memory=True)
+                                               pin_memory=True,
+                                               collate_fn=train_collate_fn)
     val_loader = torch.utils.data.DataLoader(val_dataset,
                                              batch_size=config.batch_size,
                                              num_workers=config.num_workers,
@@ -258,6 +293,13 @@ def get_dataloaders(
             ]))
         val_dataset = ExtendedDataset(val_dataset,
                                       desired_len=10 * len(val_dataset))
+        if config.dataset_cache:
+            val_dataset = cache_dataset(val_dataset,
+                                        cache_dir=config.dataset_cache_dir,
+                                        name='%s-val' % config.dataset,
+                                        dataset_dir=config.dataset_dir,
+                                        imsize=imsize,
+                                        num_workers=config.num_workers)
         val_loader = torch.utils.data.DataLoader(
             val_dataset,
             batch_size=config.batch_size,
@@ -318,18 +360,11 @@ def plot_figures(data_arrays: Dict[str, Iterable], save_path_fig: str,
 
     # Display correlation.
     if len(data_arrays['val_acc']) > 1:
-        ax.set_title(
-            'CSE(Z), P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
-            (pearsonr(data_arrays['val_acc'], data_arrays['cse_Z'])[0],
-             pearsonr(data_arrays['val_acc'], data_arrays['cse_Z'])[1],
-             spearmanr(data_arrays['val_acc'], data_arrays['cse_Z'])[0],
-             spearmanr(data_arrays['val_acc'], data_arrays['cse_Z'])[1]) +
-            'DSE(Z), P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
-            (pearsonr(data_arrays['val_acc'], data_arrays['dse_Z'])[0],
-             pearsonr(data_arrays['val_acc'], data_arrays['dse_Z'])[1],
-             spearmanr(data_arrays['val_acc'], data_arrays['dse_Z'])[0],
-             spearmanr(data_arrays['val_acc'], data_arrays['dse_Z'])[1]),
-            fontsize=30)
+        ax.set_title(format_correlations(data_arrays['val_acc'], {
+            'CSE(Z)': data_arrays['cse_Z'],
+            'DSE(Z)': data_arrays['dse_Z'],
+        }),
+                     fontsize=30)
 
     # Plot of Mutual Information vs. epoch.
     ax = fig.add_subplot(3, 2, 5)
@@ -393,28 +428,13 @@ def plot_figures(data_arrays: Dict[str, Iterable], save_path_fig: str,
 
     # # Display correlation.
     if len(data_arrays['val_acc']) > 1:
-        ax.set_title(
-            'CSMI(Z; Y), P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
-            (pearsonr(data_arrays['val_acc'], data_arrays['csmi_Z_Y'])[0],
-             pearsonr(data_arrays['val_acc'], data_arrays['csmi_Z_Y'])[1],
-             spearmanr(data_arrays['val_acc'], data_arrays['csmi_Z_Y'])[0],
-             spearmanr(data_arrays['val_acc'], data_arrays['csmi_Z_Y'])[1]) +
-            'DSMI(Z; Y), P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
-            (pearsonr(data_arrays['val_acc'], data_arrays['dsmi_Z_Y'])[0],
-             pearsonr(data_arrays['val_acc'], data_arrays['dsmi_Z_Y'])[1],
-             spearmanr(data_arrays['val_acc'], data_arrays['dsmi_Z_Y'])[0],
-             spearmanr(data_arrays['val_acc'], data_arrays['dsmi_Z_Y'])[1]) +
-            'CSMI(Z; X), P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
-            (pearsonr(data_arrays['val_acc'], data_arrays['csmi_Z_X'])[0],
-             pearsonr(data_arrays['val_acc'], data_arrays['csmi_Z_X'])[1],
-             spearmanr(data_arrays['val_acc'], data_arrays['csmi_Z_X'])[0],
-             spearmanr(data_arrays['val_acc'], data_arrays['csmi_Z_X'])[1]) +
-            'DSMI(Z; X), P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
-            (pearsonr(data_arrays['val_acc'], data_arrays['dsmi_Z_X'])[0],
-             pearsonr(data_arrays['val_acc'], data_arrays['dsmi_Z_X'])[1],
-             spearmanr(data_arrays['val_acc'], data_arrays['dsmi_Z_X'])[0],
-             spearmanr(data_arrays['val_acc'], data_arrays['dsmi_Z_X'])[1]),
-            fontsize=30)
+        ax.set_title(format_correlations(data_arrays['val_acc'], {
+            'CSMI(Z; Y)': data_arrays['csmi_Z_Y'],
+            'DSMI(Z; Y)': data_arrays['dsmi_Z_Y'],
+            'CSMI(Z; X)': data_arrays['csmi_Z_X'],
+            'DSMI(Z; X)': data_arrays['dsmi_Z_X'],
+        }),
+                     fontsize=30)
     fig.tight_layout()
     fig.savefig(save_path_fig)
     plt.close(fig=fig)
@@ -485,7 +505,10 @@ def train(config: AttributeHashmap) -> None:
     model.init_params(conv_init_std=float(config.conv_init_std))
 
     loss_fn_classification = torch.nn.CrossEntropyLoss()
-    loss_fn_simclr = NTXentLoss()
+    if config.vectorized_ntxent:
+        loss_fn_simclr = VectorizedNTXentLoss()
+    else:
+        loss_fn_simclr = NTXentLoss()
 
     # `val_metric` is val acc for good training,
     # whereas train/val acc divergence for wrong label training.
@@ -494,6 +517,25 @@ def train(config: AttributeHashmap) -> None:
     else:
         val_metric = 'val_acc'
 
+    # The downsampled inputs (X), labels (Y) and clusters of X do not change
+    # across epochs. Reuse them from disk when the val loader is deterministic.
+    reference_cache, precomputed_clusters_X = None, None
+    if config.reference_cache:
+        if isinstance(val_loader.sampler,
+                      torch.utils.data.SequentialSampler):
+            reference_cache = ReferenceCache(
+                cache_dir=config.reference_cache_dir,
+                dataset_name=config.dataset,
+                dataset_dir=config.dataset_dir,
+                val_loader=val_loader,
+                in_channels=config.in_channels)
+            precomputed_clusters_X = reference_cache.clusters(
+                n_clusters=config.num_classes)
+        else:
+            log('Val loader is shuffled. Reference cache not used.',
+                filepath=log_path,
+                to_console=True)
+
     # Compute the results before training.
     val_loss, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, \
         dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X = validate_epoch(
@@ -502,7 +544,8 @@ def train(config: AttributeHashmap) -> None:
         model=model,
         device=device,
         loss_fn_classification=loss_fn_classification,
-        precomputed_clusters_X=None)
+        precomputed_clusters_X=precomputed_clusters_X,
+        reference_cache=reference_cache)
 
     state_dict = {
         'train_loss': 'Not started',
@@ -543,8 +586,46 @@ def train(config: AttributeHashmap) -> None:
                                                      config.max_epoch // 5),
                                                  max_epochs=config.max_epoch)
 
+    engine = TrainEngine(model=model,
+                         opt=opt,
+                         device=device,
+                         bf16=config.bf16,
+                         channels_last=config.channels_last,
+                         compile=config.compile,
+                         grad_accum_steps=config.grad_accum_steps,
+                         log_interval=config.throughput_log_interval,
+                         log_fn=lambda s: log(
+                             s, filepath=log_path, to_console=False))
+    loss_fn_classification = engine.compile_loss(loss_fn_classification)
+    loss_fn_simclr = engine.compile_loss(loss_fn_simclr)
+
+    # Class-stratified sample of the train embeddings from the training forward passes,
+    # for train-side DSE/DSMI at no extra forward cost.
+    train_reservoir, train_reservoir_metrics = None, None
+    if config.train_reservoir_size is not None:
+        train_reservoir = StratifiedReservoir(
+            num_classes=config.num_classes,
+            per_class=max(1, config.train_reservoir_size // config.num_classes),
+            seed=config.random_seed)
+        train_reservoir_metrics = ReservoirMetrics(
+            train_reservoir,
+            dse_fn=diffusion_spectral_entropy,
+            dsmi_fn=diffusion_spectral_mutual_information)
+
+    # Append-only log of the per-epoch metrics. If `plot_interval` is set,
+    # the figures are rendered from it by a separate, throttled process.
+    metrics_sink = MetricsSink(log_dir='%s-metrics-log/' % save_path_fig)
+    plotter = None
+    if config.plot_interval is not None:
+        plotter = PlottingProcess(plot_fn=plot_figures,
+                                  log_dir=metrics_sink.log_dir,
+                                  min_interval=config.plot_interval,
+                                  save_path_fig=save_path_fig,
+                                  block_by_block=config.block_by_block)
+
     best_val_metric = 0
-    best_model = None
+    # Checkpoints are written in the background.
+    checkpoint_writer = CheckpointWriter(keep_last=config.checkpoint_keep_last)
 
     # val_metric_pct_list = [20, 30, 40, 50, 60, 70, 80, 90]
     # is_model_saved = {}
@@ -573,6 +654,7 @@ def train(config: AttributeHashmap) -> None:
         model.train()
         # Because of linear warmup, first step has zero LR. Hence step once before training.
         lr_scheduler.step()
+        engine.start_epoch()
         correct, total_count_loss, total_count_acc = 0, 0, 0
         for _, (x, y_true) in enumerate(tqdm(train_loader)):
             if config.method in ['supervised', 'wronglabel']:
@@ -583,9 +665,14 @@ def train(config: AttributeHashmap) -> None:
                 if config.in_channels == 1:
                     # Repeat the channel dimension: 1 channel -> 3 channels.
                     x = x.repeat(1, 3, 1, 1)
-                x, y_true = x.to(device), y_true.to(device)
-
-                y_pred = model(x)
+                x, y_true = engine.to_device(x), y_true.to(device)
+
+                with engine.autocast():
+                    y_pred, z, _ = model.forward_with_latent(x)
+                if train_reservoir is not None:
+                    train_reservoir.add(z.detach(), y_true)
+                # Loss in float32, outside of autocast.
+                y_pred = y_pred.float()
                 loss = loss_fn_classification(y_pred, y_true)
                 state_dict['train_loss'] += loss.item() * B
                 correct += torch.sum(
@@ -593,9 +680,7 @@ def train(config: AttributeHashmap) -> None:
                 total_count_loss += B
                 total_count_acc += B
 
-                opt.zero_grad()
-                loss.backward()
-                opt.step()
+                engine.step(loss, batch_size=B)
 
             elif config.method == 'simclr':
                 # Using SimCLR.
@@ -607,27 +692,40 @@ def train(config: AttributeHashmap) -> None:
                     # Repeat the channel dimension: 1 channel -> 3 channels.
                     x_aug1 = x_aug1.repeat(1, 3, 1, 1)
                     x_aug2 = x_aug2.repeat(1, 3, 1, 1)
-                x_aug1, x_aug2, y_true = x_aug1.to(device), x_aug2.to(
-                    device), y_true.to(device)
+                x_aug1, x_aug2, y_true = engine.to_device(
+                    x_aug1), engine.to_device(x_aug2), y_true.to(device)
 
                 # Train encoder.
-                z1 = model.project(x_aug1)
-                z2 = model.project(x_aug2)
+                with engine.autocast():
+                    h1 = model.encode(x_aug1)
+                    z1 = model.projection_head(h1)
+                    z2 = model.project(x_aug2)
+                if train_reservoir is not None:
+                    train_reservoir.add(h1.detach(), y_true)
+                # Loss in float32, outside of autocast.
+                z1, z2 = z1.float(), z2.float()
 
                 loss, pseudo_acc = loss_fn_simclr(z1, z2)
-                state_dict['train_loss'] += loss.item() * B
+                # Accumulated on device. Synced once per epoch below.
+                state_dict['train_loss'] += loss.detach() * B
                 state_dict['train_simclr_pseudoAcc'] += pseudo_acc * B
                 total_count_loss += B
 
-                opt.zero_grad()
-                loss.backward()
-                opt.step()
+                engine.step(loss, batch_size=B)
 
+        state_dict['train_images_per_sec'] = engine.end_epoch()
         if config.method == 'simclr':
-            state_dict['train_simclr_pseudoAcc'] /= total_count_loss
+            state_dict['train_simclr_pseudoAcc'] = float(
+                state_dict['train_simclr_pseudoAcc']) / total_count_loss
         else:
             state_dict['train_acc'] = correct / total_count_acc * 100
-        state_dict['train_loss'] /= total_count_loss
+        state_dict['train_loss'] = float(
+            state_dict['train_loss']) / total_count_loss
+
+        if train_reservoir_metrics is not None:
+            train_metrics = train_reservoir_metrics.end_epoch(epoch_idx)
+            state_dict['train_dse_Z'] = train_metrics['dse_Z']
+            state_dict['train_dsmi_Z_Y'] = train_metrics['dsmi_Z_Y']
 
         #
         '''
@@ -644,7 +742,8 @@ def train(config: AttributeHashmap) -> None:
                     model=model,
                     device=device,
                     loss_fn_classification=loss_fn_classification,
-                    precomputed_clusters_X=precomputed_clusters_X)
+                    precomputed_clusters_X=precomputed_clusters_X,
+                    reference_cache=reference_cache)
                 state_dict['train_acc'] = probing_acc
                 state_dict['val_loss'] = np.nan
                 state_dict['val_acc'] = val_acc_final
@@ -660,7 +759,8 @@ def train(config: AttributeHashmap) -> None:
                 model=model,
                 device=device,
                 loss_fn_classification=loss_fn_classification,
-                precomputed_clusters_X=precomputed_clusters_X)
+                precomputed_clusters_X=precomputed_clusters_X,
+                reference_cache=reference_cache)
             state_dict['val_loss'] = val_loss
             state_dict['val_acc'] = val_acc
 
@@ -686,33 +786,42 @@ def train(config: AttributeHashmap) -> None:
             results_dict['dsmi_blockZ_Xs'].append(np.array(dsmi_blockZ_Xs))
             results_dict['dsmi_blockZ_Ys'].append(np.array(dsmi_blockZ_Ys))
 
-        plot_figures(data_arrays=results_dict,
-                     save_path_fig=save_path_fig,
-                     block_by_block=config.block_by_block)
+        metrics_sink.sync(results_dict)
+        if plotter is None:
+            plot_figures(data_arrays=results_dict,
+                         save_path_fig=save_path_fig,
+                         block_by_block=config.block_by_block)
 
-        # Save best model
+        # Save the epoch model, and the best model
         if not (config.method == 'simclr' and skip_epoch_simlr):
+            epoch_save_path = '%s/%s-%s-%s-ConvInitStd-%s-seed%s-epoch-%s.pth' % (
+                config.checkpoint_dir, config.dataset, config.method,
+                config.model, config.conv_init_std, config.random_seed,
+                epoch_idx)
+            checkpoint_writer.save(model.state_dict(),
+                                   epoch_save_path,
+                                   retention_group='epoch')
+
             if state_dict[val_metric] > best_val_metric:
                 best_val_metric = state_dict[val_metric]
-                best_model = model.state_dict()
                 model_save_path = '%s/%s-%s-%s-ConvInitStd-%s-seed%s-%s' % (
                     config.checkpoint_dir, config.dataset, config.method,
                     config.model, config.conv_init_std, config.random_seed,
                     '%s_best.pth' % val_metric)
-                torch.save(best_model, model_save_path)
+                # Same weights as the epoch model: hard link, no re-serialization.
+                checkpoint_writer.link(epoch_save_path, model_save_path)
                 log('Best model (so far) successfully saved.',
                     filepath=log_path,
                     to_console=False)
 
-            model_save_path = '%s/%s-%s-%s-ConvInitStd-%s-seed%s-epoch-%s.pth' % (
-                config.checkpoint_dir, config.dataset, config.method,
-                config.model, config.conv_init_std, config.random_seed,
-                epoch_idx)
-            torch.save(model.state_dict(), model_save_path)
-
         if epoch_idx > 30:
             break
 
+    checkpoint_writer.close()
+    if plotter is not None:
+        # Final render with the complete log.
+        plotter.close()
+
     # Save the results after training.
     save_path_numpy = '%s/%s-%s-%s-ConvInitStd-%s-seed%s/%s' % (
         config.output_save_path, config.dataset, config.method, config.model,
@@ -732,6 +841,11 @@ def train(config: AttributeHashmap) -> None:
             csmi_Z_Y=np.array(results_dict['csmi_Z_Y']),
         )
 
+    if train_reservoir_metrics is not None:
+        # Train-side metrics, from the reservoir of train embeddings.
+        train_reservoir_metrics.save(
+            os.path.join(os.path.dirname(save_path_numpy), 'train-results.npz'))
+
     # Save block by block DSMI results
     save_path_numpy = '%s/%s-%s-%s-ConvInitStd-%s-seed%s/%s' % (
         config.output_save_path, config.dataset, config.method, config.model,
@@ -763,7 +877,12 @@ def validate_epoch(config: AttributeHashmap,
                    val_loader: torch.utils.data.DataLoader,
                    model: torch.nn.Module, device: torch.device,
                    loss_fn_classification: torch.nn.Module,
-                   precomputed_clusters_X: np.array):
+                   precomputed_clusters_X: np.array,
+                   reference_cache: ReferenceCache = None):
+    '''
+    If `reference_cache` is provided, X and Y are read from the cache
+    and only the latent vectors (Z) are collected here.
+    '''
 
     correct, total_count_loss, total_count_acc = 0, 0, 0
     val_loss, val_acc = 0, 0
@@ -775,11 +894,17 @@ def validate_epoch(config: AttributeHashmap,
     if config.block_by_block:
         '''Get block by block activations'''
         activation = {}
+        # Compress the activations inside the hook, before they leave the device.
+        # See `ActivationSketch` for the distance distortion of each mode.
+        sketch = ActivationSketch(mode=config.block_sketch,
+                                  dim=config.block_sketch_dim,
+                                  seed=config.random_seed,
+                                  channels_last=config.model == 'swin')
 
         def getActivation(name):
 
             def hook(model, input, output):
-                activation[name] = output.detach()
+                activation[name] = sketch(output.detach())
 
             return hook
 
@@ -817,7 +942,9 @@ def validate_epoch(config: AttributeHashmap,
                 x = x.repeat(1, 3, 1, 1)
             x, y_true = x.to(device), y_true.to(device)
 
-            y_pred = model(x)
+            # One forward pass for both the logits and the latent embedding.
+            y_pred, curr_Z, _ = model.forward_with_latent(x)
+            curr_Z = curr_Z.cpu().numpy()
             loss = loss_fn_classification(y_pred, y_true)
             val_loss += loss.item() * B
             correct += torch.sum(torch.argmax(y_pred, dim=-1) == y_true).item()
@@ -826,26 +953,27 @@ def validate_epoch(config: AttributeHashmap,
                 total_count_loss += B
 
             ## Record data for DSE and DSMI computation.
-
-            # Downsample the input image to reduce memory usage.
-            curr_X = torch.nn.functional.interpolate(
-                x, size=(64, 64)).cpu().numpy().reshape(x.shape[0], -1)
-            curr_Y = y_true.cpu().numpy()
-            curr_Z = model.encode(x).cpu().numpy()
-            if tensor_X is None:
-                tensor_X, tensor_Y, tensor_Z = curr_X, curr_Y, curr_Z
+            if tensor_Z is None:
+                tensor_Z = curr_Z
             else:
-                tensor_X = np.vstack((tensor_X, curr_X))
-                tensor_Y = np.hstack((tensor_Y, curr_Y))
                 tensor_Z = np.vstack((tensor_Z, curr_Z))
 
+            if reference_cache is None:
+                # Downsample the input image to reduce memory usage.
+                curr_X = torch.nn.functional.interpolate(
+                    x, size=(64, 64)).cpu().numpy().reshape(x.shape[0], -1)
+                curr_Y = y_true.cpu().numpy()
+                if tensor_X is None:
+                    tensor_X, tensor_Y = curr_X, curr_Y
+                else:
+                    tensor_X = np.vstack((tensor_X, curr_X))
+                    tensor_Y = np.hstack((tensor_Y, curr_Y))
+
             if config.block_by_block:
                 # Collect block activations from key layers
                 for i in block_index_list:
                     curr_block_features = activation['blocks_' +
                                                      str(i)].cpu().numpy()
-                    curr_block_features = curr_block_features.reshape(
-                        curr_block_features.shape[0], -1)
                     blocks_features[i].append(curr_block_features)  # (B, D)
 
     if config.block_by_block:
@@ -853,6 +981,10 @@ def validate_epoch(config: AttributeHashmap,
             blocks_features[i] = np.vstack(blocks_features[i])
             handlers_list[i].remove()
 
+    if reference_cache is not None:
+        tensor_X, tensor_Y = reference_cache.X, reference_cache.Y
+        assert tensor_X.shape[0] == tensor_Z.shape[0]
+
     if config.dataset == 'tinyimagenet':
         # For DSE, subsample for faster computation.
         dse_Z = diffusion_spectral_entropy(
@@ -913,30 +1045,45 @@ def linear_probing(config: AttributeHashmap,
                    val_loader: torch.utils.data.DataLoader,
                    model: torch.nn.Module, device: torch.device,
                    loss_fn_classification: torch.nn.Module,
-                   precomputed_clusters_X: np.array):
+                   precomputed_clusters_X: np.array,
+                   reference_cache: ReferenceCache = None):
 
     # Separately train linear classifier.
     model.init_linear()
-    # Note: Need to create another optimizer because the model will keep updating
-    # even after freezing with `requires_grad = False` when `opt` has `momentum`.
-    opt_probing = torch.optim.AdamW(list(model.linear.parameters()),
-                                    lr=float(config.learning_rate_probing))
-
-    lr_scheduler_probing = LinearWarmupCosineAnnealingLR(
-        optimizer=opt_probing,
-        warmup_epochs=min(10, config.probing_epoch // 5),
-        max_epochs=config.probing_epoch)
 
-    for _ in tqdm(range(config.probing_epoch)):
-        # Because of linear warmup, first step has zero LR. Hence step once before training.
-        lr_scheduler_probing.step()
-        probing_acc = linear_probing_epoch(
-            config=config,
-            train_loader=train_loader,
+    if config.probing_mode != 'online':
+        # The train set goes through the frozen encoder once per probe,
+        # and the linear classifier is trained on the cached features.
+        probing_acc = cached_linear_probing(
             model=model,
+            train_loader=train_loader,
             device=device,
-            opt_probing=opt_probing,
-            loss_fn_classification=loss_fn_classification)
+            mode=config.probing_mode,
+            in_channels=config.in_channels,
+            num_epochs=config.probing_epoch,
+            learning_rate=float(config.learning_rate_probing),
+            batch_size=config.batch_size)
+    else:
+        # Note: Need to create another optimizer because the model will keep updating
+        # even after freezing with `requires_grad = False` when `opt` has `momentum`.
+        opt_probing = torch.optim.AdamW(list(model.linear.parameters()),
+                                        lr=float(config.learning_rate_probing))
+
+        lr_scheduler_probing = LinearWarmupCosineAnnealingLR(
+            optimizer=opt_probing,
+            warmup_epochs=min(10, config.probing_epoch // 5),
+            max_epochs=config.probing_epoch)
+
+        for _ in tqdm(range(config.probing_epoch)):
+            # Because of linear warmup, first step has zero LR. Hence step once before training.
+            lr_scheduler_probing.step()
+            probing_acc = linear_probing_epoch(
+                config=config,
+                train_loader=train_loader,
+                model=model,
+                device=device,
+                opt_probing=opt_probing,
+                loss_fn_classification=loss_fn_classification)
 
     _, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, dsmi_blockZ_Xs, dsmi_blockZ_Ys, _ = validate_epoch(
         config=config,
@@ -944,7 +1091,8 @@ def linear_probing(config: AttributeHashmap,
         model=model,
         device=device,
         loss_fn_classification=loss_fn_classification,
-        precomputed_clusters_X=precomputed_clusters_X)
+        precomputed_clusters_X=precomputed_clusters_X,
+        reference_cache=reference_cache)
 
     return probing_acc, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X
 
@@ -1007,6 +1155,91 @@ if __name__ == '__main__':
         '--block-by-block',
         action='store_true',
         help='If turned on, we compute the block-by-block DSE/DSMI.')
+    parser.add_argument(
+        '--block-sketch',
+        help='How to compress the block activations for block-by-block DSE/DSMI: '
+        '[none, pool, jl]. `jl` is a sparse Johnson-Lindenstrauss projection.',
+        type=str,
+        default='none')
+    parser.add_argument(
+        '--block-sketch-dim',
+        help='Feature dimension of the compressed block activations.',
+        type=int,
+        default=2048)
+    parser.add_argument(
+        '--bf16',
+        action='store_true',
+        help='If turned on, the training forward pass runs under bf16 autocast (CPU or GPU).')
+    parser.add_argument(
+        '--channels-last',
+        action='store_true',
+        help='If turned on, the model and the inputs use channels_last memory format.')
+    parser.add_argument(
+        '--compile',
+        action='store_true',
+        help='If turned on, the model and the losses are compiled with `torch.compile`.')
+    parser.add_argument(
+        '--grad-accum-steps',
+        help='Number of batches to accumulate the gradients over per optimizer step.',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--throughput-log-interval',
+        help='If provided, log the training throughput (images/s) every this many steps.',
+        type=int,
+        default=None)
+    parser.add_argument(
+        '--dataset-cache',
+        action='store_true',
+        help='If turned on, each split is decoded and resized once into a '
+        'memory-mapped uint8 array, and augmented as tensors afterwards.')
+    parser.add_argument(
+        '--dataset-cache-dir',
+        help='Where to store the dataset cache. Defaults to `$dataset_dir/dataset_cache/`.',
+        type=str,
+        default=None)
+    parser.add_argument(
+        '--reference-cache',
+        action='store_true',
+        help='If turned on, the downsampled val inputs (X), labels (Y) and '
+        'clusters of X are built once and reused from disk.')
+    parser.add_argument(
+        '--reference-cache-dir',
+        help='Where to store the reference cache. Defaults to `$dataset_dir/reference_cache/`.',
+        type=str,
+        default=None)
+    parser.add_argument(
+        '--probing-mode',
+        help='Linear probing for SimCLR: [online, cached-sgd, cached-lbfgs]. '
+        'The cached modes run the frozen encoder over the train set once per probe.',
+        type=str,
+        default='online')
+    parser.add_argument(
+        '--vectorized-ntxent',
+        action='store_true',
+        help='If turned on, SimCLR uses the standard 2B x 2B NT-Xent loss computed on device.')
+    parser.add_argument(
+        '--batched-augmentation',
+        action='store_true',
+        help='If turned on, the SimCLR views are generated per batch with vectorized tensor ops. '
+        'Requires `--dataset-cache`.')
+    parser.add_argument(
+        '--checkpoint-keep-last',
+        help='If provided, only keep this many of the most recent per-epoch checkpoints.',
+        type=int,
+        default=None)
+    parser.add_argument(
+        '--train-reservoir-size',
+        help='If provided, keep a class-stratified reservoir of this many train embeddings '
+        'from the training forward passes, and compute DSE/DSMI on it at each epoch end.',
+        type=int,
+        default=None)
+    parser.add_argument(
+        '--plot-interval',
+        help='If provided, the figures are rendered by a separate process, '
+        'at most once every this many seconds, instead of every epoch.',
+        type=float,
+        default=None)
     parser.add_argument('--gpu-id',
                         help='Available GPU index.',
                         type=int,
@@ -1022,12 +1255,33 @@ if __name__ == '__main__':
     config = AttributeHashmap(yaml.safe_load(open(args.config)))
     config.config_file_name = args.config
     config.gpu_id = args.gpu_id
+    config.plot_interval = args.plot_interval
+    config.train_reservoir_size = args.train_reservoir_size
+    config.checkpoint_keep_last = args.checkpoint_keep_last
+    config.batched_augmentation = args.batched_augmentation
+    config.vectorized_ntxent = args.vectorized_ntxent
+    config.probing_mode = args.probing_mode
+    config.dataset_cache = args.dataset_cache
+    config.dataset_cache_dir = args.dataset_cache_dir
+    config.bf16 = args.bf16
+    config.channels_last = args.channels_last
+    config.compile = args.compile
+    config.grad_accum_steps = args.grad_accum_steps
+    config.throughput_log_interval = args.throughput_log_interval
     config.model = args.model
     config.block_by_block = args.block_by_block
+    config.block_sketch = args.block_sketch
+    config.block_sketch_dim = args.block_sketch_dim
+    config.reference_cache = args.reference_cache
+    config.reference_cache_dir = args.reference_cache_dir
     config.conv_init_std = args.conv_init_std
     if args.random_seed is not None:
         config.random_seed = args.random_seed
     config = update_config_dirs(AttributeHashmap(config))
+    if config.dataset_cache_dir is None:
+        config.dataset_cache_dir = '%s/dataset_cache/' % config.dataset_dir
+    if config.reference_cache_dir is None:
+        config.reference_cache_dir = '%s/reference_cache/' % config.dataset_dir
 
     # Update checkpoint dir.
     config.checkpoint_dir = '%s/%s-%s-%s-ConvInitStd-%s-seed%s/' % (
@@ -1,6 +1,14 @@
+import os
+import sys
+from typing import List
+
 import timm
 import torch
 
+import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-4])
+sys.path.insert(0, import_dir + '/src/nn/')
+from latent_access import encode_with_block_outputs
+
 
 def build_timm_model(model_name: str,
                      num_classes: int,
@@ -99,6 +107,10 @@ class SimCLRModel(torch.nn.Module):
     def forward(self, x):
         return self.linear(self.encoder(x))
 
+    def forward_with_latent(self, x, blocks: List[torch.nn.Module] = None):
+        h, block_outputs = encode_with_block_outputs(self.encoder, x, blocks)
+        return self.linear(h), h, block_outputs
+
     def init_linear(self):
         torch.nn.init.constant_(self.linear.weight, 0.01)
         torch.nn.init.constant_(self.linear.bias, 0)
@@ -1,9 +1,8 @@
 import argparse
 import os
 import sys
-from typing import Tuple, Dict, Iterable
+from typing import Tuple, Dict, Iterable, List
 from matplotlib import pyplot as plt
-from scipy.stats import pearsonr, spearmanr
 
 import numpy as np
 import torch
@@ -19,12 +18,23 @@ from dsmi import diffusion_spectral_mutual_information
 
 sys.path.insert(0, import_dir + '/src/nn/')
 sys.path.insert(0, import_dir + '/src/utils/')
+from activation_sketch import ActivationSketch
+from async_metrics import AsyncMetricsWorker
 from attribute_hashmap import AttributeHashmap
+from checkpoint_writer import CheckpointWriter
+from dataset_cache import cache_dataset
+from linear_probe import cached_linear_probing
 from log_utils import log
+from metrics_sink import MetricsSink, PlottingProcess, format_correlations
+from metric_scheduler import DriftMetricScheduler, collect_probe_inputs, encode_probe
+from reference_cache import ReferenceCache
 from path_utils import update_config_dirs
+from reservoir import ReservoirMetrics, StratifiedReservoir
 from seed import seed_everything
-from simclr import NTXentLoss, SingleInstanceTwoView
+from simclr import NTXentLoss, VectorizedNTXentLoss, SingleInstanceTwoView, \
+    BatchedTwoView, BatchedTwoViewCollate
 from scheduler import LinearWarmupCosineAnnealingLR
+from train_engine import TrainEngine
 from timm_models import build_timm_model
 from extend import ExtendedDataset
 
@@ -219,11 +229,38 @@ def get_dataloaders(
                                           split='val',
                                           transform=transform_val)
 
+    # Two-view generation on whole uint8 batches, in the `collate_fn`.
+    batched_augmentation = config.method == 'simclr' and config.batched_augmentation
+    train_collate_fn = None
+    if batched_augmentation:
+        assert config.dataset_cache, \
+            '`--batched-augmentation` requires `--dataset-cache`.'
+        train_collate_fn = BatchedTwoViewCollate(
+            BatchedTwoView(imsize=imsize, mean=dataset_mean, std=dataset_std))
+
+    if config.dataset_cache:
+        # Decode and resize each split only once.
+        # The random augmentations then run on the cached uint8 tensors.
+        train_dataset = cache_dataset(train_dataset,
+                                      cache_dir=config.dataset_cache_dir,
+                                      name='%s-train' % config.dataset,
+                                      dataset_dir=config.dataset_dir,
+                                      imsize=imsize,
+                                      num_workers=config.num_workers,
+                                      keep_transform=not batched_augmentation)
+        val_dataset = cache_dataset(val_dataset,
+                                    cache_dir=config.dataset_cache_dir,
+                                    name='%s-val' % config.dataset,
+                                    dataset_dir=config.dataset_dir,
+                                    imsize=imsize,
+                                    num_workers=config.num_workers)
+
     train_loader = torch.utils.data.DataLoader(train_dataset,
                                                batch_size=config.batch_size,
                                                num_workers=config.num_workers,
                                                shuffle=True,
-                                               pin_memory=True)
+                                               pin_memory=True,
+                                               collate_fn=train_collate_fn)
     val_loader = torch.utils.data.DataLoader(val_dataset,
                                              batch_size=config.batch_size,
                                              num_workers=config.num_workers,
@@ -255,6 +292,13 @@ def get_dataloaders(
             ]))
         val_dataset = ExtendedDataset(val_dataset,
                                       desired_len=10 * len(val_dataset))
+        if config.dataset_cache:
+            val_dataset = cache_dataset(val_dataset,
+                                        cache_dir=config.dataset_cache_dir,
+                                        name='%s-val' % config.dataset,
+                                        dataset_dir=config.dataset_dir,
+                                        imsize=imsize,
+                                        num_workers=config.num_workers)
         val_loader = torch.utils.data.DataLoader(
             val_dataset,
             batch_size=config.batch_size,
@@ -315,18 +359,11 @@ def plot_figures(data_arrays: Dict[str, Iterable], save_path_fig: str,
 
     # Display correlation.
     if len(data_arrays['val_acc']) > 1:
-        ax.set_title(
-            'CSE(Z), P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
-            (pearsonr(data_arrays['val_acc'], data_arrays['cse_Z'])[0],
-             pearsonr(data_arrays['val_acc'], data_arrays['cse_Z'])[1],
-             spearmanr(data_arrays['val_acc'], data_arrays['cse_Z'])[0],
-             spearmanr(data_arrays['val_acc'], data_arrays['cse_Z'])[1]) +
-            'DSE(Z), P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
-            (pearsonr(data_arrays['val_acc'], data_arrays['dse_Z'])[0],
-             pearsonr(data_arrays['val_acc'], data_arrays['dse_Z'])[1],
-             spearmanr(data_arrays['val_acc'], data_arrays['dse_Z'])[0],
-             spearmanr(data_arrays['val_acc'], data_arrays['dse_Z'])[1]),
-            fontsize=30)
+        ax.set_title(format_correlations(data_arrays['val_acc'], {
+            'CSE(Z)': data_arrays['cse_Z'],
+            'DSE(Z)': data_arrays['dse_Z'],
+        }),
+                     fontsize=30)
 
     # Plot of Mutual Information vs. epoch.
     ax = fig.add_subplot(3, 2, 5)
@@ -390,28 +427,13 @@ def plot_figures(data_arrays: Dict[str, Iterable], save_path_fig: str,
 
     # # Display correlation.
     if len(data_arrays['val_acc']) > 1:
-        ax.set_title(
-            'CSMI(Z; Y), P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
-            (pearsonr(data_arrays['val_acc'], data_arrays['csmi_Z_Y'])[0],
-             pearsonr(data_arrays['val_acc'], data_arrays['csmi_Z_Y'])[1],
-             spearmanr(data_arrays['val_acc'], data_arrays['csmi_Z_Y'])[0],
-             spearmanr(data_arrays['val_acc'], data_arrays['csmi_Z_Y'])[1]) +
-            'DSMI(Z; Y), P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
-            (pearsonr(data_arrays['val_acc'], data_arrays['dsmi_Z_Y'])[0],
-             pearsonr(data_arrays['val_acc'], data_arrays['dsmi_Z_Y'])[1],
-             spearmanr(data_arrays['val_acc'], data_arrays['dsmi_Z_Y'])[0],
-             spearmanr(data_arrays['val_acc'], data_arrays['dsmi_Z_Y'])[1]) +
-            'CSMI(Z; X), P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
-            (pearsonr(data_arrays['val_acc'], data_arrays['csmi_Z_X'])[0],
-             pearsonr(data_arrays['val_acc'], data_arrays['csmi_Z_X'])[1],
-             spearmanr(data_arrays['val_acc'], data_arrays['csmi_Z_X'])[0],
-             spearmanr(data_arrays['val_acc'], data_arrays['csmi_Z_X'])[1]) +
-            'DSMI(Z; X), P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
-            (pearsonr(data_arrays['val_acc'], data_arrays['dsmi_Z_X'])[0],
-             pearsonr(data_arrays['val_acc'], data_arrays['dsmi_Z_X'])[1],
-             spearmanr(data_arrays['val_acc'], data_arrays['dsmi_Z_X'])[0],
-             spearmanr(data_arrays['val_acc'], data_arrays['dsmi_Z_X'])[1]),
-            fontsize=30)
+        ax.set_title(format_correlations(data_arrays['val_acc'], {
+            'CSMI(Z; Y)': data_arrays['csmi_Z_Y'],
+            'DSMI(Z; Y)': data_arrays['dsmi_Z_Y'],
+            'CSMI(Z; X)': data_arrays['csmi_Z_X'],
+            'DSMI(Z; X)': data_arrays['dsmi_Z_X'],
+        }),
+                     fontsize=30)
     fig.tight_layout()
     fig.savefig(save_path_fig)
     plt.close(fig=fig)
@@ -482,7 +504,10 @@ def train(config: AttributeHashmap) -> None:
     model.init_params()
 
     loss_fn_classification = torch.nn.CrossEntropyLoss()
-    loss_fn_simclr = NTXentLoss()
+    if config.vectorized_ntxent:
+        loss_fn_simclr = VectorizedNTXentLoss()
+    else:
+        loss_fn_simclr = NTXentLoss()
 
     # `val_metric` is val acc for good training,
     # whereas train/val acc divergence for wrong label training.
@@ -491,6 +516,25 @@ def train(config: AttributeHashmap) -> None:
     else:
         val_metric = 'val_acc'
 
+    # The downsampled inputs (X), labels (Y) and clusters of X do not change
+    # across epochs. Reuse them from disk when the val loader is deterministic.
+    reference_cache, precomputed_clusters_X = None, None
+    if config.reference_cache:
+        if isinstance(val_loader.sampler,
+                      torch.utils.data.SequentialSampler):
+            reference_cache = ReferenceCache(
+                cache_dir=config.reference_cache_dir,
+                dataset_name=config.dataset,
+                dataset_dir=config.dataset_dir,
+                val_loader=val_loader,
+                in_channels=config.in_channels)
+            precomputed_clusters_X = reference_cache.clusters(
+                n_clusters=config.num_classes)
+        else:
+            log('Val loader is shuffled. Reference cache not used.',
+                filepath=log_path,
+                to_console=True)
+
     # Compute the results before training.
     val_loss, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, \
         dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X = validate_epoch(
@@ -499,7 +543,8 @@ def train(config: AttributeHashmap) -> None:
         model=model,
         device=device,
         loss_fn_classification=loss_fn_classification,
-        precomputed_clusters_X=None)
+        precomputed_clusters_X=precomputed_clusters_X,
+        reference_cache=reference_cache)
 
     state_dict = {
         'train_loss': 'Not started',
@@ -523,8 +568,49 @@ def train(config: AttributeHashmap) -> None:
         'val_acc': [0],
         'dsmi_blockZ_Xs': [np.array(dsmi_blockZ_Xs)],
         'dsmi_blockZ_Ys': [np.array(dsmi_blockZ_Ys)],
+        'metrics_computed': [True],
     }
 
+    # The metrics of epoch 0 are computed synchronously above,
+    # such that `precomputed_clusters_X` is available for the later epochs.
+    metrics_worker = None
+    if config.async_metrics:
+        metrics_worker = AsyncMetricsWorker(
+            num_workers=config.async_metrics_workers,
+            max_pending=config.async_metrics_max_pending)
+        if reference_cache is not None:
+            # The same for every epoch: copied into shared memory once.
+            metrics_worker.share(arrays={
+                'tensor_X': reference_cache.X,
+                'tensor_Y': reference_cache.Y,
+            })
+    # Val. metric of the epochs whose DSE/DSMI are still being computed.
+    pending_val_metric = {}
+
+    # Only compute DSE/DSMI when the representation has drifted enough.
+    metric_scheduler = None
+    # Val. metric of the epochs whose DSE/DSMI were skipped, waiting to be interpolated.
+    skipped_val_metric = {}
+    if config.metric_drift_threshold is not None:
+        metric_scheduler = DriftMetricScheduler(
+            threshold=config.metric_drift_threshold,
+            max_interval=config.metric_max_interval,
+            measure=config.metric_drift_measure)
+        probe_x = collect_probe_inputs(val_loader=val_loader,
+                                       probe_size=config.metric_probe_size)
+        # Epoch 0 is the first reference.
+        metric_scheduler.step(epoch_idx=0,
+                              probe_Z=encode_probe(
+                                  model=model,
+                                  probe_x=probe_x,
+                                  device=device,
+                                  in_channels=config.in_channels,
+                                  batch_size=config.batch_size))
+        # The last validated epoch is always computed, so that every skipped epoch can be interpolated.
+        last_val_epoch = config.max_epoch - 1
+        if config.method == 'simclr':
+            last_val_epoch = last_val_epoch // 5 * 5
+
     if config.method in ['supervised', 'wronglabel']:
         opt = torch.optim.AdamW(list(model.encoder.parameters()) +
                                 list(model.linear.parameters()),
@@ -540,8 +626,47 @@ def train(config: AttributeHashmap) -> None:
                                                      config.max_epoch // 5),
                                                  max_epochs=config.max_epoch)
 
+    engine = TrainEngine(model=model,
+                         opt=opt,
+                         device=device,
+                         bf16=config.bf16,
+                         channels_last=config.channels_last,
+                         compile=config.compile,
+                         grad_accum_steps=config.grad_accum_steps,
+                         log_interval=config.throughput_log_interval,
+                         log_fn=lambda s: log(
+                             s, filepath=log_path, to_console=False))
+    loss_fn_classification = engine.compile_loss(loss_fn_classification)
+    loss_fn_simclr = engine.compile_loss(loss_fn_simclr)
+
+    # Class-stratified sample of the train embeddings from the training forward passes,
+    # for train-side DSE/DSMI at no extra forward cost.
+    train_reservoir, train_reservoir_metrics = None, None
+    if config.train_reservoir_size is not None:
+        train_reservoir = StratifiedReservoir(
+            num_classes=config.num_classes,
+            per_class=max(1, config.train_reservoir_size // config.num_classes),
+            seed=config.random_seed)
+        train_reservoir_metrics = ReservoirMetrics(
+            train_reservoir,
+            dse_fn=diffusion_spectral_entropy,
+            dsmi_fn=diffusion_spectral_mutual_information)
+
+    # Append-only log of the per-epoch metrics. If `plot_interval` is set,
+    # the figures are rendered from it by a separate, throttled process.
+    metrics_sink = MetricsSink(log_dir='%s-metrics-log/' % save_path_fig)
+    plotter = None
+    if config.plot_interval is not None:
+        plotter = PlottingProcess(plot_fn=plot_figures,
+                                  log_dir=metrics_sink.log_dir,
+                                  min_interval=config.plot_interval,
+                                  save_path_fig=save_path_fig,
+                                  block_by_block=config.block_by_block)
+
     best_val_metric = 0
     best_model = None
+    # Checkpoints are written in the background.
+    checkpoint_writer = CheckpointWriter()
 
     val_metric_pct_list = [20, 30, 40, 50, 60, 70, 80, 90]
     is_model_saved = {}
@@ -570,6 +695,7 @@ def train(config: AttributeHashmap) -> None:
         model.train()
         # Because of linear warmup, first step has zero LR. Hence step once before training.
         lr_scheduler.step()
+        engine.start_epoch()
         correct, total_count_loss, total_count_acc = 0, 0, 0
         for _, (x, y_true) in enumerate(tqdm(train_loader)):
             if config.method in ['supervised', 'wronglabel']:
@@ -580,9 +706,14 @@ def train(config: AttributeHashmap) -> None:
                 if config.in_channels == 1:
                     # Repeat the channel dimension: 1 channel -> 3 channels.
                     x = x.repeat(1, 3, 1, 1)
-                x, y_true = x.to(device), y_true.to(device)
-
-                y_pred = model(x)
+                x, y_true = engine.to_device(x), y_true.to(device)
+
+                with engine.autocast():
+                    y_pred, z, _ = model.forward_with_latent(x)
+                if train_reservoir is not None:
+                    train_reservoir.add(z.detach(), y_true)
+                # Loss in float32, outside of autocast.
+                y_pred = y_pred.float()
                 loss = loss_fn_classification(y_pred, y_true)
                 state_dict['train_loss'] += loss.item() * B
                 correct += torch.sum(
@@ -590,9 +721,7 @@ def train(config: AttributeHashmap) -> None:
                 total_count_loss += B
                 total_count_acc += B
 
-                opt.zero_grad()
-                loss.backward()
-                opt.step()
+                engine.step(loss, batch_size=B)
 
             elif config.method == 'simclr':
                 # Using SimCLR.
@@ -604,27 +733,52 @@ def train(config: AttributeHashmap) -> None:
                     # Repeat the channel dimension: 1 channel -> 3 channels.
                     x_aug1 = x_aug1.repeat(1, 3, 1, 1)
                     x_aug2 = x_aug2.repeat(1, 3, 1, 1)
-                x_aug1, x_aug2, y_true = x_aug1.to(device), x_aug2.to(
-                    device), y_true.to(device)
+                x_aug1, x_aug2, y_true = engine.to_device(
+                    x_aug1), engine.to_device(x_aug2), y_true.to(device)
 
                 # Train encoder.
-                z1 = model.project(x_aug1)
-                z2 = model.project(x_aug2)
+                with engine.autocast():
+                    h1 = model.encode(x_aug1)
+                    z1 = model.projection_head(h1)
+                    z2 = model.project(x_aug2)
+                if train_reservoir is not None:
+                    train_reservoir.add(h1.detach(), y_true)
+                # Loss in float32, outside of autocast.
+                z1, z2 = z1.float(), z2.float()
 
                 loss, pseudo_acc = loss_fn_simclr(z1, z2)
-                state_dict['train_loss'] += loss.item() * B
+                # Accumulated on device. Synced once per epoch below.
+                state_dict['train_loss'] += loss.detach() * B
                 state_dict['train_simclr_pseudoAcc'] += pseudo_acc * B
                 total_count_loss += B
 
-                opt.zero_grad()
-                loss.backward()
-                opt.step()
+                engine.step(loss, batch_size=B)
 
+        state_dict['train_images_per_sec'] = engine.end_epoch()
         if config.method == 'simclr':
-            state_dict['train_simclr_pseudoAcc'] /= total_count_loss
+            state_dict['train_simclr_pseudoAcc'] = float(
+                state_dict['train_simclr_pseudoAcc']) / total_count_loss
         else:
             state_dict['train_acc'] = correct / total_count_acc * 100
-        state_dict['train_loss'] /= total_count_loss
+        state_dict['train_loss'] = float(
+            state_dict['train_loss']) / total_count_loss
+
+        if train_reservoir_metrics is not None:
+            train_metrics = train_reservoir_metrics.end_epoch(epoch_idx)
+            state_dict['train_dse_Z'] = train_metrics['dse_Z']
+            state_dict['train_dsmi_Z_Y'] = train_metrics['dsmi_Z_Y']
+
+        compute_dse_dsmi = True
+        if metric_scheduler is not None and \
+            not (config.method == 'simclr' and skip_epoch_simlr):
+            compute_dse_dsmi, state_dict['repr_drift'] = metric_scheduler.step(
+                epoch_idx=epoch_idx,
+                probe_Z=encode_probe(model=model,
+                                     probe_x=probe_x,
+                                     device=device,
+                                     in_channels=config.in_channels,
+                                     batch_size=config.batch_size),
+                force=epoch_idx == last_val_epoch)
 
         #
         '''
@@ -641,7 +795,11 @@ def train(config: AttributeHashmap) -> None:
                     model=model,
                     device=device,
                     loss_fn_classification=loss_fn_classification,
-                    precomputed_clusters_X=precomputed_clusters_X)
+                    precomputed_clusters_X=precomputed_clusters_X,
+                    reference_cache=reference_cache,
+                    metrics_worker=metrics_worker,
+                    epoch_idx=epoch_idx,
+                    compute_dse_dsmi=compute_dse_dsmi)
                 state_dict['train_acc'] = probing_acc
                 state_dict['val_loss'] = np.nan
                 state_dict['val_acc'] = val_acc_final
@@ -657,7 +815,11 @@ def train(config: AttributeHashmap) -> None:
                 model=model,
                 device=device,
                 loss_fn_classification=loss_fn_classification,
-                precomputed_clusters_X=precomputed_clusters_X)
+                precomputed_clusters_X=precomputed_clusters_X,
+                reference_cache=reference_cache,
+                metrics_worker=metrics_worker,
+                epoch_idx=epoch_idx,
+                compute_dse_dsmi=compute_dse_dsmi)
             state_dict['val_loss'] = val_loss
             state_dict['val_acc'] = val_acc
 
@@ -672,20 +834,34 @@ def train(config: AttributeHashmap) -> None:
             to_console=False)
 
         if not (config.method == 'simclr' and skip_epoch_simlr):
-            results_dict['epoch'].append(epoch_idx)
-            results_dict['dse_Z'].append(dse_Z)
-            results_dict['cse_Z'].append(cse_Z)
-            results_dict['dsmi_Z_X'].append(dsmi_Z_X)
-            results_dict['csmi_Z_X'].append(csmi_Z_X)
-            results_dict['dsmi_Z_Y'].append(dsmi_Z_Y)
-            results_dict['csmi_Z_Y'].append(csmi_Z_Y)
-            results_dict['val_acc'].append(state_dict['val_acc'])
-            results_dict['dsmi_blockZ_Xs'].append(np.array(dsmi_blockZ_Xs))
-            results_dict['dsmi_blockZ_Ys'].append(np.array(dsmi_blockZ_Ys))
-
-        plot_figures(data_arrays=results_dict,
-                     save_path_fig=save_path_fig,
-                     block_by_block=config.block_by_block)
+            if not compute_dse_dsmi:
+                skipped_val_metric[epoch_idx] = state_dict['val_acc']
+            elif metrics_worker is None:
+                update_results(results_dict=results_dict,
+                               epoch_idx=epoch_idx,
+                               val_acc=state_dict['val_acc'],
+                               metrics=(dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X,
+                                        dsmi_Z_Y, csmi_Z_Y, dsmi_blockZ_Xs,
+                                        dsmi_blockZ_Ys),
+                               skipped_val_metric=skipped_val_metric)
+            else:
+                pending_val_metric[epoch_idx] = state_dict['val_acc']
+
+        if metrics_worker is not None:
+            # Write back whatever has finished, in epoch order.
+            for finished_epoch_idx, metrics in metrics_worker.collect():
+                update_results(
+                    results_dict=results_dict,
+                    epoch_idx=finished_epoch_idx,
+                    val_acc=pending_val_metric.pop(finished_epoch_idx),
+                    metrics=metrics[:-1],
+                    skipped_val_metric=skipped_val_metric)
+
+        metrics_sink.sync(results_dict)
+        if plotter is None:
+            plot_figures(data_arrays=results_dict,
+                         save_path_fig=save_path_fig,
+                         block_by_block=config.block_by_block)
 
         # Save best model
         if not (config.method == 'simclr' and skip_epoch_simlr):
@@ -696,7 +872,8 @@ def train(config: AttributeHashmap) -> None:
                     config.checkpoint_dir, config.dataset, config.method,
                     config.model, config.random_seed,
                     '%s_best.pth' % val_metric)
-                torch.save(best_model, model_save_path)
+                checkpoint_writer.save(best_model, model_save_path)
+                best_model_save_path = model_save_path
                 log('Best model (so far) successfully saved.',
                     filepath=log_path,
                     to_console=False)
@@ -709,13 +886,35 @@ def train(config: AttributeHashmap) -> None:
                             config.checkpoint_dir, config.dataset,
                             config.method, config.model, config.random_seed,
                             '%s_%s%%.pth' % (val_metric, val_metric_pct))
-                        torch.save(best_model, model_save_path)
+                        # Same weights as the best model: hard link, no re-serialization.
+                        checkpoint_writer.link(best_model_save_path,
+                                               model_save_path)
                         is_model_saved[str(val_metric_pct)] = True
                         log('%s:%s%% model successfully saved.' %
                             (val_metric, val_metric_pct),
                             filepath=log_path,
                             to_console=False)
 
+    if metrics_worker is not None:
+        # Wait for the outstanding epochs.
+        for finished_epoch_idx, metrics in metrics_worker.collect(block=True):
+            update_results(results_dict=results_dict,
+                           epoch_idx=finished_epoch_idx,
+                           val_acc=pending_val_metric.pop(finished_epoch_idx),
+                           metrics=metrics[:-1],
+                           skipped_val_metric=skipped_val_metric)
+        metrics_worker.close()
+        metrics_sink.sync(results_dict)
+        if plotter is None:
+            plot_figures(data_arrays=results_dict,
+                         save_path_fig=save_path_fig,
+                         block_by_block=config.block_by_block)
+
+    checkpoint_writer.close()
+    if plotter is not None:
+        # Final render with the complete log.
+        plotter.close()
+
     # Save the results after training.
     save_path_numpy = '%s/%s-%s-%s-seed%s/%s' % (
         config.output_save_path, config.dataset, config.method, config.model,
@@ -733,8 +932,14 @@ def train(config: AttributeHashmap) -> None:
             csmi_Z_X=np.array(results_dict['csmi_Z_X']),
             dsmi_Z_Y=np.array(results_dict['dsmi_Z_Y']),
             csmi_Z_Y=np.array(results_dict['csmi_Z_Y']),
+            metrics_computed=np.array(results_dict['metrics_computed']),
         )
 
+    if train_reservoir_metrics is not None:
+        # Train-side metrics, from the reservoir of train embeddings.
+        train_reservoir_metrics.save(
+            os.path.join(os.path.dirname(save_path_numpy), 'train-results.npz'))
+
     # Save block by block DSMI results
     save_path_numpy = '%s/%s-%s-%s-seed%s/%s' % (
         config.output_save_path, config.dataset, config.method, config.model,
@@ -752,6 +957,50 @@ def train(config: AttributeHashmap) -> None:
     return
 
 
+def update_results(results_dict: Dict[str, list],
+                   epoch_idx: int,
+                   val_acc: float,
+                   metrics: Tuple,
+                   skipped_val_metric: Dict[int, float] = None) -> None:
+    '''
+    Append the metrics of `epoch_idx`.
+
+    Epochs before `epoch_idx` whose metrics were skipped by the drift-triggered scheduler
+    (`skipped_val_metric`: epoch -> val metric) are appended first, with metrics linearly
+    interpolated between the previous computed epoch and `epoch_idx`,
+    and marked by `metrics_computed = False`.
+    '''
+    metric_keys = [
+        'dse_Z', 'cse_Z', 'dsmi_Z_X', 'csmi_Z_X', 'dsmi_Z_Y', 'csmi_Z_Y',
+        'dsmi_blockZ_Xs', 'dsmi_blockZ_Ys'
+    ]
+    metrics = list(metrics)
+    metrics[-2:] = [np.array(metrics[-2]), np.array(metrics[-1])]
+
+    if skipped_val_metric:
+        prev_epoch_idx = results_dict['epoch'][-1]
+        prev_metrics = [results_dict[key][-1] for key in metric_keys]
+        for skipped_epoch_idx in sorted(skipped_val_metric.keys()):
+            if skipped_epoch_idx > epoch_idx:
+                break
+            w = (skipped_epoch_idx - prev_epoch_idx) / (epoch_idx -
+                                                         prev_epoch_idx)
+            results_dict['epoch'].append(skipped_epoch_idx)
+            results_dict['val_acc'].append(
+                skipped_val_metric.pop(skipped_epoch_idx))
+            results_dict['metrics_computed'].append(False)
+            for key, prev_value, value in zip(metric_keys, prev_metrics,
+                                              metrics):
+                results_dict[key].append((1 - w) * prev_value + w * value)
+
+    results_dict['epoch'].append(epoch_idx)
+    results_dict['val_acc'].append(val_acc)
+    results_dict['metrics_computed'].append(True)
+    for key, value in zip(metric_keys, metrics):
+        results_dict[key].append(value)
+    return
+
+
 timm_model_blocks_map = {
     'resnet': ['layer1', 'layer2', 'layer3', 'layer4'],
     'resnext': ['layer1', 'layer2', 'layer3', 'layer4'],
@@ -766,7 +1015,20 @@ def validate_epoch(config: AttributeHashmap,
                    val_loader: torch.utils.data.DataLoader,
                    model: torch.nn.Module, device: torch.device,
                    loss_fn_classification: torch.nn.Module,
-                   precomputed_clusters_X: np.array):
+                   precomputed_clusters_X: np.array,
+                   reference_cache: ReferenceCache = None,
+                   metrics_worker: AsyncMetricsWorker = None,
+                   epoch_idx: int = None,
+                   compute_dse_dsmi: bool = True):
+    '''
+    If `compute_dse_dsmi` is False, only the val loss and accuracy are computed.
+
+    If `reference_cache` is provided, X and Y are read from the cache
+    and only the latent vectors (Z) are collected here.
+
+    If `metrics_worker` is provided, the DSE/DSMI metrics are computed asynchronously
+    and returned as None here. They will be available via `metrics_worker.collect()`.
+    '''
 
     correct, total_count_loss, total_count_acc = 0, 0, 0
     val_loss, val_acc = 0, 0
@@ -778,11 +1040,17 @@ def validate_epoch(config: AttributeHashmap,
     if config.block_by_block:
         '''Get block by block activations'''
         activation = {}
+        # Compress the activations inside the hook, before they leave the device.
+        # See `ActivationSketch` for the distance distortion of each mode.
+        sketch = ActivationSketch(mode=config.block_sketch,
+                                  dim=config.block_sketch_dim,
+                                  seed=config.random_seed,
+                                  channels_last=config.model == 'swin')
 
         def getActivation(name):
 
             def hook(model, input, output):
-                activation[name] = output.detach()
+                activation[name] = sketch(output.detach())
 
             return hook
 
@@ -820,7 +1088,9 @@ def validate_epoch(config: AttributeHashmap,
                 x = x.repeat(1, 3, 1, 1)
             x, y_true = x.to(device), y_true.to(device)
 
-            y_pred = model(x)
+            # One forward pass for both the logits and the latent embedding.
+            y_pred, curr_Z, _ = model.forward_with_latent(x)
+            curr_Z = curr_Z.cpu().numpy()
             loss = loss_fn_classification(y_pred, y_true)
             val_loss += loss.item() * B
             correct += torch.sum(torch.argmax(y_pred, dim=-1) == y_true).item()
@@ -829,26 +1099,27 @@ def validate_epoch(config: AttributeHashmap,
                 total_count_loss += B
 
             ## Record data for DSE and DSMI computation.
-
-            # Downsample the input image to reduce memory usage.
-            curr_X = torch.nn.functional.interpolate(
-                x, size=(64, 64)).cpu().numpy().reshape(x.shape[0], -1)
-            curr_Y = y_true.cpu().numpy()
-            curr_Z = model.encode(x).cpu().numpy()
-            if tensor_X is None:
-                tensor_X, tensor_Y, tensor_Z = curr_X, curr_Y, curr_Z
+            if tensor_Z is None:
+                tensor_Z = curr_Z
             else:
-                tensor_X = np.vstack((tensor_X, curr_X))
-                tensor_Y = np.hstack((tensor_Y, curr_Y))
                 tensor_Z = np.vstack((tensor_Z, curr_Z))
 
+            if reference_cache is None:
+                # Downsample the input image to reduce memory usage.
+                curr_X = torch.nn.functional.interpolate(
+                    x, size=(64, 64)).cpu().numpy().reshape(x.shape[0], -1)
+                curr_Y = y_true.cpu().numpy()
+                if tensor_X is None:
+                    tensor_X, tensor_Y = curr_X, curr_Y
+                else:
+                    tensor_X = np.vstack((tensor_X, curr_X))
+                    tensor_Y = np.hstack((tensor_Y, curr_Y))
+
             if config.block_by_block:
                 # Collect block activations from key layers
                 for i in block_index_list:
                     curr_block_features = activation['blocks_' +
                                                      str(i)].cpu().numpy()
-                    curr_block_features = curr_block_features.reshape(
-                        curr_block_features.shape[0], -1)
                     blocks_features[i].append(curr_block_features)  # (B, D)
 
     if config.block_by_block:
@@ -856,7 +1127,67 @@ def validate_epoch(config: AttributeHashmap,
             blocks_features[i] = np.vstack(blocks_features[i])
             handlers_list[i].remove()
 
-    if config.dataset == 'tinyimagenet':
+    if reference_cache is not None:
+        tensor_X, tensor_Y = reference_cache.X, reference_cache.Y
+        assert tensor_X.shape[0] == tensor_Z.shape[0]
+
+    if config.method == 'simclr':
+        val_loss = torch.nan
+    else:
+        val_loss /= total_count_loss
+    val_acc = correct / total_count_acc * 100
+
+    if not config.block_by_block:
+        blocks_features = []
+
+    if not compute_dse_dsmi:
+        # Skipped by the drift-triggered metric scheduler.
+        return (val_loss, val_acc, None, None, None, None, None, None, None,
+                None, precomputed_clusters_X)
+
+    if metrics_worker is not None:
+        # Hand the collected data off to the background worker and return immediately.
+        # The metrics will be retrieved from `metrics_worker.collect()` later.
+        arrays = {'tensor_Z': tensor_Z, 'blocks_features': blocks_features}
+        if reference_cache is None:
+            # Otherwise X and Y were shared once for the run.
+            arrays.update({'tensor_X': tensor_X, 'tensor_Y': tensor_Y})
+        metrics_worker.submit(key=epoch_idx,
+                              fn=compute_metrics,
+                              arrays=arrays,
+                              dataset=config.dataset,
+                              num_classes=config.num_classes,
+                              precomputed_clusters_X=precomputed_clusters_X)
+        return (val_loss, val_acc, None, None, None, None, None, None, None,
+                None, precomputed_clusters_X)
+
+    dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, dsmi_blockZ_Xs, \
+        dsmi_blockZ_Ys, precomputed_clusters_X = compute_metrics(
+        tensor_X=tensor_X,
+        tensor_Y=tensor_Y,
+        tensor_Z=tensor_Z,
+        blocks_features=blocks_features,
+        dataset=config.dataset,
+        num_classes=config.num_classes,
+        precomputed_clusters_X=precomputed_clusters_X)
+
+    return (val_loss, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y,
+            csmi_Z_Y, dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X)
+
+
+def compute_metrics(tensor_X: np.array, tensor_Y: np.array,
+                    tensor_Z: np.array, blocks_features: List[np.array],
+                    dataset: str, num_classes: int,
+                    precomputed_clusters_X: np.array):
+    '''
+    Compute the DSE/DSMI (and CSE/CSMI) metrics from the collected
+    inputs (X), labels (Y), latents (Z) and block activations.
+
+    Kept separate from `validate_epoch` such that it can run in a
+    background process (see `AsyncMetricsWorker`).
+    '''
+
+    if dataset == 'tinyimagenet':
         # For DSE, subsample for faster computation.
         dse_Z = diffusion_spectral_entropy(
             embedding_vectors=tensor_Z[:10000, :])
@@ -871,12 +1202,12 @@ def validate_epoch(config: AttributeHashmap,
     dsmi_Z_X, precomputed_clusters_X = diffusion_spectral_mutual_information(
         embedding_vectors=tensor_Z,
         reference_vectors=tensor_X,
-        n_clusters=config.num_classes,
+        n_clusters=num_classes,
         precomputed_clusters=precomputed_clusters_X)
     csmi_Z_X, precomputed_clusters_X = diffusion_spectral_mutual_information(
         embedding_vectors=tensor_Z,
         reference_vectors=tensor_X,
-        n_clusters=config.num_classes,
+        n_clusters=num_classes,
         precomputed_clusters=precomputed_clusters_X,
         classic_shannon_entropy=True)
 
@@ -888,27 +1219,19 @@ def validate_epoch(config: AttributeHashmap,
         classic_shannon_entropy=True)
 
     dsmi_blockZ_Xs, dsmi_blockZ_Ys = [], []
-    if config.block_by_block:
-        for i in block_index_list:
-            tensor_blockZ = blocks_features[i]
-            dsmi_blockZ_X, _ = diffusion_spectral_mutual_information(
-                embedding_vectors=tensor_blockZ,
-                reference_vectors=tensor_X,
-                precomputed_clusters=precomputed_clusters_X,
-            )
-            dsmi_blockZ_Xs.append(dsmi_blockZ_X)
-            dsmi_blockZ_Y, _ = diffusion_spectral_mutual_information(
-                embedding_vectors=tensor_blockZ, reference_vectors=tensor_Y)
-            dsmi_blockZ_Ys.append(dsmi_blockZ_Y)
-
-    if config.method == 'simclr':
-        val_loss = torch.nan
-    else:
-        val_loss /= total_count_loss
-    val_acc = correct / total_count_acc * 100
+    for tensor_blockZ in blocks_features:
+        dsmi_blockZ_X, _ = diffusion_spectral_mutual_information(
+            embedding_vectors=tensor_blockZ,
+            reference_vectors=tensor_X,
+            precomputed_clusters=precomputed_clusters_X,
+        )
+        dsmi_blockZ_Xs.append(dsmi_blockZ_X)
+        dsmi_blockZ_Y, _ = diffusion_spectral_mutual_information(
+            embedding_vectors=tensor_blockZ, reference_vectors=tensor_Y)
+        dsmi_blockZ_Ys.append(dsmi_blockZ_Y)
 
-    return (val_loss, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y,
-            csmi_Z_Y, dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X)
+    return (dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y,
+            dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X)
 
 
 def linear_probing(config: AttributeHashmap,
@@ -916,30 +1239,48 @@ def linear_probing(config: AttributeHashmap,
                    val_loader: torch.utils.data.DataLoader,
                    model: torch.nn.Module, device: torch.device,
                    loss_fn_classification: torch.nn.Module,
-                   precomputed_clusters_X: np.array):
+                   precomputed_clusters_X: np.array,
+                   reference_cache: ReferenceCache = None,
+                   metrics_worker: AsyncMetricsWorker = None,
+                   epoch_idx: int = None,
+                   compute_dse_dsmi: bool = True):
 
     # Separately train linear classifier.
     model.init_linear()
-    # Note: Need to create another optimizer because the model will keep updating
-    # even after freezing with `requires_grad = False` when `opt` has `momentum`.
-    opt_probing = torch.optim.AdamW(list(model.linear.parameters()),
-                                    lr=float(config.learning_rate_probing))
-
-    lr_scheduler_probing = LinearWarmupCosineAnnealingLR(
-        optimizer=opt_probing,
-        warmup_epochs=min(10, config.probing_epoch // 5),
-        max_epochs=config.probing_epoch)
 
-    for _ in tqdm(range(config.probing_epoch)):
-        # Because of linear warmup, first step has zero LR. Hence step once before training.
-        lr_scheduler_probing.step()
-        probing_acc = linear_probing_epoch(
-            config=config,
-            train_loader=train_loader,
+    if config.probing_mode != 'online':
+        # The train set goes through the frozen encoder once per probe,
+        # and the linear classifier is trained on the cached features.
+        probing_acc = cached_linear_probing(
             model=model,
+            train_loader=train_loader,
             device=device,
-            opt_probing=opt_probing,
-            loss_fn_classification=loss_fn_classification)
+            mode=config.probing_mode,
+            in_channels=config.in_channels,
+            num_epochs=config.probing_epoch,
+            learning_rate=float(config.learning_rate_probing),
+            batch_size=config.batch_size)
+    else:
+        # Note: Need to create another optimizer because the model will keep updating
+        # even after freezing with `requires_grad = False` when `opt` has `momentum`.
+        opt_probing = torch.optim.AdamW(list(model.linear.parameters()),
+                                        lr=float(config.learning_rate_probing))
+
+        lr_scheduler_probing = LinearWarmupCosineAnnealingLR(
+            optimizer=opt_probing,
+            warmup_epochs=min(10, config.probing_epoch // 5),
+            max_epochs=config.probing_epoch)
+
+        for _ in tqdm(range(config.probing_epoch)):
+            # Because of linear warmup, first step has zero LR. Hence step once before training.
+            lr_scheduler_probing.step()
+            probing_acc = linear_probing_epoch(
+                config=config,
+                train_loader=train_loader,
+                model=model,
+                device=device,
+                opt_probing=opt_probing,
+                loss_fn_classification=loss_fn_classification)
 
     _, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, dsmi_blockZ_Xs, dsmi_blockZ_Ys, _ = validate_epoch(
         config=config,
@@ -947,7 +1288,11 @@ def linear_probing(config: AttributeHashmap,
         model=model,
         device=device,
         loss_fn_classification=loss_fn_classification,
-        precomputed_clusters_X=precomputed_clusters_X)
+        precomputed_clusters_X=precomputed_clusters_X,
+        reference_cache=reference_cache,
+        metrics_worker=metrics_worker,
+        epoch_idx=epoch_idx,
+        compute_dse_dsmi=compute_dse_dsmi)
 
     return probing_acc, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X
 
@@ -1005,6 +1350,120 @@ if __name__ == '__main__':
         '--block-by-block',
         action='store_true',
         help='If turned on, we compute the block-by-block DSE/DSMI.')
+    parser.add_argument(
+        '--block-sketch',
+        help='How to compress the block activations for block-by-block DSE/DSMI: '
+        '[none, pool, jl]. `jl` is a sparse Johnson-Lindenstrauss projection.',
+        type=str,
+        default='none')
+    parser.add_argument(
+        '--block-sketch-dim',
+        help='Feature dimension of the compressed block activations.',
+        type=int,
+        default=2048)
+    parser.add_argument(
+        '--reference-cache',
+        action='store_true',
+        help='If turned on, the downsampled val inputs (X), labels (Y) and '
+        'clusters of X are built once and reused from disk.')
+    parser.add_argument(
+        '--reference-cache-dir',
+        help='Where to store the reference cache. Defaults to `$dataset_dir/reference_cache/`.',
+        type=str,
+        default=None)
+    parser.add_argument(
+        '--async-metrics',
+        action='store_true',
+        help='If turned on, DSE/DSMI are computed in background processes '
+        'while training continues.')
+    parser.add_argument('--async-metrics-workers',
+                        help='Number of background processes for DSE/DSMI.',
+                        type=int,
+                        default=1)
+    parser.add_argument(
+        '--async-metrics-max-pending',
+        help='Max number of epochs waiting for DSE/DSMI. Caps the memory usage.',
+        type=int,
+        default=2)
+    parser.add_argument(
+        '--bf16',
+        action='store_true',
+        help='If turned on, the training forward pass runs under bf16 autocast (CPU or GPU).')
+    parser.add_argument(
+        '--channels-last',
+        action='store_true',
+        help='If turned on, the model and the inputs use channels_last memory format.')
+    parser.add_argument(
+        '--compile',
+        action='store_true',
+        help='If turned on, the model and the losses are compiled with `torch.compile`.')
+    parser.add_argument(
+        '--grad-accum-steps',
+        help='Number of batches to accumulate the gradients over per optimizer step.',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--throughput-log-interval',
+        help='If provided, log the training throughput (images/s) every this many steps.',
+        type=int,
+        default=None)
+    parser.add_argument(
+        '--dataset-cache',
+        action='store_true',
+        help='If turned on, each split is decoded and resized once into a '
+        'memory-mapped uint8 array, and augmented as tensors afterwards.')
+    parser.add_argument(
+        '--dataset-cache-dir',
+        help='Where to store the dataset cache. Defaults to `$dataset_dir/dataset_cache/`.',
+        type=str,
+        default=None)
+    parser.add_argument(
+        '--probing-mode',
+        help='Linear probing for SimCLR: [online, cached-sgd, cached-lbfgs]. '
+        'The cached modes run the frozen encoder over the train set once per probe.',
+        type=str,
+        default='online')
+    parser.add_argument(
+        '--vectorized-ntxent',
+        action='store_true',
+        help='If turned on, SimCLR uses the standard 2B x 2B NT-Xent loss computed on device.')
+    parser.add_argument(
+        '--batched-augmentation',
+        action='store_true',
+        help='If turned on, the SimCLR views are generated per batch with vectorized tensor ops. '
+        'Requires `--dataset-cache`.')
+    parser.add_argument(
+        '--metric-drift-threshold',
+        help='If provided, DSE/DSMI are only computed when the drift of the probe embeddings '
+        'since the last computation exceeds this value (or after `--metric-max-interval` epochs). '
+        'Skipped epochs are interpolated and marked in the results.',
+        type=float,
+        default=None)
+    parser.add_argument(
+        '--metric-max-interval',
+        help='Max number of epochs between two DSE/DSMI computations.',
+        type=int,
+        default=10)
+    parser.add_argument('--metric-drift-measure',
+                        help='Drift statistic: [cka, kernel].',
+                        type=str,
+                        default='cka')
+    parser.add_argument('--metric-probe-size',
+                        help='Number of val images used for the drift statistic.',
+                        type=int,
+                        default=512)
+    parser.add_argument(
+        '--train-reservoir-size',
+        help='If provided, keep a class-stratified reservoir of this many train embeddings '
+        'from the training forward passes, and compute DSE/DSMI on it at each epoch end.',
+        type=int,
+        default=None)
+    parser.add_argument(
+        '--plot-interval',
+        help='If provided, the figures are rendered by a separate process, '
+        'at most once every this many seconds, instead of every epoch.',
+        type=float,
+        default=None)
     parser.add_argument('--gpu-id',
                         help='Available GPU index.',
                         type=int,
@@ -1020,11 +1479,38 @@ if __name__ == '__main__':
     config = AttributeHashmap(yaml.safe_load(open(args.config)))
     config.config_file_name = args.config
     config.gpu_id = args.gpu_id
+    config.plot_interval = args.plot_interval
+    config.train_reservoir_size = args.train_reservoir_size
+    config.metric_drift_threshold = args.metric_drift_threshold
+    config.metric_max_interval = args.metric_max_interval
+    config.metric_drift_measure = args.metric_drift_measure
+    config.metric_probe_size = args.metric_probe_size
+    config.batched_augmentation = args.batched_augmentation
+    config.vectorized_ntxent = args.vectorized_ntxent
+    config.probing_mode = args.probing_mode
+    config.dataset_cache = args.dataset_cache
+    config.dataset_cache_dir = args.dataset_cache_dir
+    config.bf16 = args.bf16
+    config.channels_last = args.channels_last
+    config.compile = args.compile
+    config.grad_accum_steps = args.grad_accum_steps
+    config.throughput_log_interval = args.throughput_log_interval
     config.model = args.model
     config.block_by_block = args.block_by_block
+    config.block_sketch = args.block_sketch
+    config.block_sketch_dim = args.block_sketch_dim
+    config.reference_cache = args.reference_cache
+    config.reference_cache_dir = args.reference_cache_dir
+    config.async_metrics = args.async_metrics
+    config.async_metrics_workers = args.async_metrics_workers
+    config.async_metrics_max_pending = args.async_metrics_max_pending
     if args.random_seed is not None:
         config.random_seed = args.random_seed
     config = update_config_dirs(AttributeHashmap(config))
+    if config.dataset_cache_dir is None:
+        config.dataset_cache_dir = '%s/dataset_cache/' % config.dataset_dir
+    if config.reference_cache_dir is None:
+        config.reference_cache_dir = '%s/reference_cache/' % config.dataset_dir
 
     # Update checkpoint dir.
     config.checkpoint_dir = '%s/%s-%s-%s-seed%s/' % (
@@ -1,7 +1,7 @@
 import argparse
 import os
 import sys
-from typing import Tuple, Dict, Iterable
+from typing import Tuple, Dict, Iterable, List
 from matplotlib import pyplot as plt
 from scipy.stats import pearsonr, spearmanr
 import pandas as pd
@@ -17,10 +17,16 @@ sys.path.insert(0, import_dir + '/api/')
 from dse import diffusion_spectral_entropy
 from dsmi import diffusion_spectral_mutual_information
 
+sys.path.insert(0, import_dir + '/src/nn/')
+from latent_access import encode_with_block_outputs
+
 sys.path.insert(0, import_dir + '/src/utils/')
 from attribute_hashmap import AttributeHashmap
 from seed import seed_everything
 from extend import ExtendedDataset
+from fast_inference import accelerate_model, probe_batch
+from image_cache import CachedImageLoader, load_image_cache, normalize_uint8
+from work_queue import ResultLedger, SkipTask, run_work_queue
 
 
 class ImageNetSubset(torch.utils.data.Dataset):
@@ -147,6 +153,61 @@ def get_val_loader(
     return val_loader
 
 
+def get_cached_val_loader(
+        args: AttributeHashmap, crop_pct: float,
+        interpolation: str) -> Tuple[CachedImageLoader, np.array]:
+    '''
+    Val loader over the preprocessed tensor cache in `args.val_cache_dir`.
+
+    The ImageNet subset is decoded once per (resolution, crop_pct, interpolation),
+    with the timm evaluation preprocessing (resize to `imsize / crop_pct`, center crop),
+    and stored as uint8. The 64 x 64 reference images used for I(Z; X)
+    are stored once for all models.
+
+    Returns the loader and the normalized reference X [N, 3 x 64 x 64].
+    '''
+    assert args.dataset == 'imagenet'
+    dataset_mean = (0.485, 0.456, 0.406)
+    dataset_std = (0.229, 0.224, 0.225)
+
+    def build_dataset(size: int, crop_pct: float, interpolation: str):
+        transform = torchvision.transforms.Compose([
+            torchvision.transforms.Resize(
+                int(np.floor(size / crop_pct)),
+                interpolation=torchvision.transforms.InterpolationMode(
+                    interpolation)),
+            torchvision.transforms.CenterCrop(size),
+            torchvision.transforms.PILToTensor(),
+        ])
+        return lambda: ImageNetSubset(full_dataset=torchvision.datasets.
+                                      ImageNet(args.dataset_dir,
+                                               split='val',
+                                               transform=transform))
+
+    cache = load_image_cache(
+        cache_dir=args.val_cache_dir,
+        key='%d-%.3f-%s' % (args.imsize, crop_pct, interpolation),
+        build_dataset=build_dataset(args.imsize, crop_pct, interpolation),
+        num_workers=args.num_workers)
+    reference = load_image_cache(cache_dir=args.val_cache_dir,
+                                 key='reference-64',
+                                 build_dataset=build_dataset(
+                                     64, 1.0, 'bicubic'),
+                                 num_workers=args.num_workers)
+    assert np.array_equal(cache['label'], reference['label'])
+
+    val_loader = CachedImageLoader(images=cache['image'],
+                                   labels=cache['label'],
+                                   batch_size=args.batch_size,
+                                   mean=dataset_mean,
+                                   std=dataset_std)
+    reference_X = normalize_uint8(
+        reference['image'],
+        mean=val_loader.mean,
+        std=val_loader.std).numpy().reshape(len(reference['image']), -1)
+    return val_loader, reference_X
+
+
 class ThisArchitectureIsWeirdError(Exception):
     pass
 
@@ -271,13 +332,36 @@ class ModelWithLatentAccess(torch.nn.Module):
     def encode(self, x):
         return self.encoder(x)
 
+    def forward_with_latent(self, x, blocks: List[torch.nn.Module] = None):
+        h, block_outputs = encode_with_block_outputs(self.encoder, x, blocks)
+        return self.linear(h), h, block_outputs
+
+
+RESULT_KEYS = [
+    'model_params', 'imagenet_val_acc_top1', 'imagenet_val_acc_top5',
+    'imagenet_test_acc_top1', 'imagenet_test_acc_top5', 'dse_Z', 'cse_Z',
+    'dsmi_Z_X', 'csmi_Z_X', 'dsmi_Z_Y', 'csmi_Z_Y'
+]
+
 
 def main(args: AttributeHashmap) -> None:
     '''
     Compute DSE and DSMI, and compute correlation with ImageNet acc.
+
+    The models are evaluated by a work queue (see `run_work_queue`):
+    one row per model in the ledger `results-ledger.sqlite`, with its status and metrics,
+    `args.num_eval_workers` processes in parallel, each on its own cores,
+    with an optional memory limit and timeout per model.
+    After a crash, re-running resumes without re-evaluating the finished models.
+    `results.npz` and the figure are exported from the ledger at the end.
+
+    The cached val protocol (`args.val_cache_dir`) does not preprocess exactly
+    like the online one, so it has its own ledger and outputs (suffix `-valcache`).
     '''
-    save_path_numpy = './results.npz'
-    save_path_fig = './results'
+    suffix = '' if args.val_cache_dir is None else '-valcache'
+    save_path_numpy = './results%s.npz' % suffix
+    save_path_fig = './results%s' % suffix
+    ledger_path = './results-ledger%s.sqlite' % suffix
 
     in_channels_map = {
         'imagenet': 3,
@@ -297,10 +381,7 @@ def main(args: AttributeHashmap) -> None:
     df_val = pd.read_csv('./results-imagenet.csv')
     df_test = pd.read_csv('./results-imagenet-real.csv')
 
-    df_val.drop([
-        'top1_err', 'top5_err', 'crop_pct', 'interpolation', 'img_size',
-        'param_count'
-    ],
+    df_val.drop(['top1_err', 'top5_err', 'img_size', 'param_count'],
                 axis=1,
                 inplace=True)
     df_test.drop([
@@ -322,152 +403,180 @@ def main(args: AttributeHashmap) -> None:
     df_combined = df_val.merge(df_test, on='model')
     del df_val, df_test
 
-    # Iterate over all models and evaluate results.
-    if os.path.isfile(save_path_numpy) and not args.restart:
-        npz_file = np.load(save_path_numpy)
-        results_dict = {
-            'model_names': list(npz_file['model_names']),
-            'model_params': list(npz_file['model_params']),
-            'imagenet_val_acc_top1': list(npz_file['imagenet_val_acc_top1']),
-            'imagenet_val_acc_top5': list(npz_file['imagenet_val_acc_top5']),
-            'imagenet_test_acc_top1': list(npz_file['imagenet_test_acc_top1']),
-            'imagenet_test_acc_top5': list(npz_file['imagenet_test_acc_top5']),
-            'dse_Z': list(npz_file['dse_Z']),
-            'cse_Z': list(npz_file['cse_Z']),
-            'dsmi_Z_X': list(npz_file['dsmi_Z_X']),
-            'csmi_Z_X': list(npz_file['csmi_Z_X']),
-            'dsmi_Z_Y': list(npz_file['dsmi_Z_Y']),
-            'csmi_Z_Y': list(npz_file['csmi_Z_Y']),
+    # model name -> row of the accuracy tables.
+    model_table = {
+        row['model']: {
+            'img_size': int(row['img_size']),
+            'crop_pct': float(row['crop_pct']),
+            'interpolation': str(row['interpolation']),
+            'param_count': float(str(row['param_count']).replace(',', '')),
+            'val_acc_top1': float(row['val_acc_top1']),
+            'val_acc_top5': float(row['val_acc_top5']),
+            'test_acc_top1': float(row['test_acc_top1']),
+            'test_acc_top5': float(row['test_acc_top5']),
         }
+        for (_, row) in df_combined.iterrows()
+    }
 
-    else:
-        results_dict = {
-            'model_names': [],
-            'model_params': [],
-            'imagenet_val_acc_top1': [],
-            'imagenet_val_acc_top5': [],
-            'imagenet_test_acc_top1': [],
-            'imagenet_test_acc_top5': [],
-            'dse_Z': [],
-            'cse_Z': [],
-            'dsmi_Z_X': [],
-            'csmi_Z_X': [],
-            'dsmi_Z_Y': [],
-            'csmi_Z_Y': [],
-        }
+    new_ledger = not os.path.isfile(ledger_path)
+    ledger = ResultLedger(ledger_path)
+    if args.restart:
+        ledger.reset()
+    ledger.add(model_table.keys())
+    if new_ledger and not args.restart and os.path.isfile(save_path_numpy):
+        # Carry over the results of the former sequential evaluator.
+        npz_file = np.load(save_path_numpy)
+        for i, model_name in enumerate(npz_file['model_names']):
+            ledger.finish(
+                str(model_name),
+                {key: float(npz_file[key][i])
+                 for key in RESULT_KEYS})
+    if args.retry_failed:
+        ledger.requeue(statuses=['failed', 'timeout'])
+
+    counts = run_work_queue(ledger_path=ledger_path,
+                            task_fn=evaluate_model,
+                            num_workers=args.num_eval_workers,
+                            cores_per_worker=args.cores_per_worker,
+                            timeout=args.timeout,
+                            memory_limit_gb=args.memory_limit_gb,
+                            task_kwargs={
+                                'args': dict(args),
+                                'model_table': model_table
+                            })
+    print('Models per status: %s' % counts)
+
+    results_dict = {key: [] for key in ['model_names'] + RESULT_KEYS}
+    for model_name, result in ledger.results():
+        results_dict['model_names'].append(model_name)
+        for key in RESULT_KEYS:
+            results_dict[key].append(result[key])
+
+    plot_figures(results_dict, save_path_fig=save_path_fig)
+    with open(save_path_numpy, 'wb+') as f:
+        np.savez(f, **{
+            key: np.array(value)
+            for (key, value) in results_dict.items()
+        })
+
+    return
 
-    # Iterate over the model candidates with pretrained weights.
-    for _i, model_candidate in tqdm(df_combined.iterrows(),
-                                    total=len(df_combined)):
 
-        # This is for resuming progress.
-        if model_candidate['model'] in results_dict['model_names']:
-            print('Model already evaluated: %s' % model_candidate['model'])
-            continue
+def find_local_weights(weights_dir: str, model_name: str) -> str:
+    '''
+    `weights_dir`/`model_name`.{safetensors, pth, pth.tar, bin}, or None if not found.
+    '''
+    for extension in ['.safetensors', '.pth', '.pth.tar', '.bin']:
+        path = os.path.join(weights_dir, model_name + extension)
+        if os.path.isfile(path):
+            return path
+    return None
 
-        args.imsize = model_candidate['img_size']
 
-        try:
-            device = torch.device(
-                'cuda:%d' %
-                args.gpu_id if torch.cuda.is_available() else 'cpu')
-            model = timm.create_model(model_name=model_candidate['model'],
-                                      num_classes=args.num_classes,
-                                      pretrained=True).to(device)
-        except RuntimeError as e:
-            if not "CUDA out of memory. " in str(e):
-                print(
-                    'When evaluating %s, hit error %s. Skipping this model.' %
-                    (model_candidate['model'], e))
-                continue
-            device = torch.device('cpu')
-            model = timm.create_model(model_name=model_candidate['model'],
-                                      num_classes=args.num_classes,
-                                      pretrained=True).to(device)
+def evaluate_model(name: str, worker_id: int, args: Dict,
+                   model_table: Dict[str, Dict]) -> Dict[str, float]:
+    '''
+    Work queue task: evaluate one timm model (runs in its own worker process).
 
-        try:
-            model = ModelWithLatentAccess(model, num_classes=args.num_classes)
-        except ThisArchitectureIsWeirdError as _:
-            print('Cannot process: %s. Skipping it.' %
-                  model_candidate['model'])
-            continue
+    The pretrained weights are read from `args.weights_dir`, never downloaded.
+    On CUDA out-of-memory, the evaluation is redone on CPU.
+    '''
+    args = AttributeHashmap(args)
+    if args.gpu_ids is None:
+        args.gpu_ids = [args.gpu_id]
+    seed_everything(args.random_seed)
+    os.environ['HF_HUB_OFFLINE'] = '1'
 
-        model.eval()
-        val_loader = get_val_loader(args=args)
+    model_candidate = model_table[name]
+    weights_path = find_local_weights(args.weights_dir, name)
+    if weights_path is None:
+        raise SkipTask('No local weights for %s in %s.' %
+                       (name, args.weights_dir))
 
+    args.imsize = model_candidate['img_size']
+    if args.val_cache_dir is None:
+        val_loader = get_val_loader(args=args)
+        reference_X = None
+    else:
+        val_loader, reference_X = get_cached_val_loader(
+            args=args,
+            crop_pct=model_candidate['crop_pct'],
+            interpolation=model_candidate['interpolation'])
+
+    devices = [torch.device('cpu')]
+    if torch.cuda.is_available():
+        gpu_id = args.gpu_ids[worker_id % len(args.gpu_ids)]
+        devices.insert(0, torch.device('cuda:%d' % gpu_id))
+
+    for device in devices:
+        model = None
         try:
+            model = timm.create_model(
+                model_name=name,
+                num_classes=args.num_classes,
+                pretrained=True,
+                pretrained_cfg_overlay=dict(file=weights_path))
+            try:
+                model = ModelWithLatentAccess(model,
+                                              num_classes=args.num_classes)
+            except ThisArchitectureIsWeirdError as _:
+                raise SkipTask('Cannot process: %s.' % name)
+            model = model.to(device)
+            model.eval()
+            if args.fast_inference != 'off' and device.type == 'cpu':
+                model, _ = accelerate_model(
+                    model,
+                    probe_x=probe_batch(val_loader,
+                                        in_channels=args.in_channels),
+                    backend=args.fast_inference,
+                    quantize_int8=args.fast_inference_int8,
+                    batch_size=args.batch_size,
+                    dse_fn=lambda Z: diffusion_spectral_entropy(
+                        embedding_vectors=Z,
+                        gaussian_kernel_sigma=np.sqrt(Z.shape[-1])),
+                    tolerance=args.fidelity_tolerance)
             dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y = evaluate_dse_dsmi(
-                args=args, val_loader=val_loader, model=model, device=device)
-        except RuntimeError as e:
-            if not "CUDA out of memory. " in str(e):
-                print(
-                    'When evaluating %s, hit error %s. Skipping this model.' %
-                    (model_candidate['model'], e))
-                continue
-            device = torch.device('cpu')
-            model = timm.create_model(model_name=model_candidate['model'],
-                                      num_classes=args.num_classes,
-                                      pretrained=True).to(device)
-            model = ModelWithLatentAccess(model, num_classes=args.num_classes)
-            dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y = evaluate_dse_dsmi(
-                args=args, val_loader=val_loader, model=model, device=device)
-
-        results_dict['model_names'].append(model_candidate['model'])
-        results_dict['model_params'].append(
-            float(model_candidate['param_count'].replace(',', '')))
-        results_dict['imagenet_val_acc_top1'].append(
-            model_candidate['val_acc_top1'])
-        results_dict['imagenet_val_acc_top5'].append(
-            model_candidate['val_acc_top5'])
-        results_dict['imagenet_test_acc_top1'].append(
-            model_candidate['test_acc_top1'])
-        results_dict['imagenet_test_acc_top5'].append(
-            model_candidate['test_acc_top5'])
-        results_dict['dse_Z'].append(dse_Z)
-        results_dict['cse_Z'].append(cse_Z)
-        results_dict['dsmi_Z_X'].append(dsmi_Z_X)
-        results_dict['csmi_Z_X'].append(csmi_Z_X)
-        results_dict['dsmi_Z_Y'].append(dsmi_Z_Y)
-        results_dict['csmi_Z_Y'].append(csmi_Z_Y)
-
-        # Delete model from cache.
-        os.system('rm -rf /home/cl2482/.cache/huggingface/hub/')
-
-        # It takes a long time to evaluate all models.
-        # Plot and save results after each model evaluation.
-        plot_figures(results_dict, save_path_fig=save_path_fig)
-        with open(save_path_numpy, 'wb+') as f:
-            np.savez(
-                f,
-                model_names=np.array(results_dict['model_names']),
-                model_params=np.array(results_dict['model_params']),
-                imagenet_val_acc_top1=np.array(
-                    results_dict['imagenet_val_acc_top1']),
-                imagenet_val_acc_top5=np.array(
-                    results_dict['imagenet_val_acc_top5']),
-                imagenet_test_acc_top1=np.array(
-                    results_dict['imagenet_test_acc_top1']),
-                imagenet_test_acc_top5=np.array(
-                    results_dict['imagenet_test_acc_top5']),
-                dse_Z=np.array(results_dict['dse_Z']),
-                cse_Z=np.array(results_dict['cse_Z']),
-                dsmi_Z_X=np.array(results_dict['dsmi_Z_X']),
-                csmi_Z_X=np.array(results_dict['csmi_Z_X']),
-                dsmi_Z_Y=np.array(results_dict['dsmi_Z_Y']),
-                csmi_Z_Y=np.array(results_dict['csmi_Z_Y']),
-            )
-
-    return
+                args=args,
+                val_loader=val_loader,
+                model=model,
+                device=device,
+                reference_X=reference_X)
+            break
+        except torch.cuda.OutOfMemoryError:
+            if device == devices[-1]:
+                raise
+            del model
+            torch.cuda.empty_cache()
+
+    return {
+        'model_params': model_candidate['param_count'],
+        'imagenet_val_acc_top1': model_candidate['val_acc_top1'],
+        'imagenet_val_acc_top5': model_candidate['val_acc_top5'],
+        'imagenet_test_acc_top1': model_candidate['test_acc_top1'],
+        'imagenet_test_acc_top5': model_candidate['test_acc_top5'],
+        'dse_Z': float(dse_Z),
+        'cse_Z': float(cse_Z),
+        'dsmi_Z_X': float(dsmi_Z_X),
+        'csmi_Z_X': float(csmi_Z_X),
+        'dsmi_Z_Y': float(dsmi_Z_Y),
+        'csmi_Z_Y': float(csmi_Z_Y),
+    }
 
 
 @torch.no_grad()
 def evaluate_dse_dsmi(args: AttributeHashmap,
                       val_loader: torch.utils.data.DataLoader,
-                      model: torch.nn.Module, device: torch.device):
+                      model: torch.nn.Module,
+                      device: torch.device,
+                      reference_X: np.array = None):
+    '''
+    `reference_X`: precomputed reference images for I(Z; X), in the order of `val_loader`.
+    If not provided, the inputs are downsampled to 64 x 64 on the fly.
+    '''
 
-    tensor_X = None  # input
-    tensor_Y = None  # label
-    tensor_Z = None  # latent
+    list_X = []  # input
+    list_Y = []  # label
+    list_Z = []  # latent
 
     model.eval()
     for x, y_true in tqdm(val_loader):
@@ -479,17 +588,18 @@ def evaluate_dse_dsmi(args: AttributeHashmap,
 
         ## Record data for DSE and DSMI computation.
 
-        # Downsample the input image to reduce memory usage.
-        curr_X = torch.nn.functional.interpolate(
-            x, size=(64, 64)).cpu().numpy().reshape(x.shape[0], -1)
-        curr_Y = y_true.cpu().numpy()
-        curr_Z = model.encode(x).cpu().numpy()
-        if tensor_X is None:
-            tensor_X, tensor_Y, tensor_Z = curr_X, curr_Y, curr_Z
-        else:
-            tensor_X = np.vstack((tensor_X, curr_X))
-            tensor_Y = np.hstack((tensor_Y, curr_Y))
-            tensor_Z = np.vstack((tensor_Z, curr_Z))
+        if reference_X is None:
+            # Downsample the input image to reduce memory usage.
+            list_X.append(
+                torch.nn.functional.interpolate(
+                    x, size=(64, 64)).cpu().numpy().reshape(x.shape[0], -1))
+        list_Y.append(y_true.cpu().numpy())
+        list_Z.append(model.encode(x).cpu().numpy())
+
+    tensor_X = np.vstack(list_X) if reference_X is None else reference_X
+    tensor_Y = np.hstack(list_Y)
+    tensor_Z = np.vstack(list_Z)
+    assert len(tensor_X) == len(tensor_Y) == len(tensor_Z)
 
     # For DSE, subsample for faster computation.
     dse_Z = diffusion_spectral_entropy(embedding_vectors=tensor_Z,
@@ -533,15 +643,70 @@ if __name__ == '__main__':
     parser.add_argument('--random-seed', type=int, default=1)
     parser.add_argument('--dataset', type=str, default='imagenet')
     parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--gpu-ids',
+                        help='GPUs shared by the evaluation workers '
+                        '(worker i uses gpu_ids[i %% len]). Default: [gpu_id].',
+                        type=int,
+                        nargs='+',
+                        default=None)
     parser.add_argument('--num-workers', type=int, default=8)
+    parser.add_argument('--num-eval-workers',
+                        help='Number of models evaluated in parallel.',
+                        type=int,
+                        default=1)
+    parser.add_argument('--cores-per-worker',
+                        help='Disjoint CPU cores per evaluation worker. '
+                        'Default: all cores split evenly.',
+                        type=int,
+                        default=None)
+    parser.add_argument('--memory-limit-gb',
+                        help='Address space limit per evaluation worker. '
+                        'Leave unset when evaluating on GPU.',
+                        type=float,
+                        default=None)
+    parser.add_argument('--timeout',
+                        help='Seconds before a model evaluation is killed.',
+                        type=float,
+                        default=None)
+    parser.add_argument('--weights-dir',
+                        help='Local folder with the timm weights, '
+                        'as `MODEL_NAME`.{safetensors, pth, pth.tar, bin}.',
+                        type=str,
+                        default='./timm_weights')
+    parser.add_argument('--val-cache-dir',
+                        help='If provided, decode the val images once per '
+                        '(resolution, crop_pct, interpolation) into this folder '
+                        'and evaluate on the cached center crops. '
+                        'Otherwise, random resized crops (x3) decoded for each model.',
+                        type=str,
+                        default=None)
+    parser.add_argument(
+        '--fast-inference',
+        help='CPU only. `trace`: torch.jit.trace + freeze, `compile`: torch.compile, '
+        'with channels_last and inference_mode. Falls back to the fp32 model '
+        'if the DSE of a probe set deviates by more than `--fidelity-tolerance`.',
+        choices=['off', 'trace', 'compile'],
+        default='off')
+    parser.add_argument('--fast-inference-int8',
+                        help='Also quantize the Linear layers to dynamic int8.',
+                        action='store_true')
+    parser.add_argument('--fidelity-tolerance',
+                        help='Max relative DSE deviation of the fast inference mode.',
+                        type=float,
+                        default=0.01)
+    parser.add_argument('--retry-failed',
+                        action='store_true',
+                        help='Re-evaluate the models that failed or timed out.')
     parser.add_argument(
         '--restart',
         action='store_true',
         help=
-        'If turned on, recompute from the first model. Otherwise resume where it left off.'
+        'If turned on, recompute from the first model. Otherwise resume where it left off (from the ledger).'
     )
     args = vars(parser.parse_args())
 
     args = AttributeHashmap(args)
+    if args.gpu_ids is None:
+        args.gpu_ids = [args.gpu_id]
     seed_everything(args.random_seed)
     main(args)
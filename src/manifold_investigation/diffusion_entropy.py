@@ -1,13 +1,17 @@
 import argparse
+import hashlib
+import json
 import os
 import sys
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from glob import glob
+from multiprocessing import get_context
 
 import numpy as np
 import yaml
 from matplotlib import pyplot as plt
 from scipy.stats import pearsonr, spearmanr
-from tqdm import tqdm
 from typing import Dict, Iterable
 import random
 
@@ -21,6 +25,8 @@ import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
 sys.path.insert(0, import_dir + '/utils/')
 sys.path.insert(0, import_dir + '/embedding_preparation')
 from attribute_hashmap import AttributeHashmap
+from embedding_store import folder_fingerprint, label_names, \
+    load_embedding_folder
 from information import approx_eigvals, exact_eigvals, \
     mutual_information_per_class_simple, mutual_information_per_class_random_sample, \
         von_neumann_entropy, shannon_entropy, mutual_information_wrt_Input_sample, comp_diffusion_embedding
@@ -213,6 +219,165 @@ def plot_figures(data_arrays: Dict[str, Iterable],
     return
 
 
+def analyze_checkpoint(embedding_folder: str, dataset: str, t: int,
+                       sigma: float, chebyshev: bool, input_clusters: np.array,
+                       save_root: str, log_path: str,
+                       cache_key: str) -> Dict[str, float]:
+    '''
+    All the metrics of one checkpoint. Independent of the other checkpoints,
+    given the (shared) spectral clusters of the input.
+
+    `cache_key` identifies the embedding folder content and the analysis parameters,
+    and names the cached diffusion eigenvalues of the checkpoint.
+    '''
+    checkpoint_name = os.path.basename(embedding_folder)
+    embedding_data = load_embedding_folder(embedding_folder)
+    orig_input = embedding_data['image']
+    labels = embedding_data['label_true'][:, None]  # expand dim to [N, 1]
+    embeddings = embedding_data['embedding']
+
+    # This is the matrix of N embedding vectors each at dim [1, D].
+    N, D = embeddings.shape
+
+    assert labels.shape[0] == N
+    assert labels.shape[1] == 1
+
+    if dataset == 'cifar10':
+        labels = label_names(labels, cifar10_int2name)
+
+    #
+    '''Shannon Entropy of embeddings'''
+    se = shannon_entropy(embeddings)
+    log('Shannon Entropy = %.4f' % se, log_path)
+
+    #
+    '''Diffusion Matrix and Diffusion Eigenvalues'''
+    save_path_eigenvalues = '%s/numpy_files/diffusion-eigenvalues/diffusion-eigenvalues-%s-%s.npz' % (
+        save_root, checkpoint_name, cache_key)
+    os.makedirs(os.path.dirname(save_path_eigenvalues), exist_ok=True)
+    if os.path.exists(save_path_eigenvalues):
+        data_numpy = np.load(save_path_eigenvalues)
+        eigenvalues_P = data_numpy['eigenvalues_P']
+        print('Pre-computed eigenvalues loaded.')
+    else:
+        diffusion_matrix = compute_diffusion_matrix(embeddings, sigma=sigma)
+        print('Diffusion matrix computed.')
+
+        if chebyshev:
+            eigenvalues_P = approx_eigvals(diffusion_matrix)
+        else:
+            eigenvalues_P = exact_eigvals(diffusion_matrix)
+
+        # Lower precision to save disk space.
+        eigenvalues_P = eigenvalues_P.astype(np.float16)
+        tmp_path = '%s.%s.tmp' % (save_path_eigenvalues, uuid.uuid4().hex)
+        with open(tmp_path, 'wb+') as f:
+            np.savez(f, eigenvalues_P=eigenvalues_P)
+        os.replace(tmp_path, save_path_eigenvalues)
+        print('Eigenvalues computed.')
+
+    eig_thr_list = [0.5, 0.2, 0.1, 5e-2, 1e-2, 1e-3, 1e-4]
+    log('# eigenvalues > thr: %s' % eig_thr_list, log_path)
+    log('t = 1: ' + str([np.sum(eigenvalues_P > thr) for thr in eig_thr_list]),
+        log_path)
+    log(
+        't = %d: ' % t +
+        str([np.sum(eigenvalues_P**t > thr) for thr in eig_thr_list]),
+        log_path)
+
+    #
+    '''Diffusion Entropy'''
+    log('von Neumann Entropy: ', log_path)
+    vne = von_neumann_entropy(eigenvalues_P, t=t)
+    log('Diffusion Entropy = %.4f' % vne, log_path)
+
+    #
+    '''Mutual Information between z and Output Class'''
+    log('Mutual Information between z and Output Class: ', log_path)
+
+    mi_Y_simple, H_ZgivenY_map, H_ZgivenY = mutual_information_per_class_simple(
+        embeddings=embeddings,
+        labels=labels,
+        H_Z=vne,
+        sigma=sigma,
+        vne_t=t,
+        chebyshev_approx=chebyshev)
+    log('MI between z and Output (full graph) = %.4f' % mi_Y_simple, log_path)
+
+    mi_Y, _, _ = mutual_information_per_class_random_sample(
+        embeddings=embeddings,
+        labels=labels,
+        H_ZgivenY_map=H_ZgivenY_map,
+        sigma=sigma,
+        vne_t=t,
+        chebyshev_approx=chebyshev)
+    log('MI between z and Output = %.4f' % mi_Y, log_path)
+
+    mi_Y_shannon, _, _ = mutual_information_per_class_random_sample(
+        embeddings=embeddings,
+        labels=labels,
+        H_ZgivenY_map=None,
+        sigma=sigma,
+        vne_t=t,
+        use_shannon_entropy=True,
+        chebyshev_approx=chebyshev)
+    log('MI between z and Output (Shannon) = %.4f' % mi_Y_shannon, log_path)
+
+    #
+    '''Mutual Information between z and Input'''
+    orig_input = np.reshape(orig_input, (N, -1))  # [N, W, H, C] -> [N, W*H*C]
+
+    mi_X, input_clusters = mutual_information_wrt_Input_sample(
+        embeddings=embeddings,
+        input=orig_input,
+        input_clusters=input_clusters,
+        sigma=sigma,
+        vne_t=t,
+        chebyshev_approx=chebyshev)
+    log('Mutual Information between z and Input = %.4f' % mi_X, log_path)
+
+    mi_X_shannon, input_clusters = mutual_information_wrt_Input_sample(
+        embeddings=embeddings,
+        input=orig_input,
+        input_clusters=input_clusters,
+        sigma=sigma,
+        vne_t=t,
+        use_shannon_entropy=True,
+        chebyshev_approx=chebyshev)
+    log('Mutual Information between z and Input (Shannon) = %.4f' %
+        mi_X_shannon, log_path)
+
+    return {
+        'se': float(se),
+        'vne': float(vne),
+        'mi_Y_simple': float(mi_Y_simple),
+        'mi_Y': float(mi_Y),
+        'H_ZgivenY': float(H_ZgivenY),
+        'mi_X': float(mi_X),
+        'mi_Y_shannon': float(mi_Y_shannon),
+        'mi_X_shannon': float(mi_X_shannon),
+    }
+
+
+def load_record(record_path: str, fingerprint: str) -> Dict[str, float]:
+    if not os.path.isfile(record_path):
+        return None
+    with open(record_path) as f:
+        record = json.load(f)
+    if record['fingerprint'] != fingerprint:
+        return None
+    return record['metrics']
+
+
+def save_record(record_path: str, fingerprint: str,
+                metrics: Dict[str, float]) -> None:
+    tmp_path = '%s.%s.tmp' % (record_path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'metrics': metrics}, f)
+    os.replace(tmp_path, record_path)
+    return
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config',
@@ -224,6 +389,11 @@ if __name__ == '__main__':
         '--chebyshev',
         action='store_true',
         help='Chebyshev approximation instead of full eigendecomposition.')
+    parser.add_argument(
+        '--num-workers',
+        help='Number of checkpoints analyzed in parallel.',
+        type=int,
+        default=1)
     parser.add_argument(
         '--random-seed',
         help='Only enter if you want to override the config!!!',
@@ -283,212 +453,134 @@ if __name__ == '__main__':
         config.random_seed)
 
     os.makedirs(os.path.dirname(save_path_final_npy), exist_ok=True)
-    if os.path.exists(save_path_final_npy):
-        data_numpy = np.load(save_path_final_npy)
+
+    # Per-checkpoint metric records, keyed by checkpoint name and analysis parameters.
+    # A record is reused as long as its embedding folder is unchanged,
+    # so only new or changed checkpoints are analyzed.
+    param_hash = hashlib.md5(
+        json.dumps(
+            {
+                'dataset': config.dataset,
+                't': args.t,
+                'gaussian_kernel_sigma': args.gaussian_kernel_sigma,
+                'chebyshev': args.chebyshev,
+            },
+            sort_keys=True).encode()).hexdigest()[:12]
+    record_dir = '%s/numpy_files/checkpoint-records/' % save_root_override
+    os.makedirs(record_dir, exist_ok=True)
+
+    epoch_list, acc_list, records, pending = [], [], [], []
+    folder_fingerprints = []
+    for i, embedding_folder in enumerate(embedding_folders):
+        epoch_list.append(
+            int(embedding_folder.split('epoch')[-1].split('-valAcc')[0]) + 1)
+        acc_list.append(
+            float(
+                embedding_folder.split('-valAcc')[1].split('-divergence')[0]))
+
+        checkpoint_name = os.path.basename(embedding_folder)
+        record_path = '%s/%s-%s.json' % (record_dir, checkpoint_name,
+                                         param_hash)
+        fingerprint = folder_fingerprint(embedding_folder)
+        folder_fingerprints.append(fingerprint)
+        records.append(load_record(record_path, fingerprint))
+        if records[-1] is None:
+            pending.append((i, record_path, fingerprint))
+            checkpoint_log_path = '%s/%s-%s.log' % (record_dir, checkpoint_name,
+                                                    param_hash)
+            if os.path.exists(checkpoint_log_path):
+                os.remove(checkpoint_log_path)
+
+    def collect_data_arrays() -> Dict[str, Iterable]:
+        # The checkpoints analyzed so far, in epoch order.
+        done = [i for i in range(len(records)) if records[i] is not None]
         data_arrays = {
-            'epoch': data_numpy['epoch'],
-            'acc': data_numpy['acc'],
-            'se': data_numpy['se'],
-            'vne': data_numpy['vne'],
-            'mi_Y_simple': data_numpy['mi_Y_simple'],
-            'mi_Y': data_numpy['mi_Y'],
-            'H_ZgivenY': data_numpy['H_ZgivenY'],
-            'mi_X': data_numpy['mi_X'],
-            'mi_Y_shannon': data_numpy['mi_Y_shannon'],
-            'mi_X_shannon': data_numpy['mi_X_shannon'],
+            'epoch': [epoch_list[i] for i in done],
+            'acc': [acc_list[i] for i in done],
         }
-        plot_figures(data_arrays=data_arrays, save_paths_fig=save_paths_fig)
-
-    else:
-        epoch_list, acc_list, se_list, vne_list, \
-            mi_Y_simple_list, mi_Y_append_list, mi_Y_list, H_ZgivenY_list, mi_X_list, mi_Y_shannon_list, mi_X_shannon_list \
-                = [], [], [], [], [], [], [], [], [], [], []
-        input_clusters = None
-
-        for i, embedding_folder in enumerate(embedding_folders):
-            epoch_list.append(
-                int(embedding_folder.split('epoch')[-1].split('-valAcc')[0]) +
-                1)
-            acc_list.append(
-                float(
-                    embedding_folder.split('-valAcc')[1].split('-divergence')
-                    [0]))
-
-            files = sorted(glob(embedding_folder + '/*'))
-            checkpoint_name = os.path.basename(embedding_folder)
-            log(checkpoint_name, log_path)
-
-            labels, embeddings, orig_input = None, None, None
-
-            for file in tqdm(files):
-                np_file = np.load(file)
-                curr_input = np_file['image']
-                curr_label = np_file['label_true']
-                curr_embedding = np_file['embedding']
-
-                if labels is None:
-                    orig_input = curr_input
-                    labels = curr_label[:, None]  # expand dim to [B, 1]
-                    embeddings = curr_embedding
-                else:
-                    orig_input = np.vstack((orig_input, curr_input))
-                    labels = np.vstack((labels, curr_label[:, None]))
-                    embeddings = np.vstack((embeddings, curr_embedding))
-
-            # This is the matrix of N embedding vectors each at dim [1, D].
-            N, D = embeddings.shape
-
-            assert labels.shape[0] == N
-            assert labels.shape[1] == 1
-
-            if config.dataset == 'cifar10':
-                labels_updated = np.zeros(labels.shape, dtype='object')
-                for k in range(N):
-                    labels_updated[k] = cifar10_int2name[labels[k].item()]
-                labels = labels_updated
-                del labels_updated
-
-            #
-            '''Shannon Entropy of embeddings'''
-            se = shannon_entropy(embeddings)
-            se_list.append(se)
-            log('Shannon Entropy = %.4f' % se, log_path)
-
-            #
-            '''Diffusion Matrix and Diffusion Eigenvalues'''
-            save_path_eigenvalues = '%s/numpy_files/diffusion-eigenvalues/diffusion-eigenvalues-%s.npz' % (
-                save_root, checkpoint_name)
-            os.makedirs(os.path.dirname(save_path_eigenvalues), exist_ok=True)
-            if os.path.exists(save_path_eigenvalues):
-                data_numpy = np.load(save_path_eigenvalues)
-                eigenvalues_P = data_numpy['eigenvalues_P']
-                print('Pre-computed eigenvalues loaded.')
-            else:
-                diffusion_matrix = compute_diffusion_matrix(
-                    embeddings, sigma=args.gaussian_kernel_sigma)
-                print('Diffusion matrix computed.')
-
-                if args.chebyshev:
-                    eigenvalues_P = approx_eigvals(diffusion_matrix)
-                else:
-                    eigenvalues_P = exact_eigvals(diffusion_matrix)
-
-                # Lower precision to save disk space.
-                eigenvalues_P = eigenvalues_P.astype(np.float16)
-                with open(save_path_eigenvalues, 'wb+') as f:
-                    np.savez(f, eigenvalues_P=eigenvalues_P)
-                print('Eigenvalues computed.')
-
-            eig_thr_list = [0.5, 0.2, 0.1, 5e-2, 1e-2, 1e-3, 1e-4]
-            log('# eigenvalues > thr: %s' % eig_thr_list, log_path)
-            log(
-                't = 1: ' +
-                str([np.sum(eigenvalues_P > thr) for thr in eig_thr_list]),
-                log_path)
-            log(
-                't = %d: ' % args.t + str([
-                    np.sum(eigenvalues_P**args.t > thr) for thr in eig_thr_list
-                ]), log_path)
-
-            #
-            '''Diffusion Entropy'''
-            log('von Neumann Entropy: ', log_path)
-            vne = von_neumann_entropy(eigenvalues_P, t=args.t)
-            vne_list.append(vne)
-            log('Diffusion Entropy = %.4f' % vne, log_path)
-
-            #
-            '''Mutual Information between z and Output Class'''
-            log('Mutual Information between z and Output Class: ', log_path)
-
-            mi_Y_simple, H_ZgivenY_map, H_ZgivenY = mutual_information_per_class_simple(
-                embeddings=embeddings,
-                labels=labels,
-                H_Z=vne,
-                sigma=args.gaussian_kernel_sigma,
-                vne_t=args.t,
-                chebyshev_approx=args.chebyshev)
-            mi_Y_simple_list.append(mi_Y_simple)
-            H_ZgivenY_list.append(H_ZgivenY)
-            log('MI between z and Output (full graph) = %.4f' % mi_Y_simple,
-                log_path)
-
-            mi_Y, _, _ = mutual_information_per_class_random_sample(
-                embeddings=embeddings,
-                labels=labels,
-                H_ZgivenY_map=H_ZgivenY_map,
-                sigma=args.gaussian_kernel_sigma,
-                vne_t=args.t,
-                chebyshev_approx=args.chebyshev)
-            mi_Y_list.append(mi_Y)
-            log('MI between z and Output = %.4f' % mi_Y, log_path)
-
-            mi_Y_shannon, _, _ = mutual_information_per_class_random_sample(
-                embeddings=embeddings,
-                labels=labels,
-                H_ZgivenY_map=None,
-                sigma=args.gaussian_kernel_sigma,
-                vne_t=args.t,
-                use_shannon_entropy=True,
-                chebyshev_approx=args.chebyshev)
-            mi_Y_shannon_list.append(mi_Y_shannon)
-            log('MI between z and Output (Shannon) = %.4f' % mi_Y_shannon,
-                log_path)
-
-            #
-            '''Mutual Information between z and Input'''
-            orig_input = np.reshape(orig_input,
-                                    (N, -1))  # [N, W, H, C] -> [N, W*H*C]
-
-            mi_X, input_clusters = mutual_information_wrt_Input_sample(
-                embeddings=embeddings,
-                input=orig_input,
-                input_clusters=input_clusters,
-                sigma=args.gaussian_kernel_sigma,
-                vne_t=args.t,
-                chebyshev_approx=args.chebyshev)
-            mi_X_list.append(mi_X)
-            log('Mutual Information between z and Input = %.4f' % mi_X,
-                log_path)
-
-            mi_X_shannon, input_clusters = mutual_information_wrt_Input_sample(
-                embeddings=embeddings,
-                input=orig_input,
-                input_clusters=input_clusters,
-                sigma=args.gaussian_kernel_sigma,
-                vne_t=args.t,
-                use_shannon_entropy=True,
-                chebyshev_approx=args.chebyshev)
-            mi_X_shannon_list.append(mi_X_shannon)
-            log(
-                'Mutual Information between z and Input (Shannon) = %.4f' %
-                mi_X_shannon, log_path)
-
-            # Plotting
-            data_arrays = {
-                'epoch': epoch_list,
-                'acc': acc_list,
-                'se': se_list,
-                'vne': vne_list,
-                'mi_Y_simple': mi_Y_simple_list,
-                'mi_Y': mi_Y_list,
-                'H_ZgivenY': H_ZgivenY_list,
-                'mi_X': mi_X_list,
-                'mi_Y_shannon': mi_Y_shannon_list,
-                'mi_X_shannon': mi_X_shannon_list,
-            }
-            plot_figures(data_arrays=data_arrays,
+        for key in [
+                'se', 'vne', 'mi_Y_simple', 'mi_Y', 'H_ZgivenY', 'mi_X',
+                'mi_Y_shannon', 'mi_X_shannon'
+        ]:
+            data_arrays[key] = [records[i][key] for i in done]
+        return data_arrays
+
+    log('%d checkpoints, %d to analyze.' %
+        (len(embedding_folders), len(pending)), log_path)
+
+    if len(pending) > 0:
+        # The input is the same for every checkpoint:
+        # cluster it once, before the checkpoints are dispatched.
+        # The cached clusters are keyed by the number and the content of the clustered images.
+        orig_input = load_embedding_folder(embedding_folders[pending[0][0]],
+                                           fields=('image', ))['image']
+        orig_input = np.reshape(orig_input, (orig_input.shape[0], -1))
+        input_md5 = hashlib.md5(
+            np.ascontiguousarray(orig_input).tobytes()).hexdigest()[:12]
+        save_path_input_clusters = '%s/numpy_files/input-clusters-%s-seed%s-N%d-%s.npy' % (
+            save_root_override, config.dataset, config.random_seed,
+            orig_input.shape[0], input_md5)
+        if os.path.exists(save_path_input_clusters):
+            input_clusters = np.load(save_path_input_clusters)
+        else:
+            from sklearn.cluster import SpectralClustering
+            input_clusters = SpectralClustering(
+                n_clusters=100,
+                affinity='nearest_neighbors',
+                assign_labels='cluster_qr',
+                random_state=0).fit(orig_input).labels_
+            tmp_path = '%s.%s.tmp' % (save_path_input_clusters,
+                                      uuid.uuid4().hex)
+            with open(tmp_path, 'wb+') as f:
+                np.save(f, input_clusters)
+            os.replace(tmp_path, save_path_input_clusters)
+
+        def analyze_kwargs(i: int) -> Dict:
+            checkpoint_name = os.path.basename(embedding_folders[i])
+            return dict(embedding_folder=embedding_folders[i],
+                        dataset=config.dataset,
+                        t=args.t,
+                        sigma=args.gaussian_kernel_sigma,
+                        chebyshev=args.chebyshev,
+                        input_clusters=input_clusters,
+                        save_root=save_root,
+                        log_path='%s/%s-%s.log' %
+                        (record_dir, checkpoint_name, param_hash),
+                        cache_key='%s-%s' %
+                        (param_hash, folder_fingerprints[i][:12]))
+
+        def on_done(i: int, record_path: str, fingerprint: str,
+                    metrics: Dict[str, float]) -> None:
+            save_record(record_path, fingerprint, metrics)
+            records[i] = metrics
+            # Append the log of this checkpoint to the main log.
+            log(os.path.basename(embedding_folders[i]), log_path)
+            with open(analyze_kwargs(i)['log_path']) as f:
+                log(f.read().rstrip('\n'), log_path, to_console=False)
+            plot_figures(data_arrays=collect_data_arrays(),
                          save_paths_fig=save_paths_fig)
 
-        with open(save_path_final_npy, 'wb+') as f:
-            np.savez(f,
-                     epoch=np.array(epoch_list),
-                     acc=np.array(acc_list),
-                     se=np.array(se_list),
-                     vne=np.array(vne_list),
-                     mi_Y_simple=np.array(mi_Y_simple_list),
-                     mi_Y=np.array(mi_Y_list),
-                     H_ZgivenY=np.array(H_ZgivenY_list),
-                     mi_X=np.array(mi_X_list),
-                     mi_Y_shannon=np.array(mi_Y_shannon_list),
-                     mi_X_shannon=np.array(mi_X_shannon_list))
+        if args.num_workers <= 1:
+            for (i, record_path, fingerprint) in pending:
+                on_done(i, record_path, fingerprint,
+                        analyze_checkpoint(**analyze_kwargs(i)))
+        else:
+            with ProcessPoolExecutor(
+                    max_workers=args.num_workers,
+                    mp_context=get_context('spawn')) as executor:
+                futures = {
+                    executor.submit(analyze_checkpoint, **analyze_kwargs(i)):
+                    (i, record_path, fingerprint)
+                    for (i, record_path, fingerprint) in pending
+                }
+                for future in as_completed(futures):
+                    on_done(*futures[future], future.result())
+
+    data_arrays = collect_data_arrays()
+    plot_figures(data_arrays=data_arrays, save_paths_fig=save_paths_fig)
+
+    with open(save_path_final_npy, 'wb+') as f:
+        np.savez(f, **{
+            key: np.array(value)
+            for (key, value) in data_arrays.items()
+        })
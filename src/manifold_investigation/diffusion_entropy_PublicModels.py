@@ -1,5 +1,10 @@
 import argparse
+import copy
+import functools
+import hashlib
+import json
 import os
+import uuid
 import sys
 from typing import List, Tuple, Union
 
@@ -21,6 +26,10 @@ os.environ["NUMEXPR_NUM_THREADS"] = "1"  # export NUMEXPR_NUM_THREADS=1
 import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
 sys.path.insert(0, import_dir + '/utils/')
 from attribute_hashmap import AttributeHashmap
+from embedding_store import folder_fingerprint, load_embedding_store
+from fast_inference import accelerate_model, probe_batch
+from feature_extraction import extract_features_multi_model
+from linear_probe import fit_linear_path, linear_accuracy
 from information import von_neumann_entropy, approx_eigvals, exact_eigvals, mutual_information_per_class_random_sample
 from log_utils import log
 from seed import seed_everything
@@ -28,6 +37,7 @@ from scheduler import LinearWarmupCosineAnnealingLR
 
 sys.path.insert(0, import_dir + '/nn/external_model_loader/')
 from barlowtwins_model import BarlowTwinsModel
+from base import BaseModel
 from diffusion import compute_diffusion_matrix
 from moco_model import MoCoModel
 from supervised_model import SupervisedModel
@@ -60,8 +70,10 @@ def compute_diffusion_entropy(embeddings: torch.Tensor,
         eigenvalues_P = eigenvalues_P.astype(np.float16)
         print('Eigenvalues computed.')
 
-        with open(eig_npy_path, 'wb+') as f:
+        tmp_path = '%s.%s.tmp' % (eig_npy_path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb+') as f:
             np.savez(f, eigenvalues_P=eigenvalues_P)
+        os.replace(tmp_path, eig_npy_path)
 
     eig_thr_list = [0.5, 0.2, 0.1, 5e-2, 1e-2, 1e-3, 1e-4]
     print('# eigenvalues > thr: %s' % eig_thr_list)
@@ -75,6 +87,72 @@ def compute_diffusion_entropy(embeddings: torch.Tensor,
     return vne
 
 
+def build_model(model_name: str, version: str, device: torch.device,
+                num_classes: int) -> BaseModel:
+    if model_name == 'supervised':
+        return SupervisedModel(device=device,
+                               version=version,
+                               num_classes=num_classes)
+    elif model_name == 'barlowtwins':
+        return BarlowTwinsModel(device=device,
+                                version=version,
+                                num_classes=num_classes)
+    elif model_name == 'moco':
+        return MoCoModel(device=device,
+                         version=version,
+                         num_classes=num_classes)
+    elif model_name == 'simsiam':
+        return SimSiamModel(device=device,
+                            version=version,
+                            num_classes=num_classes)
+    elif model_name == 'swav':
+        return SwavModel(device=device,
+                         version=version,
+                         num_classes=num_classes)
+    elif model_name == 'vicreg':
+        return VICRegModel(device=device,
+                           version=version,
+                           num_classes=num_classes)
+    elif model_name == 'vicregl':
+        return VICRegLModel(device=device,
+                            version=version,
+                            num_classes=num_classes)
+    else:
+        raise ValueError('model_name: %s not supported.' % model_name)
+
+
+def load_pretrained_model(model_name: str, version: str,
+                          device: torch.device, num_classes: int) -> BaseModel:
+    model = build_model(model_name=model_name,
+                        version=version,
+                        device=device,
+                        num_classes=num_classes)
+    model.restore_model()
+    return model
+
+
+def load_accelerated_model(model_fn: functools.partial,
+                           probe_x: torch.Tensor, args: AttributeHashmap,
+                           log_path: str):
+    '''
+    `model_fn()`, with its encoder replaced by the fast inference mode
+    if it passes the DSE fidelity check (see `accelerate_model`).
+    '''
+    model = model_fn()
+    model.eval()
+    encoder, report = accelerate_model(
+        model.encoder,
+        probe_x=probe_x,
+        backend=args.fast_inference,
+        quantize_int8=args.fast_inference_int8,
+        batch_size=args.batch_size,
+        tolerance=args.fidelity_tolerance,
+        log_fn=lambda s: log(s, log_path))
+    if report['accelerated']:
+        return encoder
+    return model
+
+
 def get_dataloaders(
     args: AttributeHashmap
 ) -> Tuple[Tuple[
@@ -321,6 +399,47 @@ def tune_model_single_epoch(args: AttributeHashmap,
     return tuning_acc
 
 
+def cached_linear_probe(args: AttributeHashmap, linear: torch.nn.Linear,
+                        train_store_folder: str, val_store_folder: str,
+                        device: torch.device, head_path: str,
+                        log_path: str) -> float:
+    '''
+    Linear probing on the cached (frozen encoder) train and val features,
+    over a path of regularization values. Returns the val accuracy.
+    '''
+    train_data = load_embedding_store(train_store_folder,
+                                      fields=('label_true', 'embedding'))
+    val_data = load_embedding_store(val_store_folder,
+                                    fields=('label_true', 'embedding'))
+    val_features = torch.from_numpy(np.asarray(val_data['embedding']))
+    val_labels = torch.from_numpy(np.asarray(val_data['label_true']))
+
+    if os.path.exists(head_path):
+        log('Loading tuned linear head: %s' % head_path, log_path)
+        linear.load_state_dict(torch.load(head_path, map_location=device))
+        return linear_accuracy(linear=linear,
+                               features=val_features,
+                               labels=val_labels,
+                               device=device)
+
+    linear.weight.data.normal_(mean=0.0, std=0.01)
+    linear.bias.data.zero_()
+    val_acc, weight_decay = fit_linear_path(
+        linear=linear,
+        train_features=torch.from_numpy(np.asarray(train_data['embedding'])),
+        train_labels=torch.from_numpy(np.asarray(train_data['label_true'])),
+        val_features=val_features,
+        val_labels=val_labels,
+        device=device,
+        mode=args.probing_mode,
+        weight_decays=args.probe_weight_decays)
+    log('Linear probing (%s): best weight decay %s, acc: %.3f' %
+        (args.probing_mode, weight_decay, val_acc), log_path)
+
+    torch.save(linear.state_dict(), head_path)
+    return val_acc
+
+
 def infer_model(val_loader: torch.utils.data.DataLoader,
                 model: torch.nn.Module, device: torch.device,
                 model_path: str) -> float:
@@ -391,6 +510,77 @@ def diffusion_entropy(args: AttributeHashmap):
     }
     summary = {}
 
+    #
+    '''
+    1. Run through encoder and save embeddings.
+       We have to do this prior to tuning, because we want to
+       see if the manifold characteristics extracted prior to tuning
+       can give us enough information to estimate tuning performance.
+       Each val batch is decoded once and run through all the pretrained encoders.
+    '''
+    embedding_store_dir = '%s/embeddings/' % npy_folder
+    model_fns = {
+        version: functools.partial(load_pretrained_model,
+                                   model_name=model_name,
+                                   version=version,
+                                   device=device,
+                                   num_classes=args.num_classes)
+        for model_name in model_version_map.keys()
+        for version in model_version_map[model_name]
+    }
+    if args.fast_inference != 'off' and device.type == 'cpu':
+        probe_x = probe_batch(val_loader, in_channels=args.in_channels)
+        model_fns = {
+            version: functools.partial(load_accelerated_model,
+                                       model_fn=model_fn,
+                                       probe_x=probe_x,
+                                       args=args,
+                                       log_path=log_path)
+            for (version, model_fn) in model_fns.items()
+        }
+    extracted = extract_features_multi_model(
+        model_fns=model_fns,
+        loader=val_loader,
+        device=device,
+        store_dir=embedding_store_dir,
+        in_channels=args.in_channels,
+        models_per_pass=args.models_per_pass)
+    log('Embeddings and labels computed for: %s' % extracted, log_path)
+
+    # With cached probing, the train set also goes through each encoder only once
+    # (val transform, no augmentation), and the linear heads are fit on the cached features.
+    cached_probing = not args.full_fine_tune and args.probing_mode != 'online'
+    train_embedding_store_dir = '%s/embeddings-train/' % npy_folder
+    if cached_probing:
+        train_feature_dataset = copy.copy(train_loader.dataset)
+        train_feature_dataset.transform = val_loader.dataset.transform
+        train_feature_loader = torch.utils.data.DataLoader(
+            train_feature_dataset,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            shuffle=False,
+            pin_memory=True)
+        extracted = extract_features_multi_model(
+            model_fns=model_fns,
+            loader=train_feature_loader,
+            device=device,
+            store_dir=train_embedding_store_dir,
+            in_channels=args.in_channels,
+            models_per_pass=args.models_per_pass)
+        log('Train embeddings and labels computed for: %s' % extracted,
+            log_path)
+
+    # The cached eigenvalues are keyed by the analysis parameters
+    # and by the content of the embedding store of each encoder.
+    param_hash = hashlib.md5(
+        json.dumps(
+            {
+                't': args.t,
+                'gaussian_kernel_sigma': args.gaussian_kernel_sigma,
+                'chebyshev': args.chebyshev,
+            },
+            sort_keys=True).encode()).hexdigest()[:12]
+
     for model_name in model_version_map.keys():
         for i, version in enumerate(model_version_map[model_name]):
             log('model: %s, version: %s' % (model_name, version), log_path)
@@ -399,80 +589,23 @@ def diffusion_entropy(args: AttributeHashmap):
                 'top1_acc_nominal': top1_acc_nominal[model_name][i]
             }
 
-            embedding_npy_path = '%s/%s_embeddings.npy' % (npy_folder, version)
-            eig_npy_path = '%s/%s_eigP.npy' % (npy_folder, version)
-
-            if model_name == 'supervised':
-                model = SupervisedModel(device=device,
-                                        version=version,
-                                        num_classes=args.num_classes)
-            elif model_name == 'barlowtwins':
-                model = BarlowTwinsModel(device=device,
-                                         version=version,
-                                         num_classes=args.num_classes)
-            elif model_name == 'moco':
-                model = MoCoModel(device=device,
-                                  version=version,
-                                  num_classes=args.num_classes)
-            elif model_name == 'simsiam':
-                model = SimSiamModel(device=device,
-                                     version=version,
-                                     num_classes=args.num_classes)
-            elif model_name == 'swav':
-                model = SwavModel(device=device,
-                                  version=version,
-                                  num_classes=args.num_classes)
-            elif model_name == 'vicreg':
-                model = VICRegModel(device=device,
-                                    version=version,
-                                    num_classes=args.num_classes)
-            elif model_name == 'vicregl':
-                model = VICRegLModel(device=device,
-                                     version=version,
-                                     num_classes=args.num_classes)
-            else:
-                raise ValueError('model_name: %s not supported.' % model_name)
+            embedding_folder = '%s/%s' % (embedding_store_dir, version)
+            eig_npy_path = '%s/%s_eigP-%s-%s.npy' % (
+                npy_folder, version, param_hash,
+                folder_fingerprint(embedding_folder)[:12])
 
-            #
-            '''
-            1. Run through encoder and save embeddings.
-               We have to do this prior to tuning, because we want to
-               see if the manifold characteristics extracted prior to tuning
-               can give us enough information to estimate tuning performance.
-            '''
-            if os.path.exists(embedding_npy_path):
-                data_numpy = np.load(embedding_npy_path)
-                embeddings = data_numpy['embeddings']
-                labels = data_numpy['labels']
-                log('Pre-computed embeddings loaded.', log_path)
-            else:
-                embeddings, labels = [], []
-                with torch.no_grad():
-                    for i, (x, y_true) in enumerate(tqdm(val_loader)):
-                        assert args.in_channels in [1, 3]
-                        if args.in_channels == 1:
-                            # Repeat the channel dimension: 1 channel -> 3 channels.
-                            x = x.repeat(1, 3, 1, 1)
-                        x = x.to(device)
-
-                        # shape: [B, d, 1, 1]
-                        embedding_vec = model.encode(x).cpu().detach().numpy()
-                        # shape: [B, d]
-                        embedding_vec = embedding_vec.reshape(
-                            embedding_vec.shape[:2])
-
-                        y_true = y_true.detach().numpy()
-
-                        embeddings.append(embedding_vec)
-                        labels.append(y_true)
-
-                embeddings = np.concatenate(embeddings)
-                embeddings = embeddings.astype(np.float16)
-                labels = np.concatenate(labels)
-                log('Embeddings and labels computed.', log_path)
-
-                with open(embedding_npy_path, 'wb+') as f:
-                    np.savez(f, embeddings=embeddings, labels=labels)
+            # Used for tuning, which restores the pretrained weights itself.
+            model = build_model(model_name=model_name,
+                                version=version,
+                                device=device,
+                                num_classes=args.num_classes)
+
+            embedding_data = load_embedding_store(
+                embedding_folder,
+                fields=('label_true', 'embedding'))
+            embeddings = np.asarray(embedding_data['embedding'])
+            labels = np.asarray(embedding_data['label_true'])
+            log('Pre-computed embeddings loaded.', log_path)
 
             summary[version]['vne'] = compute_diffusion_entropy(
                 embeddings=embeddings,
@@ -494,6 +627,10 @@ def diffusion_entropy(args: AttributeHashmap):
             if args.full_fine_tune is True:
                 tuned_model_path = '%s/%s_FineTuneModel.pt' % (pt_folder,
                                                                version)
+            elif cached_probing:
+                # Only the linear head: the encoder is the pretrained one.
+                tuned_model_path = '%s/%s_LinearProbeHead-%s.pt' % (
+                    pt_folder, version, args.probing_mode)
             else:
                 tuned_model_path = '%s/%s_LinearProbeModel.pt' % (pt_folder,
                                                                   version)
@@ -501,6 +638,9 @@ def diffusion_entropy(args: AttributeHashmap):
             if args.full_fine_tune is True:
                 val_acc_npy_path = '%s/%s_val_acc_FineTune.npy' % (npy_folder,
                                                                    version)
+            elif cached_probing:
+                val_acc_npy_path = '%s/%s_val_acc_LinearProbe-%s.npy' % (
+                    npy_folder, version, args.probing_mode)
             else:
                 val_acc_npy_path = '%s/%s_val_acc_LinearProbe.npy' % (
                     npy_folder, version)
@@ -510,6 +650,19 @@ def diffusion_entropy(args: AttributeHashmap):
                 data_numpy = np.load(val_acc_npy_path)
                 val_acc_actual = data_numpy['val_acc']
                 print('Reusing previously computed accuracies.')
+            elif cached_probing:
+                val_acc_actual = cached_linear_probe(
+                    args=args,
+                    linear=model.linear,
+                    train_store_folder='%s/%s' %
+                    (train_embedding_store_dir, version),
+                    val_store_folder='%s/%s' % (embedding_store_dir, version),
+                    device=device,
+                    head_path=tuned_model_path,
+                    log_path=log_path)
+
+                with open(val_acc_npy_path, 'wb+') as f:
+                    np.savez(f, val_acc=val_acc_actual)
             else:
                 if os.path.exists(tuned_model_path):
                     log('Loading tuned model: %s' % version, log_path)
@@ -722,12 +875,43 @@ if __name__ == '__main__':
                         default=0)
     parser.add_argument('--batch-size', type=int, default=512)
     parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument(
+        '--models-per-pass',
+        help='Max number of pretrained encoders held in memory during feature extraction. '
+        'If None, all encoders share a single pass over the val set.',
+        type=int,
+        default=None)
     parser.add_argument('--full-fine-tune',
                         help='If True, full fine tune. Else, linear probe.',
                         action='store_true')
     parser.add_argument('--learning-rate-tuning', type=float, default=1e-4)
     parser.add_argument('--num-tuning-epoch', type=int, default=50)
     parser.add_argument('--reuse-acc', action='store_true')
+    parser.add_argument(
+        '--probing-mode',
+        help='`online`: AdamW on the frozen backbone, one pass over the train set per epoch. '
+        '`cached-lbfgs` / `cached-ridge`: fit the linear head on cached features, '
+        'over the path of `--probe-weight-decays`. Ignored with `--full-fine-tune`.',
+        choices=['online', 'cached-lbfgs', 'cached-ridge'],
+        default='online')
+    parser.add_argument('--probe-weight-decays',
+                        type=float,
+                        nargs='+',
+                        default=[1e-2, 1e-3, 1e-4, 1e-5, 1e-6])
+    parser.add_argument(
+        '--fast-inference',
+        help='CPU only. `trace`: torch.jit.trace + freeze, `compile`: torch.compile, '
+        'with channels_last and inference_mode. Falls back to the fp32 model '
+        'if the DSE of a probe set deviates by more than `--fidelity-tolerance`.',
+        choices=['off', 'trace', 'compile'],
+        default='off')
+    parser.add_argument('--fast-inference-int8',
+                        help='Also quantize the Linear layers to dynamic int8.',
+                        action='store_true')
+    parser.add_argument('--fidelity-tolerance',
+                        help='Max relative DSE deviation of the fast inference mode.',
+                        type=float,
+                        default=0.01)
     args = vars(parser.parse_args())
     args = AttributeHashmap(args)
 
@@ -8,7 +8,6 @@ from typing import List
 import numpy as np
 import yaml
 from matplotlib import pyplot as plt
-from tqdm import tqdm
 
 os.environ["OMP_NUM_THREADS"] = "1"  # export OMP_NUM_THREADS=1
 os.environ["OPENBLAS_NUM_THREADS"] = "1"  # export OPENBLAS_NUM_THREADS=1
@@ -19,6 +18,7 @@ os.environ["NUMEXPR_NUM_THREADS"] = "1"  # export NUMEXPR_NUM_THREADS=1
 import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
 sys.path.insert(0, import_dir + '/utils/')
 from attribute_hashmap import AttributeHashmap
+from embedding_store import label_names, load_embedding_folder
 from log_utils import log
 from path_utils import update_config_dirs
 from seed import seed_everything
@@ -201,23 +201,13 @@ if __name__ == '__main__':
                 1)
             acc_list.append(float(embedding_folder.split('-valAcc')[1]))
 
-            files = sorted(glob(embedding_folder + '/*'))
             checkpoint_name = os.path.basename(embedding_folder)
             log(checkpoint_name, log_path)
 
-            labels, embeddings = None, None
-
-            for file in tqdm(files):
-                np_file = np.load(file)
-                curr_label = np_file['label_true']
-                curr_embedding = np_file['embedding']
-
-                if labels is None:
-                    labels = curr_label[:, None]  # expand dim to [B, 1]
-                    embeddings = curr_embedding
-                else:
-                    labels = np.vstack((labels, curr_label[:, None]))
-                    embeddings = np.vstack((embeddings, curr_embedding))
+            embedding_data = load_embedding_folder(embedding_folder,
+                                                   fields=('label_true', 'embedding'))
+            labels = embedding_data['label_true'][:, None]  # expand dim to [N, 1]
+            embeddings = embedding_data['embedding']
 
             # This is the matrix of N embedding vectors each at dim [1, D].
             N, D = embeddings.shape
@@ -226,11 +216,7 @@ if __name__ == '__main__':
             assert labels.shape[1] == 1
 
             if config.dataset == 'cifar10':
-                labels_updated = np.zeros(labels.shape, dtype='object')
-                for k in range(N):
-                    labels_updated[k] = cifar10_int2name[labels[k].item()]
-                labels = labels_updated
-                del labels_updated
+                labels = label_names(labels, cifar10_int2name)
 
             # NOTE: This time we only consider the "activation" of neurons in the
             # last layer before the final fully-connected classifier.
@@ -14,11 +14,11 @@ import phate
 import scprep
 import yaml
 from matplotlib import pyplot as plt
-from tqdm import tqdm
 
 import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
 sys.path.insert(0, import_dir + '/utils/')
 from attribute_hashmap import AttributeHashmap
+from embedding_store import load_embedding_folder
 from laplacian_extrema import get_laplacian_extrema
 from path_utils import update_config_dirs
 
@@ -76,23 +76,13 @@ if __name__ == '__main__':
                          config.dataset)
 
     for i, embedding_folder in enumerate(embedding_folders):
-        files = sorted(glob(embedding_folder + '/*'))
         checkpoint_name = os.path.basename(embedding_folder)
         checkpoint_acc = checkpoint_name.split('acc_')[1]
 
-        labels, embeddings = None, None
-
-        for file in tqdm(files):
-            np_file = np.load(file)
-            curr_label = np_file['label_true']
-            curr_embedding = np_file['embedding']
-
-            if labels is None:
-                labels = curr_label[:, None]  # expand dim to [B, 1]
-                embeddings = curr_embedding
-            else:
-                labels = np.vstack((labels, curr_label[:, None]))
-                embeddings = np.vstack((embeddings, curr_embedding))
+        embedding_data = load_embedding_folder(embedding_folder,
+                                               fields=('label_true', 'embedding'))
+        labels = embedding_data['label_true'][:, None]  # expand dim to [N, 1]
+        embeddings = embedding_data['embedding']
 
         N, D = embeddings.shape
 
@@ -0,0 +1,32 @@
+from typing import List, Tuple
+
+import torch
+
+
+def encode_with_block_outputs(
+        encoder: torch.nn.Module,
+        x: torch.Tensor,
+        blocks: List[torch.nn.Module] = None
+) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+    '''
+    Run `encoder` once and record the outputs of the sub-modules in `blocks`
+    (empty list if not provided).
+
+    Shared by the `forward_with_latent(x, blocks=None)` method of our models,
+    which returns, from this single forward pass:
+        (1) the logits, i.e., `self.forward(x)`,
+        (2) the penultimate embedding, i.e., `self.encode(x)`,
+        (3) the outputs of the sub-modules in `blocks`.
+    '''
+    block_outputs, handles = [], []
+    if blocks is not None:
+        for block in blocks:
+            handles.append(
+                block.register_forward_hook(
+                    lambda module, input, output: block_outputs.append(output)))
+    try:
+        h = encoder(x)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return h, block_outputs
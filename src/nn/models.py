@@ -3,9 +3,13 @@ Modification to ResNet encoder is adapted from
 https://github.com/leftthomas/SimCLR/blob/master/model.py
 """
 
+from typing import List
+
 import torch
 import torchvision
 
+from latent_access import encode_with_block_outputs
+
 
 def get_model(model_name: str, num_classes: int,
               small_image: bool) -> torch.nn.Module:
@@ -85,6 +89,10 @@ class ResNet50(torch.nn.Module):
     def forward(self, x):
         return self.linear(self.encoder(x))
 
+    def forward_with_latent(self, x, blocks: List[torch.nn.Module] = None):
+        h, block_outputs = encode_with_block_outputs(self.encoder, x, blocks)
+        return self.linear(h), h, block_outputs
+
     def init_linear(self):
         torch.nn.init.constant_(self.linear.weight, 0.01)
         torch.nn.init.constant_(self.linear.bias, 0)
@@ -167,6 +175,10 @@ class WideResNet50_2(torch.nn.Module):
     def forward(self, x):
         return self.linear(self.encoder(x))
 
+    def forward_with_latent(self, x, blocks: List[torch.nn.Module] = None):
+        h, block_outputs = encode_with_block_outputs(self.encoder, x, blocks)
+        return self.linear(h), h, block_outputs
+
     def init_linear(self):
         torch.nn.init.constant_(self.linear.weight, 0.01)
         torch.nn.init.constant_(self.linear.bias, 0)
@@ -249,6 +261,10 @@ class ResNeXT50_32x4d(torch.nn.Module):
     def forward(self, x):
         return self.linear(self.encoder(x))
 
+    def forward_with_latent(self, x, blocks: List[torch.nn.Module] = None):
+        h, block_outputs = encode_with_block_outputs(self.encoder, x, blocks)
+        return self.linear(h), h, block_outputs
+
     def init_linear(self):
         torch.nn.init.constant_(self.linear.weight, 0.01)
         torch.nn.init.constant_(self.linear.bias, 0)
@@ -1,13 +1,18 @@
+import math
 import random
-from typing import Tuple
+from typing import List, Tuple
 
 import torch
 import torchvision.transforms as transforms
 from PIL import ImageFilter
+from torchvision.ops import roi_align
 from sklearn.metrics import accuracy_score
 
 
 class NTXentLoss(torch.nn.Module):
+    # The pseudo accuracy goes through sklearn on CPU numpy arrays,
+    # which `torch.compile` cannot trace. See `TrainEngine.compile_loss`.
+    compilable = False
 
     def __init__(self, temperature: float = 1.0):
         super(NTXentLoss, self).__init__()
@@ -48,6 +53,59 @@ class NTXentLoss(torch.nn.Module):
         return loss / B, pseudo_acc
 
 
+class VectorizedNTXentLoss(torch.nn.Module):
+    '''
+    The standard NT-Xent (SimCLR) loss over the 2B x 2B similarity matrix,
+    computed with log-sum-exp and without leaving the device.
+
+    For each of the 2B views, the positive is the other view of the same image,
+    and the negatives are all the other 2B - 2 views.
+
+    `pseudo_acc` is the fraction of views whose most similar other view is their positive.
+    It is returned as a detached 0-d tensor, so the caller decides when to sync (e.g., `.item()`
+    at logging time).
+
+    NOTE: This is not numerically the same loss as `NTXentLoss` above,
+    which contrasts the summed positives against the summed negatives of `z1 @ z2.T`.
+    '''
+
+    def __init__(self, temperature: float = 1.0):
+        super(VectorizedNTXentLoss, self).__init__()
+        self.temperature = temperature
+        # (B, device) -> (self-similarity mask, index of the positive).
+        self.cached_masks = {}
+
+    def forward(self, z1: torch.Tensor, z2: torch.Tensor):
+        assert z1.shape == z2.shape
+        B, _ = z1.shape
+
+        self_mask, pos_idx = self._get_masks(B, z1.device)
+
+        z = torch.nn.functional.normalize(input=torch.cat((z1, z2), dim=0),
+                                          p=2,
+                                          dim=1)
+        logits = torch.matmul(z, z.T) / self.temperature
+        logits = logits.masked_fill(self_mask, float('-inf'))
+
+        pos_logits = logits.gather(1, pos_idx[:, None]).squeeze(1)
+        loss = torch.mean(torch.logsumexp(logits, dim=1) - pos_logits)
+
+        with torch.no_grad():
+            pseudo_acc = torch.mean(
+                (torch.argmax(logits, dim=1) == pos_idx).float())
+
+        return loss, pseudo_acc
+
+    def _get_masks(self, B: int, device: torch.device):
+        key = (B, str(device))
+        if key not in self.cached_masks:
+            self_mask = torch.eye(2 * B, dtype=torch.bool, device=device)
+            pos_idx = torch.cat((torch.arange(B, 2 * B, device=device),
+                                 torch.arange(0, B, device=device)))
+            self.cached_masks[key] = (self_mask, pos_idx)
+        return self.cached_masks[key]
+
+
 class SingleInstanceTwoView:
     '''
     This class is adapted from BarlowTwins and SimSiam in our external_src folder.
@@ -88,3 +146,167 @@ class GaussianBlur(object):
         sigma = random.uniform(self.sigma[0], self.sigma[1])
         x = x.filter(ImageFilter.GaussianBlur(radius=sigma))
         return x
+
+
+class BatchedTwoView(torch.nn.Module):
+    '''
+    Batched, tensor-level counterpart of `SingleInstanceTwoView`.
+    Takes a uint8 batch [B, C, imsize, imsize] (already resized, e.g., from `DecodedDatasetCache`)
+    and returns two augmented, normalized float views with vectorized ops:
+        random resized crop:  per-sample crop boxes + `roi_align` to imsize x imsize.
+        horizontal flip:      per-sample `torch.where`.
+        color jitter:         batched brightness / contrast / saturation blends and
+                              a hue rotation in YIQ space, with per-sample factors.
+        random grayscale:     per-sample blend with the luma.
+        Gaussian blur:        separable grouped convolution with per-sample kernels.
+
+    Differences from the PIL pipeline:
+        Crop boxes that do not fit in the image are clamped instead of resampled.
+        The jitter is applied in a fixed order, and the hue shift is a YIQ rotation.
+
+    Can run on the collated batch (see `BatchedTwoViewCollate`) or on device after collation.
+    '''
+
+    def __init__(self,
+                 imsize: int,
+                 mean: Tuple[float],
+                 std: Tuple[float],
+                 crop_scale: Tuple[float] = (0.6, 1.6),
+                 crop_ratio: Tuple[float] = (3 / 4, 4 / 3),
+                 jitter_prob: float = 0.4,
+                 jitter_strength: Tuple[float] = (0.8, 0.8, 0.8, 0.2),
+                 grayscale_prob: float = 0.2,
+                 blur_prob: float = 0.5,
+                 blur_sigma: List[float] = [0.1, 2.0]):
+        super(BatchedTwoView, self).__init__()
+        self.imsize = imsize
+        self.crop_scale = crop_scale
+        self.crop_ratio = crop_ratio
+        self.jitter_prob = jitter_prob
+        self.jitter_strength = jitter_strength
+        self.grayscale_prob = grayscale_prob
+        self.blur_prob = blur_prob
+        self.blur_sigma = blur_sigma
+        self.register_buffer('mean', torch.tensor(mean)[None, :, None, None])
+        self.register_buffer('std', torch.tensor(std)[None, :, None, None])
+        self.register_buffer('luma', torch.tensor([0.299, 0.587, 0.114]))
+        rgb_to_yiq = torch.tensor([[0.299, 0.587, 0.114],
+                                   [0.596, -0.274, -0.322],
+                                   [0.211, -0.523, 0.312]])
+        self.register_buffer('rgb_to_yiq', rgb_to_yiq)
+        self.register_buffer('yiq_to_rgb', torch.linalg.inv(rgb_to_yiq))
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        x = x.float() / 255
+        return self.augment(x), self.augment(x)
+
+    def augment(self, x: torch.Tensor) -> torch.Tensor:
+        B, C, _, _ = x.shape
+        x = self._random_resized_crop(x)
+        x = torch.where(self._coin(B, 0.5, x.device), x.flip(-1), x)
+        if C == 3:
+            x = self._color_jitter(x)
+            gray = self._to_gray(x).expand(-1, 3, -1, -1)
+            x = torch.where(self._coin(B, self.grayscale_prob, x.device), gray,
+                            x)
+        x = self._gaussian_blur(x)
+        return (x - self.mean) / self.std
+
+    def _coin(self, B: int, p: float, device: torch.device) -> torch.Tensor:
+        return (torch.rand(B, device=device) < p)[:, None, None, None]
+
+    def _uniform(self, B: int, low: float, high: float,
+                 device: torch.device) -> torch.Tensor:
+        return torch.empty(B, device=device).uniform_(low, high)
+
+    def _to_gray(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.einsum('bchw,c->bhw', x, self.luma)[:, None]
+
+    def _random_resized_crop(self, x: torch.Tensor) -> torch.Tensor:
+        B, _, H, W = x.shape
+        area = H * W * self._uniform(B, *self.crop_scale, x.device)
+        aspect = torch.exp(
+            self._uniform(B, math.log(self.crop_ratio[0]),
+                          math.log(self.crop_ratio[1]), x.device))
+        w = torch.sqrt(area * aspect).clamp(max=W)
+        h = torch.sqrt(area / aspect).clamp(max=H)
+        x0 = torch.rand(B, device=x.device) * (W - w)
+        y0 = torch.rand(B, device=x.device) * (H - h)
+        boxes = torch.stack((torch.arange(B, device=x.device,
+                                          dtype=x.dtype), x0, y0, x0 + w,
+                             y0 + h),
+                            dim=1)
+        return roi_align(x,
+                         boxes,
+                         output_size=(self.imsize, self.imsize),
+                         spatial_scale=1.0,
+                         sampling_ratio=2,
+                         aligned=True)
+
+    def _color_jitter(self, x: torch.Tensor) -> torch.Tensor:
+        B = x.shape[0]
+        brightness, contrast, saturation, hue = self.jitter_strength
+        apply = self._coin(B, self.jitter_prob, x.device)
+
+        def factor(strength: float) -> torch.Tensor:
+            f = self._uniform(B, max(0, 1 - strength), 1 + strength,
+                              x.device)[:, None, None, None]
+            return torch.where(apply, f, torch.ones_like(f))
+
+        x = (x * factor(brightness)).clamp(0, 1)
+        c = factor(contrast)
+        gray_mean = self._to_gray(x).mean(dim=(2, 3), keepdim=True)
+        x = (x * c + gray_mean * (1 - c)).clamp(0, 1)
+        s = factor(saturation)
+        x = (x * s + self._to_gray(x) * (1 - s)).clamp(0, 1)
+
+        theta = self._uniform(B, -hue, hue, x.device) * 2 * math.pi
+        theta = torch.where(apply[:, 0, 0, 0], theta, torch.zeros_like(theta))
+        cos, sin = torch.cos(theta), torch.sin(theta)
+        rotation = torch.zeros(B, 3, 3, device=x.device)
+        rotation[:, 0, 0] = 1
+        rotation[:, 1, 1], rotation[:, 1, 2] = cos, -sin
+        rotation[:, 2, 1], rotation[:, 2, 2] = sin, cos
+        # RGB -> YIQ -> rotate IQ -> RGB, one 3x3 matrix per sample.
+        M = self.yiq_to_rgb[None] @ rotation @ self.rgb_to_yiq[None]
+        x = torch.einsum('bij,bjhw->bihw', M, x).clamp(0, 1)
+        return x
+
+    def _gaussian_blur(self, x: torch.Tensor) -> torch.Tensor:
+        B, C, H, W = x.shape
+        radius = math.ceil(3 * self.blur_sigma[1])
+        offsets = torch.arange(-radius, radius + 1, device=x.device,
+                               dtype=x.dtype)
+        sigma = self._uniform(B, *self.blur_sigma, x.device)
+        kernel = torch.exp(-offsets[None, :]**2 / (2 * sigma[:, None]**2))
+        kernel = kernel / kernel.sum(dim=1, keepdim=True)
+        # Samples that are not blurred get an identity kernel.
+        identity = (offsets == 0).to(x.dtype)[None, :].expand(B, -1)
+        kernel = torch.where(self._coin(B, self.blur_prob, x.device)[:, :, 0, 0],
+                             kernel, identity)
+        kernel = kernel.repeat_interleave(C, dim=0)
+
+        # Separable grouped convolution: one group per (sample, channel).
+        x = x.reshape(1, B * C, H, W)
+        x = torch.nn.functional.pad(x, (radius, radius, 0, 0), mode='reflect')
+        x = torch.nn.functional.conv2d(x, kernel[:, None, None, :], groups=B * C)
+        x = torch.nn.functional.pad(x, (0, 0, radius, radius), mode='reflect')
+        x = torch.nn.functional.conv2d(x, kernel[:, None, :, None], groups=B * C)
+        return x.reshape(B, C, H, W)
+
+
+class BatchedTwoViewCollate(object):
+    '''
+    `collate_fn` that stacks uint8 images and generates the two views with `BatchedTwoView`,
+    returning ((x_aug1, x_aug2), y) like a loader using `SingleInstanceTwoView`.
+    '''
+
+    def __init__(self, augmentation: BatchedTwoView):
+        self.augmentation = augmentation
+
+    def __call__(self, batch):
+        x = torch.stack([item[0] for item in batch])
+        y = torch.as_tensor([item[1] for item in batch])
+        with torch.no_grad():
+            x_aug1, x_aug2 = self.augmentation(x)
+        return (x_aug1, x_aug2), y
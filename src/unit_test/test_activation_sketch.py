@@ -0,0 +1,53 @@
+import os
+import sys
+
+import torch
+
+import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
+sys.path.insert(0, import_dir + '/utils/')
+from activation_sketch import ActivationSketch
+
+
+def test_pool_shapes() -> None:
+    sketch = ActivationSketch(mode='pool', dim=256)
+    # 16 channels: g = floor(sqrt(256 / 16)) = 4.
+    assert sketch(torch.randn(3, 16, 8, 8)).shape == (3, 16 * 4 * 4)
+    # The grid never exceeds the feature map.
+    assert sketch(torch.randn(3, 4, 2, 2)).shape == (3, 4 * 2 * 2)
+    # More channels than `dim`: one value per channel.
+    assert sketch(torch.randn(3, 512, 8, 8)).shape == (3, 512)
+    # Tokens [B, T, C] are averaged.
+    assert sketch(torch.randn(3, 10, 32)).shape == (3, 32)
+
+    x = torch.randn(2, 5, 6, 16)
+    channels_last = ActivationSketch(mode='pool', dim=64, channels_last=True)
+    channels_first = ActivationSketch(mode='pool', dim=64)
+    assert torch.allclose(channels_last(x),
+                          channels_first(x.permute(0, 3, 1, 2)))
+
+
+def test_jl_shapes_and_projection() -> None:
+    sketch = ActivationSketch(mode='jl', dim=128, seed=3)
+    x = torch.randn(6, 32, 4, 4)
+    out = sketch(x)
+    assert out.shape == (6, 128)
+
+    # The same projection across calls (i.e., across batches and epochs),
+    # also for a new sketch with the same seed.
+    assert torch.equal(sketch(x[:2]), out[:2])
+    assert torch.allclose(ActivationSketch(mode='jl', dim=128, seed=3)(x), out)
+    assert not torch.allclose(
+        ActivationSketch(mode='jl', dim=128, seed=4)(x), out)
+    # A different input dimension gets its own projection.
+    assert sketch(torch.randn(6, 100)).shape == (6, 128)
+
+    # Linear map with unit-norm columns: norms are preserved on average.
+    x = torch.randn(200, 4096)
+    ratio = sketch(x).norm(dim=1)**2 / x.norm(dim=1)**2
+    assert abs(ratio.mean().item() - 1) < 0.05
+
+
+if __name__ == '__main__':
+    test_pool_shapes()
+    test_jl_shapes_and_projection()
+    print('Success')
@@ -0,0 +1,55 @@
+import os
+import sys
+
+import numpy as np
+
+import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
+sys.path.insert(0, import_dir + '/utils/')
+from async_metrics import AsyncMetricsWorker
+
+
+def weighted_sum(tensor_X: np.array, tensor_Z: np.array,
+                 weight: float) -> float:
+    return float(weight * tensor_X.sum() + tensor_Z.sum())
+
+
+def failing_metric(tensor_X: np.array, tensor_Z: np.array) -> float:
+    # The traceback keeps the shared memory views alive.
+    raise ValueError('Metric failed on %d samples.' % len(tensor_X))
+
+
+def test_shared_arrays() -> None:
+    worker = AsyncMetricsWorker(num_workers=1, max_pending=2)
+    worker.share(arrays={'tensor_X': np.ones((4, 3))})
+    for epoch_idx in range(3):
+        worker.submit(key=epoch_idx,
+                      fn=weighted_sum,
+                      arrays={'tensor_Z': np.full((4, 2), epoch_idx)},
+                      weight=2)
+    results = dict(worker.collect(block=True))
+    worker.close()
+    assert results == {0: 24.0, 1: 32.0, 2: 40.0}
+
+
+def test_error_is_not_masked() -> None:
+    worker = AsyncMetricsWorker(num_workers=1, max_pending=1)
+    worker.submit(key=0,
+                  fn=failing_metric,
+                  arrays={
+                      'tensor_X': np.ones((5, 3)),
+                      'tensor_Z': np.ones((5, 2))
+                  })
+    try:
+        list(worker.collect(block=True))
+    except ValueError as e:
+        assert 'Metric failed on 5 samples.' in str(e)
+    else:
+        raise AssertionError('The error of the metric was lost.')
+    finally:
+        worker.executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    test_shared_arrays()
+    test_error_is_not_masked()
+    print('Success')
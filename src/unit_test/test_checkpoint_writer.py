@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+from glob import glob
+
+import torch
+
+import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
+sys.path.insert(0, import_dir + '/utils/')
+from checkpoint_writer import CheckpointWriter
+
+
+def test_atomic_write_and_snapshot() -> None:
+    with tempfile.TemporaryDirectory() as folder:
+        writer = CheckpointWriter()
+        state_dict = {'weight': torch.zeros(3), 'step': 0}
+        path = os.path.join(folder, 'nested', 'model.pty')
+        writer.save(state_dict, path)
+        # The snapshot is taken at `save`, later updates are not written.
+        state_dict['weight'] += 1
+        writer.close()
+
+        assert glob(os.path.join(folder, '**', '*.tmp'), recursive=True) == []
+        checkpoint = torch.load(path)
+        assert torch.equal(checkpoint['weight'], torch.zeros(3))
+        assert checkpoint['step'] == 0
+
+
+def test_retention_per_group() -> None:
+    with tempfile.TemporaryDirectory() as folder:
+        writer = CheckpointWriter(keep_last=2)
+        best_path = os.path.join(folder, 'best.pty')
+        for epoch_idx in range(5):
+            state_dict = {'weight': torch.full((2, ), float(epoch_idx))}
+            writer.save(state_dict,
+                        os.path.join(folder, 'epoch_%d.pty' % epoch_idx),
+                        retention_group='epoch')
+            writer.save(state_dict,
+                        os.path.join(folder, 'other_%d.pty' % epoch_idx),
+                        retention_group='other')
+            # Checkpoints without a group are never removed.
+            writer.save(state_dict, best_path)
+            writer.link(best_path,
+                        os.path.join(folder, 'pct_%d.pty' % epoch_idx))
+        writer.close()
+
+        expected = ['best.pty'] + [
+            '%s_%d.pty' % (prefix, epoch_idx) for prefix in ['epoch', 'other']
+            for epoch_idx in [3, 4]
+        ] + ['pct_%d.pty' % epoch_idx for epoch_idx in range(5)]
+        assert sorted(os.listdir(folder)) == sorted(expected)
+        for epoch_idx in range(5):
+            # Each link holds the weights of the best checkpoint at that time.
+            checkpoint = torch.load(
+                os.path.join(folder, 'pct_%d.pty' % epoch_idx))
+            assert torch.equal(checkpoint['weight'],
+                               torch.full((2, ), float(epoch_idx)))
+
+
+def test_failure_is_raised() -> None:
+    with tempfile.TemporaryDirectory() as folder:
+        writer = CheckpointWriter()
+        writer.link(os.path.join(folder, 'missing.pty'),
+                    os.path.join(folder, 'link.pty'))
+        try:
+            writer.wait()
+        except RuntimeError as e:
+            assert isinstance(e.__cause__, OSError)
+        else:
+            raise AssertionError('The failed write was not reported.')
+        # The writer keeps working after a reported failure.
+        path = os.path.join(folder, 'model.pty')
+        writer.save({'weight': torch.ones(1)}, path)
+        writer.close()
+        assert sorted(os.listdir(folder)) == ['model.pty']
+
+
+if __name__ == '__main__':
+    test_atomic_write_and_snapshot()
+    test_retention_per_group()
+    test_failure_is_raised()
+    print('Success')
@@ -0,0 +1,115 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
+sys.path.insert(0, import_dir + '/utils/')
+from embedding_store import EmbeddingStoreWriter, load_embedding_folder, load_embedding_store
+
+
+def write_group(store_dir: str,
+                names: list,
+                images: torch.Tensor,
+                dataset: str,
+                batch_size: int = 4,
+                random_seed: int = 1) -> dict:
+    '''
+    Write one checkpoint group (shared val images) the way `train_embeddings.py` does.
+    '''
+    rng = np.random.RandomState(random_seed)
+    N = images.shape[0]
+    labels = torch.from_numpy(rng.randint(0, 10, size=N))
+    embeddings = {
+        name: torch.from_numpy(rng.randn(N, 8)).float()
+        for name in names
+    }
+    writers = [
+        EmbeddingStoreWriter(store_dir=store_dir,
+                             name=name,
+                             num_samples=N,
+                             split_signature={
+                                 'dataset': dataset,
+                                 'split': 'val',
+                             }) for name in names
+    ]
+    for start in range(0, N, batch_size):
+        for j, (name, writer) in enumerate(zip(names, writers)):
+            writer.append(
+                image_batch=images[start:start + batch_size] if j == 0 else None,
+                label_true_batch=labels[start:start + batch_size],
+                embedding_batch=embeddings[name][start:start + batch_size])
+    for writer in writers:
+        writer.close(image_writer=writers[0])
+    return {'label_true': labels.numpy(), 'embeddings': embeddings}
+
+
+def test_round_trip(random_seed: int = 1) -> None:
+    images = torch.from_numpy(
+        np.random.RandomState(random_seed).randn(10, 3, 5, 5)).float()
+    with tempfile.TemporaryDirectory() as store_dir:
+        written = write_group(store_dir, ['epoch0', 'epoch1'], images,
+                              dataset='mnist')
+        for name in ['epoch0', 'epoch1']:
+            data = load_embedding_folder(os.path.join(store_dir, name))
+            assert np.array_equal(data['label_true'], written['label_true'])
+            assert np.allclose(data['embedding'],
+                               written['embeddings'][name].numpy(),
+                               atol=1e-2)
+            # Stored channel-last.
+            assert np.allclose(data['image'],
+                               np.moveaxis(images.numpy(), 1, -1),
+                               atol=1e-2)
+        # No temporary file is left behind.
+        for root, _, files in os.walk(store_dir):
+            assert not any(file.endswith('.tmp') for file in files), root
+
+
+def test_two_datasets_in_one_store(random_seed: int = 1) -> None:
+    rng = np.random.RandomState(random_seed)
+    images_a = torch.from_numpy(rng.randn(10, 3, 5, 5)).float()
+    # Same first batch, different remaining batches.
+    images_b = images_a.clone()
+    images_b[4:] = torch.from_numpy(rng.randn(6, 3, 5, 5)).float()
+    with tempfile.TemporaryDirectory() as store_dir:
+        write_group(store_dir, ['a_epoch0'], images_a, dataset='mnist')
+        write_group(store_dir, ['b_epoch0'], images_b, dataset='cifar10')
+        # The same images again: the existing image folder is reused.
+        write_group(store_dir, ['a_epoch1'], images_a, dataset='mnist')
+
+        assert len(os.listdir(os.path.join(store_dir, '_images'))) == 2
+        for name, images in [('a_epoch0', images_a), ('b_epoch0', images_b),
+                             ('a_epoch1', images_a)]:
+            data = load_embedding_store(os.path.join(store_dir, name),
+                                        fields=['image'])
+            assert np.allclose(data['image'],
+                               np.moveaxis(images.numpy(), 1, -1),
+                               atol=1e-2)
+
+
+def test_load_detects_changed_images(random_seed: int = 1) -> None:
+    images = torch.from_numpy(
+        np.random.RandomState(random_seed).randn(6, 3, 5, 5)).float()
+    with tempfile.TemporaryDirectory() as store_dir:
+        write_group(store_dir, ['epoch0'], images, dataset='mnist')
+        image_folder = os.path.join(store_dir, '_images',
+                                    os.listdir(os.path.join(store_dir, '_images'))[0])
+        manifest_path = os.path.join(image_folder, 'manifest.json')
+        with open(manifest_path) as f:
+            content = f.read()
+        with open(manifest_path, 'w') as f:
+            f.write(content.replace('"image_md5": "', '"image_md5": "0'))
+        try:
+            load_embedding_store(os.path.join(store_dir, 'epoch0'))
+        except ValueError:
+            return
+        raise AssertionError('Changed images were not detected.')
+
+
+if __name__ == '__main__':
+    test_round_trip()
+    test_two_datasets_in_one_store()
+    test_load_detects_changed_images()
+    print('Success')
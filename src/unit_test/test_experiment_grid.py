@@ -0,0 +1,94 @@
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
+sys.path.insert(0, import_dir + '/utils/')
+from experiment_grid import cached_dataset, grid_array, grid_cells, load_table, run_grid
+
+
+def square_cell(cell: dict, marker_dir: str) -> float:
+    '''
+    Task of the grid: records each call in `marker_dir`, fails for x = 3 if asked to.
+    '''
+    with open(os.path.join(marker_dir, 'x%d-rep%d' % (cell['x'], cell['rep'])),
+              'a') as f:
+        f.write('.')
+    if cell['x'] == 3 and os.path.isfile(os.path.join(marker_dir, 'fail')):
+        raise ValueError('Failing cell.')
+    return cell['x']**2 + cell['rep']
+
+
+def generate_arrays(n: int, seed: int):
+    rng = np.random.default_rng(seed)
+    return rng.normal(size=(n, 2)), rng.integers(0, 3, size=n)
+
+
+def test_run_grid_resume() -> None:
+    with tempfile.TemporaryDirectory() as folder:
+        table_path = os.path.join(folder, 'table.jsonl')
+        cells = grid_cells(x=np.arange(4), rep=range(2))
+
+        # A finished cell and a line truncated by a crash.
+        with open(table_path, 'w') as f:
+            f.write(json.dumps({'x': 0, 'rep': 0, 'value': 0.0}) + '\n')
+            f.write('{"x": 1, "rep": 0, "val')
+
+        open(os.path.join(folder, 'fail'), 'w').close()
+        rows = run_grid(cells=cells,
+                        task_fn=square_cell,
+                        table_path=table_path,
+                        num_workers=2,
+                        task_kwargs={'marker_dir': folder})
+        # The failed cells are left out of the table.
+        assert len(rows) == 6
+        assert not os.path.isfile(os.path.join(folder, 'x0-rep0'))
+
+        # Resume: only the failed cells are computed, once.
+        os.remove(os.path.join(folder, 'fail'))
+        rows = run_grid(cells=cells + grid_cells(x=[0], rep=[0]),
+                        task_fn=square_cell,
+                        table_path=table_path,
+                        num_workers=2,
+                        task_kwargs={'marker_dir': folder})
+        assert len(rows) == 8
+        for x in range(4):
+            for rep in range(2):
+                calls = os.path.join(folder, 'x%d-rep%d' % (x, rep))
+                if (x, rep) == (0, 0):
+                    assert not os.path.isfile(calls)
+                    continue
+                with open(calls) as f:
+                    assert len(f.read()) == (2 if x == 3 else 1)
+
+        values = grid_array(load_table(table_path), {
+            'x': range(4),
+            'rep': range(2)
+        })
+        assert np.array_equal(values, [[0, 1], [1, 2], [4, 5], [9, 10]])
+
+
+def test_cached_dataset_version() -> None:
+    with tempfile.TemporaryDirectory() as cache_dir:
+        X, Y = cached_dataset(cache_dir, generate_arrays, version='1', n=5, seed=0)
+        X_cached, Y_cached = cached_dataset(cache_dir,
+                                            generate_arrays,
+                                            version='1',
+                                            n=5,
+                                            seed=0)
+        assert np.array_equal(X, X_cached) and np.array_equal(Y, Y_cached)
+        assert len(os.listdir(cache_dir)) == 1
+
+        # A new version or new params never reuse the cached file.
+        cached_dataset(cache_dir, generate_arrays, version='2', n=5, seed=0)
+        cached_dataset(cache_dir, generate_arrays, version='2', n=6, seed=0)
+        assert len(os.listdir(cache_dir)) == 3
+
+
+if __name__ == '__main__':
+    test_run_grid_resume()
+    test_cached_dataset_version()
+    print('Success')
@@ -0,0 +1,90 @@
+import os
+import sys
+
+import numpy as np
+import torch
+
+import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
+sys.path.insert(0, import_dir + '/utils/')
+from fast_inference import accelerate_model, probe_batch
+
+
+class RandomShiftDataset(torch.utils.data.Dataset):
+    '''
+    Random transform drawn from the torch RNG, like `RandomResizedCrop`.
+    '''
+
+    def __len__(self):
+        return 20
+
+    def __getitem__(self, idx):
+        return torch.full((3, 2, 2), float(idx)) + torch.rand(1), idx
+
+
+class BatchDependentModel(torch.nn.Module):
+    '''
+    The traced graph bakes in the batch size (`torch.zeros(int(x.shape[0]), 1)`).
+    '''
+
+    def __init__(self):
+        super(BatchDependentModel, self).__init__()
+        self.linear = torch.nn.Linear(12, 4)
+
+    def encode(self, x: torch.Tensor) -> torch.Tensor:
+        h = self.linear(x.flatten(1))
+        return torch.cat((h, torch.zeros(int(x.shape[0]), 1)), dim=1)
+
+
+def dse_fn(Z: np.array) -> float:
+    return float(np.abs(Z).mean()) + 1
+
+
+def first_pass(loader: torch.utils.data.DataLoader) -> torch.Tensor:
+    return torch.cat([x for x, _ in loader])
+
+
+def test_probe_keeps_rng() -> None:
+    for num_workers in [0, 2]:
+        loader = torch.utils.data.DataLoader(RandomShiftDataset(),
+                                             batch_size=4,
+                                             shuffle=True,
+                                             num_workers=num_workers)
+        torch.manual_seed(0)
+        expected = first_pass(loader)
+
+        torch.manual_seed(0)
+        probe_x = probe_batch(loader, num_samples=6)
+        assert probe_x.shape == (6, 3, 2, 2)
+        assert torch.equal(first_pass(loader), expected)
+
+
+def test_fallback_on_batch_size() -> None:
+    torch.manual_seed(0)
+    model = BatchDependentModel().eval()
+    probe_x = torch.randn(8, 3, 2, 2)
+
+    accelerated, report = accelerate_model(model,
+                                           probe_x=probe_x,
+                                           dse_fn=dse_fn,
+                                           log_fn=lambda s: None)
+    assert report['accelerated']
+    # Smaller final batch: the graph fails, the fp32 model takes over.
+    x = torch.randn(3, 3, 2, 2)
+    h = accelerated.encode(x)
+    assert accelerated.failed
+    with torch.no_grad():
+        assert torch.allclose(h, model.encode(x))
+
+    # Built at the loader batch size, checked on the full probe batch.
+    _, report = accelerate_model(model,
+                                 probe_x=probe_x,
+                                 batch_size=4,
+                                 dse_fn=dse_fn,
+                                 log_fn=lambda s: None)
+    assert not report['accelerated']
+
+
+if __name__ == '__main__':
+    test_probe_keeps_rng()
+    test_fallback_on_batch_size()
+    print('Success')
@@ -0,0 +1,84 @@
+import os
+import sys
+import tempfile
+from glob import glob
+
+import numpy as np
+
+import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
+sys.path.insert(0, import_dir + '/utils/')
+from embedding_store import load_embedding_folder, load_npz_batches
+
+
+def write_batches(folder: str, batch_sizes: list, random_seed: int = 1,
+                  compressed: bool = False) -> None:
+    '''
+    `batch_XXXXX.npz` files as written by `save_numpy` (float16 labels).
+    '''
+    rng = np.random.RandomState(random_seed)
+    savez = np.savez_compressed if compressed else np.savez
+    for batch_idx, B in enumerate(batch_sizes):
+        with open(
+                os.path.join(folder,
+                             'batch_%s.npz' % str(batch_idx).zfill(5)),
+                'wb+') as f:
+            savez(f,
+                  image=rng.randn(B, 4, 4, 3).astype(np.float16),
+                  label_true=rng.randint(0, 10, size=B).astype(np.float16),
+                  embedding=rng.randn(B, 7).astype(np.float16))
+    return
+
+
+def load_with_vstack(folder: str) -> dict:
+    '''
+    The former loader: one `np.vstack` per batch.
+    '''
+    data = {}
+    for file in sorted(glob(os.path.join(folder, 'batch_*.npz'))):
+        with np.load(file) as npz_file:
+            for key in ['image', 'label_true', 'embedding']:
+                if key not in data:
+                    data[key] = npz_file[key]
+                elif key == 'label_true':
+                    data[key] = np.hstack((data[key], npz_file[key]))
+                else:
+                    data[key] = np.vstack((data[key], npz_file[key]))
+    data['label_true'] = data['label_true'].astype(np.int64)
+    return data
+
+
+def test_matches_vstack() -> None:
+    for compressed in [False, True]:
+        with tempfile.TemporaryDirectory() as folder:
+            # Uneven last batch.
+            write_batches(folder, [16, 16, 16, 5], compressed=compressed)
+            expected = load_with_vstack(folder)
+            for num_workers in [1, 4]:
+                data = load_npz_batches(folder, num_workers=num_workers)
+                for key in expected.keys():
+                    assert data[key].dtype == expected[key].dtype, key
+                    assert np.array_equal(data[key], expected[key]), key
+
+
+def test_requested_fields_only() -> None:
+    with tempfile.TemporaryDirectory() as folder:
+        write_batches(folder, [8, 3])
+        data = load_embedding_folder(folder, fields=('embedding', ))
+        assert list(data.keys()) == ['embedding']
+        assert data['embedding'].shape == (11, 7)
+
+
+def test_empty_folder() -> None:
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            load_npz_batches(folder)
+        except AssertionError:
+            return
+        raise AssertionError('An empty folder was not reported.')
+
+
+if __name__ == '__main__':
+    test_matches_vstack()
+    test_requested_fields_only()
+    test_empty_folder()
+    print('Success')
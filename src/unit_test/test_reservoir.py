@@ -0,0 +1,115 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
+sys.path.insert(0, import_dir + '/utils/')
+from reservoir import ReservoirMetrics, StratifiedReservoir
+
+
+def test_sample_before_add() -> None:
+    reservoir = StratifiedReservoir(num_classes=3, per_class=4)
+    Z, Y = reservoir.sample()
+    assert Z.shape[0] == 0 and Y.shape == (0, )
+
+
+def test_fill_and_bound(random_seed: int = 1) -> None:
+    rng = np.random.RandomState(random_seed)
+    reservoir = StratifiedReservoir(num_classes=3, per_class=4, seed=random_seed)
+    # Class 2 never appears, class 1 appears fewer than `per_class` times.
+    labels = np.array([0] * 50 + [1] * 2)
+    embeddings = rng.randn(len(labels), 5)
+    for start in range(0, len(labels), 7):
+        reservoir.add(torch.from_numpy(embeddings[start:start + 7]),
+                      torch.from_numpy(labels[start:start + 7]))
+    Z, Y = reservoir.sample()
+    assert Z.shape == (6, 5) and Z.dtype == np.float32
+    assert np.array_equal(Y, [0, 0, 0, 0, 1, 1])
+    # Every sampled row is one of the embeddings of its class.
+    for z, y in zip(Z, Y):
+        candidates = embeddings[labels == y].astype(np.float16)
+        assert np.any(np.all(candidates == z.astype(np.float16), axis=1))
+    # Sampled without replacement.
+    assert len(np.unique(Z[Y == 0], axis=0)) == 4
+
+    reservoir.reset()
+    reservoir.add(torch.from_numpy(embeddings[:1]), torch.zeros(1).long())
+    Z, Y = reservoir.sample()
+    assert Z.shape == (1, 5) and np.array_equal(Y, [0])
+
+
+def test_duplicate_slots_in_one_batch() -> None:
+    # A single large batch forces many arrivals to draw the same slot.
+    # The last arrival must win, as with sequential (one by one) sampling.
+    per_class, N = 2, 1000
+    embeddings = torch.arange(N, dtype=torch.float32)[:, None]
+    labels = torch.zeros(N, dtype=torch.int64)
+
+    batch_reservoir = StratifiedReservoir(num_classes=1,
+                                          per_class=per_class,
+                                          seed=0)
+    batch_reservoir.add(embeddings, labels)
+
+    # Same random draws (one per arrival), one arrival at a time.
+    draws = np.random.default_rng(0).random(N)
+    expected = [0, 1]
+    for arrival in range(per_class, N):
+        slot = int(np.floor(draws[arrival] * (arrival + 1)))
+        if slot < per_class:
+            expected[slot] = arrival
+    Z, _ = batch_reservoir.sample()
+    assert np.array_equal(Z[:, 0], expected), (Z[:, 0], expected)
+
+
+def test_uniformity(random_seed: int = 1) -> None:
+    # Each of the N embeddings is kept with probability per_class / N.
+    per_class, N, num_trials = 5, 20, 2000
+    counts = np.zeros(N)
+    for trial in range(num_trials):
+        reservoir = StratifiedReservoir(num_classes=1,
+                                        per_class=per_class,
+                                        seed=trial)
+        for start in range(0, N, 8):
+            reservoir.add(
+                torch.arange(start, min(N, start + 8),
+                             dtype=torch.float32)[:, None],
+                torch.zeros(min(N, start + 8) - start, dtype=torch.int64))
+        counts[reservoir.sample()[0][:, 0].astype(np.int64)] += 1
+    assert np.allclose(counts / num_trials, per_class / N, atol=0.05)
+
+
+def test_reservoir_metrics() -> None:
+    reservoir = StratifiedReservoir(num_classes=2, per_class=3)
+    reservoir_metrics = ReservoirMetrics(
+        reservoir,
+        dse_fn=lambda embedding_vectors, classic_shannon_entropy=False: float(
+            len(embedding_vectors)),
+        dsmi_fn=lambda embedding_vectors, reference_vectors,
+        classic_shannon_entropy=False: (float(reference_vectors.sum()), None))
+
+    # No train embedding in this epoch.
+    assert np.isnan(reservoir_metrics.end_epoch(epoch_idx=0)['dse_Z'])
+    reservoir.add(torch.zeros(5, 4), torch.tensor([0, 1, 1, 1, 1]))
+    metrics = reservoir_metrics.end_epoch(epoch_idx=1)
+    assert metrics['dse_Z'] == 4 and metrics['dsmi_Z_Y'] == 3
+    # The reservoir is reset at the end of each epoch.
+    assert len(reservoir.sample()[0]) == 0
+
+    with tempfile.TemporaryDirectory() as folder:
+        save_path = os.path.join(folder, 'train-results.npz')
+        reservoir_metrics.save(save_path)
+        with np.load(save_path) as npz_file:
+            assert np.array_equal(npz_file['epoch'], [0, 1])
+            assert npz_file['dse_Z'][1] == 4
+
+
+if __name__ == '__main__':
+    test_sample_before_add()
+    test_fill_and_bound()
+    test_duplicate_slots_in_one_batch()
+    test_uniformity()
+    test_reservoir_metrics()
+    print('Success')
@@ -0,0 +1,101 @@
+import os
+import sys
+import tempfile
+import time
+
+import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
+sys.path.insert(0, import_dir + '/utils/')
+from work_queue import ResultLedger, SkipTask, run_work_queue
+
+
+def echo_task(name: str, worker_id: int, marker_dir: str) -> dict:
+    '''
+    Task of the work queue: behavior selected by the task name.
+    '''
+    with open(os.path.join(marker_dir, name), 'a') as f:
+        f.write('.')
+    if name.startswith('skip'):
+        raise SkipTask('Skipped %s.' % name)
+    if name.startswith('fail'):
+        raise ValueError('Failed %s.' % name)
+    if name.startswith('crash'):
+        os._exit(3)
+    if name.startswith('hang'):
+        time.sleep(60)
+    return {'name': name, 'length': len(name)}
+
+
+def test_claim_and_recover() -> None:
+    with tempfile.TemporaryDirectory() as folder:
+        ledger = ResultLedger(os.path.join(folder, 'ledger.sqlite'))
+        ledger.add(['a', 'b', 'c'])
+        # Adding a task twice keeps its progress.
+        ledger.add(['a'])
+        assert ledger.counts() == {'pending': 3}
+
+        # Claimed in insertion order.
+        assert ledger.claim(worker_id=0) == 'a'
+        assert ledger.claim(worker_id=1) == 'b'
+        ledger.finish('a', {'accuracy': 0.5})
+        ledger.fail('b', 'failed', 'Traceback')
+        assert ledger.claim(worker_id=0) == 'c'
+        assert ledger.claim(worker_id=0) is None
+        assert ledger.counts() == {'done': 1, 'failed': 1, 'running': 1}
+
+        # A crashed supervisor left `c` running: it is pending again.
+        ledger = ResultLedger(ledger.path)
+        ledger.recover()
+        assert ledger.status('c') == 'pending'
+        assert ledger.status('b') == 'failed'
+        ledger.requeue(statuses=['failed'])
+        assert ledger.claim(worker_id=0) == 'b'
+        assert ledger.claim(worker_id=0) == 'c'
+        assert ledger.results() == [('a', {'accuracy': 0.5})]
+        assert ledger.status('missing') is None
+
+        ledger.reset()
+        assert ledger.counts() == {}
+
+
+def test_run_work_queue() -> None:
+    with tempfile.TemporaryDirectory() as folder:
+        ledger_path = os.path.join(folder, 'ledger.sqlite')
+        ledger = ResultLedger(ledger_path)
+        names = ['ok1', 'skip1', 'fail1', 'crash1', 'hang1', 'ok2']
+        ledger.add(names)
+        counts = run_work_queue(ledger_path,
+                                echo_task,
+                                num_workers=1,
+                                timeout=5,
+                                task_kwargs={'marker_dir': folder},
+                                poll_interval=0.05)
+        assert counts == {
+            'done': 2,
+            'skipped': 1,
+            'failed': 2,
+            'timeout': 1
+        }, counts
+        assert ledger.results() == [('ok1', {
+            'name': 'ok1',
+            'length': 3
+        }), ('ok2', {
+            'name': 'ok2',
+            'length': 3
+        })]
+
+        # Nothing is pending: a second run does not start any task.
+        counts = run_work_queue(ledger_path,
+                                echo_task,
+                                num_workers=1,
+                                task_kwargs={'marker_dir': folder},
+                                poll_interval=0.05)
+        assert counts['done'] == 2
+        for name in names:
+            with open(os.path.join(folder, name)) as f:
+                assert f.read() == '.'
+
+
+if __name__ == '__main__':
+    test_claim_and_recover()
+    test_run_work_queue()
+    print('Success')
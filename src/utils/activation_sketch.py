@@ -0,0 +1,137 @@
+import math
+from typing import Dict, Tuple
+
+import torch
+
+
+class ActivationSketch(object):
+    '''
+    Compresses intermediate activations on the fly, such that
+    block-by-block DSE/DSMI does not need to store the full flattened activations.
+    Meant to be called inside a forward hook, before moving the activations off the device.
+
+    mode:
+        'none':
+            Flatten only. [B, ...] -> [B, D].
+        'pool':
+            Adaptive average pooling over the spatial/token dimensions,
+            to at most `dim` features whenever the number of channels allows it.
+            [B, C, H, W] -> [B, C * g * g], g = floor(sqrt(dim / C)) (at least 1).
+            [B, T, C] -> [B, C].
+            NOTE: This is a different feature map, not an approximation of the flattened
+            activations. Distances (and therefore DSE/DSMI under a fixed kernel sigma)
+            are not preserved.
+        'jl':
+            Sparse Johnson-Lindenstrauss projection to exactly `dim` features.
+            [B, ...] -> [B, D] -> [B, dim].
+
+    Distance distortion of 'jl':
+        For N points, a random projection to
+            k >= 4 ln(N) / (eps^2 / 2 - eps^3 / 3)
+        dimensions preserves every pairwise squared distance within a factor of (1 +/- eps)
+        with high probability (Dasgupta & Gupta, 2003). This is the bound implemented in
+        `sklearn.random_projection.johnson_lindenstrauss_min_dim`, also see `jl_min_dim` below.
+        The sparse construction (Kane & Nelson, 2014) puts `nnz_per_column` non-zeros of value
+        +/- 1/sqrt(nnz_per_column) in each column, one per row block, which keeps
+        E[||Rx||^2] = ||x||^2 and attains the same bound up to constants.
+        Examples (N = 10000):  k = 1024 -> eps ~= 0.30,  k = 2048 -> eps ~= 0.21,  k = 4096 -> eps ~= 0.14.
+        Since the distances are preserved at their original scale, the Gaussian kernel
+        (and hence the diffusion matrix) used by DSE/DSMI is perturbed entry-wise
+        by a multiplicative factor within exp(+/- eps * d^2 / (2 sigma^2)).
+
+    The projection matrix is drawn from a fixed seed and cached per (input dim, device),
+    so the same block is sketched identically across batches and across epochs.
+    '''
+
+    def __init__(self,
+                 mode: str = 'none',
+                 dim: int = 1024,
+                 seed: int = 0,
+                 nnz_per_column: int = 4,
+                 channels_last: bool = False):
+        assert mode in ['none', 'pool', 'jl'], \
+            '`ActivationSketch`: mode (%s) not supported.' % mode
+        if mode == 'jl':
+            assert dim % nnz_per_column == 0, \
+                '`ActivationSketch`: `dim` must be divisible by `nnz_per_column`.'
+        self.mode = mode
+        self.dim = dim
+        self.seed = seed
+        self.nnz_per_column = nnz_per_column
+        self.channels_last = channels_last
+        self.projections: Dict[Tuple[int, str], torch.Tensor] = {}
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if self.mode == 'pool':
+            return self._pool(x)
+        x = x.reshape(x.shape[0], -1)
+        if self.mode == 'jl':
+            return self._project(x)
+        return x
+
+    def _pool(self, x: torch.Tensor) -> torch.Tensor:
+        if x.dim() == 4:
+            if self.channels_last:
+                # [B, H, W, C] -> [B, C, H, W]
+                x = x.permute(0, 3, 1, 2)
+            C = x.shape[1]
+            g = max(1, int(math.floor(math.sqrt(self.dim / C))))
+            g = min(g, x.shape[2], x.shape[3])
+            x = torch.nn.functional.adaptive_avg_pool2d(x, output_size=(g, g))
+        elif x.dim() == 3:
+            # Token sequence [B, T, C]: average over the tokens.
+            x = x.mean(dim=1)
+        return x.reshape(x.shape[0], -1)
+
+    def _project(self, x: torch.Tensor) -> torch.Tensor:
+        D = x.shape[1]
+        key = (D, str(x.device))
+        if key not in self.projections:
+            self.projections[key] = sparse_jl_matrix(
+                in_dim=D,
+                out_dim=self.dim,
+                nnz_per_column=self.nnz_per_column,
+                seed=self.seed).to(x.device)
+        R = self.projections[key]
+        # [dim, D] @ [D, B] -> [dim, B]
+        return torch.sparse.mm(R, x.float().T).T
+
+
+def sparse_jl_matrix(in_dim: int,
+                     out_dim: int,
+                     nnz_per_column: int = 4,
+                     seed: int = 0) -> torch.Tensor:
+    '''
+    Sparse Johnson-Lindenstrauss matrix of shape [out_dim, in_dim] (Kane & Nelson, 2014).
+
+    The rows are split into `nnz_per_column` blocks. Each column has exactly one non-zero
+    per block, at a random row, with a random sign and magnitude 1/sqrt(nnz_per_column).
+    Memory is O(in_dim * nnz_per_column) instead of O(in_dim * out_dim).
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    block_size = out_dim // nnz_per_column
+
+    rows = torch.randint(0,
+                         block_size, (nnz_per_column, in_dim),
+                         generator=generator)
+    rows = rows + torch.arange(nnz_per_column)[:, None] * block_size
+    cols = torch.arange(in_dim)[None, :].expand(nnz_per_column, in_dim)
+    signs = torch.randint(0, 2, (nnz_per_column, in_dim),
+                          generator=generator).float() * 2 - 1
+    values = signs / math.sqrt(nnz_per_column)
+
+    R = torch.sparse_coo_tensor(indices=torch.stack(
+        (rows.reshape(-1), cols.reshape(-1))),
+                                values=values.reshape(-1),
+                                size=(out_dim, in_dim))
+    return R.coalesce().to_sparse_csr()
+
+
+def jl_min_dim(n_samples: int, eps: float = 0.3) -> int:
+    '''
+    Minimum sketch dimension to preserve all pairwise distances among `n_samples`
+    points within (1 +/- eps) with high probability (Dasgupta & Gupta, 2003).
+    '''
+    assert 0 < eps < 1
+    return int(
+        math.ceil(4 * math.log(n_samples) / (eps**2 / 2 - eps**3 / 3)))
@@ -0,0 +1,168 @@
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
+
+import numpy as np
+
+
+class AsyncMetricsWorker(object):
+    '''
+    Computes expensive metrics (e.g., DSE/DSMI) in background processes,
+    so that the training loop does not wait for them.
+
+    The arrays handed to `submit` are copied once into shared memory and
+    the worker process reads them from there, instead of pickling them.
+    Arrays that are the same for every submission (e.g., the reference data
+    of DSMI) can be handed to `share` instead: they are copied once per run
+    and passed to every later submission.
+
+    At most `max_pending` submissions are kept alive at any time.
+    When the queue is full, `submit` blocks until the oldest one finishes,
+    which caps the memory held by not-yet-computed epochs.
+
+    Usage:
+        worker = AsyncMetricsWorker(num_workers=1, max_pending=2)
+        worker.share(arrays={...})  # optional
+        worker.submit(key=epoch_idx, fn=compute_metrics, arrays={...}, **kwargs)
+        for epoch_idx, result in worker.collect():
+            ...
+        for epoch_idx, result in worker.collect(block=True):
+            ...
+        worker.close()
+
+    NOTE: `fn` must be picklable, i.e., defined at the top level of a module.
+    Its result must not hold views of its input arrays (the shared memory is
+    closed before the result is sent back).
+    '''
+
+    def __init__(self, num_workers: int = 1, max_pending: int = 2):
+        assert num_workers >= 1
+        assert max_pending >= 1
+        self.max_pending = max_pending
+        # `spawn` avoids forking a process that already holds torch/OpenMP threads.
+        self.executor = ProcessPoolExecutor(max_workers=num_workers,
+                                            mp_context=get_context('spawn'))
+        self.pending = deque()
+        self.finished = deque()
+        self.shared_handles, self.shared_descriptors = [], {}
+
+    def share(self, arrays: Dict[str, Union[np.array,
+                                            List[np.array]]]) -> None:
+        '''
+        Copy `arrays` into shared memory once. They are passed to `fn` by every later
+        `submit` (unless overridden by its own `arrays`), until `close`.
+        '''
+        for name, value in arrays.items():
+            self.shared_descriptors[name] = _to_shared_memory(
+                value, self.shared_handles)
+        return
+
+    def submit(self, key: Any, fn: Callable,
+               arrays: Dict[str, Union[np.array, List[np.array]]],
+               **kwargs) -> None:
+        '''
+        Schedule `fn(**arrays, **kwargs)` in a worker process.
+        `key` (e.g., the epoch index) is returned alongside the result by `collect`.
+        '''
+        while len(self.pending) >= self.max_pending:
+            # Bounded queue: wait for the oldest submission to free its memory.
+            self._finish_oldest()
+
+        handles, descriptors = [], dict(self.shared_descriptors)
+        for name, value in arrays.items():
+            descriptors[name] = _to_shared_memory(value, handles)
+
+        future = self.executor.submit(_run_on_shared_memory, fn, descriptors,
+                                      kwargs)
+        self.pending.append((key, future, handles))
+        return
+
+    def collect(self, block: bool = False) -> Iterator[Tuple[Any, Any]]:
+        '''
+        Yield (key, result) in submission order.
+        If `block` is False, stop at the first submission that is not done yet.
+        If `block` is True, wait for all outstanding submissions.
+        '''
+        while len(self.pending) > 0 and (block or self.pending[0][1].done()):
+            self._finish_oldest()
+        while len(self.finished) > 0:
+            yield self.finished.popleft()
+
+    def close(self) -> None:
+        for _ in self.collect(block=True):
+            pass
+        self.executor.shutdown(wait=True)
+        for shm in self.shared_handles:
+            shm.close()
+            shm.unlink()
+        self.shared_handles, self.shared_descriptors = [], {}
+        return
+
+    def _finish_oldest(self) -> None:
+        key, future, handles = self.pending.popleft()
+        try:
+            result = future.result()
+        finally:
+            for shm in handles:
+                shm.close()
+                shm.unlink()
+        self.finished.append((key, result))
+        return
+
+
+def _to_shared_memory(value: Union[np.array, List[np.array]],
+                      handles: List[shared_memory.SharedMemory]):
+    '''
+    Copy an array (or a list of arrays) into shared memory.
+    Returns a picklable descriptor from which the worker can rebuild the array.
+    '''
+    if isinstance(value, (list, tuple)):
+        return [_to_shared_memory(item, handles) for item in value]
+
+    value = np.ascontiguousarray(value)
+    # Zero-sized shared memory blocks are not allowed.
+    shm = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+    np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)[...] = value
+    handles.append(shm)
+    return (shm.name, value.shape, value.dtype.str)
+
+
+def _from_shared_memory(descriptor, handles: List[shared_memory.SharedMemory]):
+    if isinstance(descriptor, list):
+        return [_from_shared_memory(item, handles) for item in descriptor]
+
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    handles.append(shm)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _run_on_shared_memory(fn: Callable, descriptors: Dict, kwargs: Dict):
+    '''
+    Entry point inside the worker process.
+    '''
+    handles = []
+    arrays = {
+        name: _from_shared_memory(descriptor, handles)
+        for (name, descriptor) in descriptors.items()
+    }
+    try:
+        result = fn(**arrays, **kwargs)
+    except BaseException as e:
+        # The frames of `fn` in the traceback hold views of the shared memory.
+        traceback.clear_frames(e.__traceback__)
+        raise
+    finally:
+        # The views must be released before the shared memory can be closed.
+        del arrays
+        for shm in handles:
+            try:
+                shm.close()
+            except BufferError:
+                # A view is still alive: do not let this error replace
+                # the result or the exception of `fn`.
+                # The mapping is released with the process.
+                pass
+    return result
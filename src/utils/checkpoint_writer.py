@@ -0,0 +1,128 @@
+import os
+import queue
+import shutil
+import threading
+import uuid
+from collections import defaultdict, deque
+from typing import Dict
+
+import torch
+
+
+class CheckpointWriter(object):
+    '''
+    Writes checkpoints from a background thread, so that the training loop
+    only pays for copying the state dict to CPU memory.
+
+    Each `save` call is serialized once. Checkpoints that hold the same weights
+    (e.g., the percentile checkpoints saved together with the best checkpoint) are
+    registered with `link`, which hard-links the already written file instead of
+    calling `torch.save` again. Operations run in the order they were queued.
+    Files are written under a temporary name and atomically renamed,
+    so a crash never leaves a truncated checkpoint behind.
+
+    Retention:
+        Checkpoints saved with a `retention_group` are pruned to the `keep_last` most recent ones
+        of that group. Checkpoints without a group are never removed.
+        `keep_last=None` keeps everything.
+
+    Usage:
+        writer = CheckpointWriter(keep_last=5)
+        writer.save(model.state_dict(), best_path)
+        writer.link(best_path, pct_path)
+        writer.save(model.state_dict(), epoch_path, retention_group='epoch')
+        writer.close()
+    '''
+
+    def __init__(self, keep_last: int = None, max_pending: int = 2):
+        assert keep_last is None or keep_last >= 1
+        self.keep_last = keep_last
+        # Bounded queue: caps the number of CPU snapshots held in memory.
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.retention: Dict[str, deque] = defaultdict(deque)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self,
+             state_dict: Dict[str, torch.Tensor],
+             path: str,
+             retention_group: str = None) -> None:
+        '''
+        Snapshot `state_dict` to CPU memory now, and write it to `path` in the background.
+        '''
+        self._raise_if_failed()
+        snapshot = {
+            key: value.detach().to('cpu', copy=True)
+            if isinstance(value, torch.Tensor) else value
+            for (key, value) in state_dict.items()
+        }
+        self.queue.put((self._write, (snapshot, path, retention_group)))
+        return
+
+    def link(self, source_path: str, path: str) -> None:
+        '''
+        Make `path` a hard link to `source_path`, once the queued writes are done.
+        '''
+        self._raise_if_failed()
+        self.queue.put((self._link, (source_path, path)))
+        return
+
+    def wait(self) -> None:
+        '''
+        Block until every queued checkpoint is on disk.
+        '''
+        self.queue.join()
+        self._raise_if_failed()
+        return
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_if_failed()
+        return
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, snapshot: Dict[str, torch.Tensor], path: str,
+               retention_group: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        torch.save(snapshot, tmp_path)
+        os.replace(tmp_path, path)
+
+        if retention_group is not None and self.keep_last is not None:
+            history = self.retention[retention_group]
+            history.append(path)
+            while len(history) > self.keep_last:
+                stale_path = history.popleft()
+                if stale_path not in history and os.path.exists(stale_path):
+                    os.remove(stale_path)
+        return
+
+    def _link(self, source_path: str, path: str) -> None:
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            os.link(source_path, tmp_path)
+        except OSError:
+            # Hard links not supported (e.g., across file systems).
+            shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, path)
+        return
+
+    def _raise_if_failed(self) -> None:
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('`CheckpointWriter`: failed to write checkpoint.') from error
@@ -0,0 +1,242 @@
+import copy
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import uuid
+from typing import Tuple
+
+import numpy as np
+import torch
+import torchvision
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from extend import ExtendedDataset
+
+
+class DecodedDatasetCache(Dataset):
+    '''
+    Decodes and deterministically resizes every image of a dataset split once,
+    and stores the results in a single memory-mapped uint8 array.
+
+    The deterministic part of the pipeline is
+        Resize(imsize, bicubic) -> CenterCrop(imsize),
+    which is exactly what the training scripts do for square images
+    (MNIST, CIFAR-10, STL-10, TinyImageNet). For non-square images (ImageNet),
+    the random augmentations only see the center square.
+
+    The random augmentations then run on uint8 tensors read from the array,
+    see `tensor_fast_path`, without going through PIL.
+
+    The cache is keyed by `name`, the real path of the data root `dataset_dir`,
+    the dataset type, its length and `imsize`.
+
+    Layout:
+        `cache_dir`/`name`-`imsize`-`hash`/
+            meta.json
+            images.npy    uint8, [N, imsize, imsize, C]
+            targets.npy   int64, [N,]
+
+    `targets` is exposed as an attribute, such that `CorruptLabelDataLoader` can permute it.
+    With `keep_transform=False`, the raw uint8 [C, H, W] tensors are returned,
+    e.g., for batched augmentations in the `collate_fn`.
+    '''
+
+    def __init__(self,
+                 dataset: Dataset,
+                 cache_dir: str,
+                 name: str,
+                 dataset_dir: str,
+                 imsize: int = 224,
+                 num_workers: int = 0,
+                 keep_transform: bool = True):
+        self.imsize = imsize
+        self.transform = None
+        if keep_transform:
+            self.transform = tensor_fast_path(
+                getattr(dataset, 'transform', None), imsize=imsize)
+
+        signature = '%s|%s|%s|%d|%d' % (name, os.path.realpath(dataset_dir),
+                                        type(dataset).__name__, len(dataset),
+                                        imsize)
+        digest = hashlib.md5(signature.encode()).hexdigest()[:12]
+        self.folder = os.path.join(cache_dir,
+                                   '%s-%d-%s' % (name, imsize, digest))
+
+        if not os.path.isfile(os.path.join(self.folder, 'meta.json')):
+            self._build(dataset=dataset,
+                        signature=signature,
+                        num_workers=num_workers)
+
+        self.images = np.load(os.path.join(self.folder, 'images.npy'),
+                              mmap_mode='r')
+        self.targets = np.load(os.path.join(self.folder, 'targets.npy'))
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def __getitem__(self, idx) -> Tuple[torch.Tensor, int]:
+        # [H, W, C] uint8 -> [C, H, W] uint8
+        x = torch.from_numpy(np.array(self.images[idx])).permute(2, 0, 1)
+        if self.transform is not None:
+            x = self.transform(x)
+        return x, int(self.targets[idx])
+
+    def _build(self, dataset: Dataset, signature: str,
+               num_workers: int) -> None:
+        # Build in a temporary folder and rename it at the end,
+        # such that concurrent runs never see a half-written cache.
+        tmp_folder = '%s.%s.tmp' % (self.folder, uuid.uuid4().hex)
+        os.makedirs(tmp_folder)
+
+        # Decode the raw images, without the random augmentations.
+        original_transform = dataset.transform
+        dataset.transform = _DeterministicResize(imsize=self.imsize)
+        try:
+            loader = torch.utils.data.DataLoader(dataset,
+                                                 batch_size=256,
+                                                 num_workers=num_workers,
+                                                 shuffle=False)
+            N = len(dataset)
+            images, targets = None, None
+            start = 0
+            for x, y in tqdm(loader, desc='Building dataset cache'):
+                if images is None:
+                    images = np.lib.format.open_memmap(
+                        os.path.join(tmp_folder, 'images.npy'),
+                        mode='w+',
+                        dtype=np.uint8,
+                        shape=(N, *x.shape[1:]))
+                    targets = np.lib.format.open_memmap(
+                        os.path.join(tmp_folder, 'targets.npy'),
+                        mode='w+',
+                        dtype=np.int64,
+                        shape=(N, ))
+                B = x.shape[0]
+                images[start:start + B] = x.numpy()
+                targets[start:start + B] = np.array(y)
+                start += B
+            assert start == N
+            images.flush()
+            targets.flush()
+            shape = images.shape
+            del images, targets
+        finally:
+            dataset.transform = original_transform
+
+        with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+            json.dump({'signature': signature, 'shape': shape}, f)
+
+        os.makedirs(os.path.dirname(self.folder), exist_ok=True)
+        try:
+            os.rename(tmp_folder, self.folder)
+        except OSError:
+            # Another run has built the same cache in the meantime.
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+        return
+
+
+class _DeterministicResize(object):
+    '''
+    PIL image -> uint8 array [imsize, imsize, C].
+    '''
+
+    def __init__(self, imsize: int):
+        self.transform = torchvision.transforms.Compose([
+            torchvision.transforms.Resize(
+                imsize,
+                interpolation=torchvision.transforms.InterpolationMode.BICUBIC),
+            torchvision.transforms.CenterCrop(imsize),
+        ])
+
+    def __call__(self, x) -> np.array:
+        x = np.array(self.transform(x), dtype=np.uint8)
+        if x.ndim == 2:
+            x = x[..., None]
+        return x
+
+
+def cache_dataset(dataset: Dataset,
+                  cache_dir: str,
+                  name: str,
+                  dataset_dir: str,
+                  imsize: int = 224,
+                  num_workers: int = 0,
+                  keep_transform: bool = True) -> Dataset:
+    '''
+    Replace `dataset` by its `DecodedDatasetCache`, keeping its transform.
+    `ExtendedDataset` is kept as the outer wrapper.
+    '''
+    if isinstance(dataset, ExtendedDataset):
+        return ExtendedDataset(cache_dataset(dataset.dataset,
+                                             cache_dir=cache_dir,
+                                             name=name,
+                                             dataset_dir=dataset_dir,
+                                             imsize=imsize,
+                                             num_workers=num_workers,
+                                             keep_transform=keep_transform),
+                               desired_len=dataset.desired_len)
+    return DecodedDatasetCache(dataset,
+                               cache_dir=cache_dir,
+                               name=name,
+                               dataset_dir=dataset_dir,
+                               imsize=imsize,
+                               num_workers=num_workers,
+                               keep_transform=keep_transform)
+
+
+def tensor_fast_path(transform, imsize: int):
+    '''
+    Adapt a PIL transform pipeline to uint8 [C, H, W] tensors that are already
+    resized to `imsize` x `imsize`:
+        `Resize(imsize)` is dropped (identity on the cached images).
+        `ToTensor` becomes `ConvertImageDtype(torch.float32)` (same [0, 1] scaling).
+        PIL-only `GaussianBlur` becomes `TensorGaussianBlur`.
+    Everything else in torchvision already supports tensors.
+    Recurses into `Compose`, `RandomApply` and objects holding an `augmentation` pipeline
+    (e.g., `SingleInstanceTwoView`).
+    '''
+    T = torchvision.transforms
+    if transform is None:
+        return None
+    if isinstance(transform, T.Compose):
+        converted = [tensor_fast_path(t, imsize) for t in transform.transforms]
+        return T.Compose([t for t in converted if t is not None])
+    if isinstance(transform, T.RandomApply):
+        return T.RandomApply(
+            [tensor_fast_path(t, imsize) for t in transform.transforms],
+            p=transform.p)
+    if isinstance(transform, T.Resize) and transform.size in [
+            imsize, [imsize], (imsize, )
+    ]:
+        return None
+    if isinstance(transform, T.ToTensor):
+        return T.ConvertImageDtype(torch.float32)
+    if type(transform).__name__ == 'GaussianBlur' and hasattr(
+            transform, 'sigma') and not isinstance(transform, T.GaussianBlur):
+        return TensorGaussianBlur(sigma=transform.sigma)
+    if hasattr(transform, 'augmentation'):
+        transform = copy.copy(transform)
+        transform.augmentation = tensor_fast_path(transform.augmentation,
+                                                  imsize)
+        return transform
+    return transform
+
+
+class TensorGaussianBlur(object):
+    '''
+    Tensor counterpart of the PIL `GaussianBlur` in `simclr.py`:
+    random sigma in [sigma[0], sigma[1]], kernel covering +/- 3 sigma.
+    '''
+
+    def __init__(self, sigma=[0.1, 2.0]):
+        self.sigma = sigma
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        sigma = random.uniform(self.sigma[0], self.sigma[1])
+        kernel_size = 2 * math.ceil(3 * sigma) + 1
+        return torchvision.transforms.functional.gaussian_blur(
+            x, kernel_size=kernel_size, sigma=sigma)
@@ -69,11 +69,26 @@ def compute_diffusion_matrix(X: np.array, sigma: float = 10.0):
     D = pairwise_distances(X)
 
     # Gaussian kernel
-    G = (1 / (sigma * np.sqrt(2 * np.pi))) * np.exp((-D**2) / (2 * sigma**2))
+    G = gaussian_kernel(D, sigma=sigma)
 
-    # Anisotropic density normalization.
-    Deg = np.diag(1 / np.sum(G, axis=1)**0.5)
-    K = Deg @ G @ Deg
+    return normalize_kernel(G)
+
+
+def gaussian_kernel(D: np.array, sigma: float = 10.0):
+    '''
+    Gaussian kernel of the distance matrix `D`, as in `compute_diffusion_matrix`.
+    '''
+    return (1 / (sigma * np.sqrt(2 * np.pi))) * np.exp((-D**2) / (2 * sigma**2))
+
+
+def normalize_kernel(G: np.array):
+    '''
+    Anisotropic density normalization of the kernel `G`, as in `compute_diffusion_matrix`.
+    '''
+    # Deg @ G @ Deg with Deg = diag(1 / sqrt(row sums)),
+    # applied by broadcasting instead of two dense N x N matrix products.
+    deg = 1 / np.sum(G, axis=1)**0.5
+    K = deg[:, None] * G * deg[None, :]
 
     # Now K has the exact same eigenvalues as the diffusion matrix `P`
     # which is defined as `P = D^{-1} K`, with `D = np.diag(np.sum(K, axis=1))`.
@@ -0,0 +1,392 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+import torch
+
+MANIFEST_NAME = 'manifest.json'
+SHARED_IMAGE_FOLDER = '_images'
+
+
+class EmbeddingStoreWriter(object):
+    '''
+    Columnar replacement for the per-batch `batch_XXXXX.npz` files of `save_numpy`.
+
+    Each field of a checkpoint is one preallocated, memory-mappable `.npy` file,
+    filled batch by batch in place:
+        `store_dir`/`name`/
+            embedding.npy       [N, D], `np_dtype`
+            label_true.npy      [N,], int64
+            manifest.json
+        `store_dir`/_images/`image_key`/
+            image.npy           [N, H, W, C] (channel-last), `np_dtype`
+            manifest.json
+
+    The val images are the same for every checkpoint of a val split, so they are
+    stored once and referenced by the manifest of every checkpoint.
+    Their folder is content-addressed: `image_key` hashes `split_signature`
+    (e.g., dataset, split, transform) together with the md5 of all the images.
+    Another val split (or a changed one) gets its own folder, and an existing image
+    folder is never overwritten. Each checkpoint manifest records the md5 of its
+    images, checked by `load_embedding_store`.
+
+    Files are written under temporary names and renamed in `close()`, manifest last,
+    so a folder with a manifest always holds complete data.
+
+    When several checkpoints are written in the same pass over the val set,
+    only one writer needs the images: the others get `image_batch=None`
+    and are closed after it with `close(image_writer=<that writer>)`.
+
+    Usage:
+        writer = EmbeddingStoreWriter(store_dir, name, num_samples=len(val_set),
+                                      split_signature={'dataset': ..., 'split': 'val', ...})
+        for x, y_true in val_loader:
+            ...
+            writer.append(image_batch=x, label_true_batch=y_true, embedding_batch=h)
+        writer.close()
+    '''
+
+    def __init__(self,
+                 store_dir: str,
+                 name: str,
+                 num_samples: int,
+                 save_images: bool = True,
+                 split_signature: Dict = None,
+                 np_dtype: np.dtype = np.float16):
+        self.store_dir = store_dir
+        self.folder = os.path.join(store_dir, name)
+        self.num_samples = num_samples
+        self.save_images = save_images
+        self.split_signature = {} if split_signature is None else split_signature
+        self.np_dtype = np_dtype
+        self.suffix = '.%s.tmp' % uuid.uuid4().hex
+        self.tmp_image_folder = os.path.join(store_dir, SHARED_IMAGE_FOLDER,
+                                             'tmp%s' % self.suffix)
+
+        self.arrays: Dict[str, np.memmap] = {}
+        self.write_images = None
+        self.image_md5 = hashlib.md5()
+        # Set by `close()` once the images are stored.
+        self.image_key = None
+        self.cursor = 0
+        os.makedirs(self.folder, exist_ok=True)
+
+    def append(self, image_batch: torch.Tensor,
+               label_true_batch: torch.Tensor,
+               embedding_batch: torch.Tensor) -> None:
+        label_true_batch = label_true_batch.cpu().detach().numpy().astype(
+            np.int64)
+        embedding_batch = embedding_batch.cpu().detach().numpy().astype(
+            self.np_dtype)
+        B = embedding_batch.shape[0]
+        assert self.cursor + B <= self.num_samples, \
+            '`EmbeddingStoreWriter`: more samples than `num_samples` (%d).' % self.num_samples
+
+        if self.write_images is None:
+            self.write_images = self.save_images and image_batch is not None
+        if self.write_images:
+            assert image_batch is not None, \
+                '`EmbeddingStoreWriter`: `image_batch` missing after the first batch.'
+            image_batch = image_batch.cpu().detach().numpy().astype(
+                self.np_dtype)
+            # channel-first to channel-last
+            image_batch = np.ascontiguousarray(np.moveaxis(image_batch, 1, -1))
+            self.image_md5.update(image_batch.tobytes())
+            self._field('image', image_batch,
+                        self.tmp_image_folder)[self.cursor:self.cursor +
+                                               B] = image_batch
+
+        self._field('label_true', label_true_batch,
+                    self.folder)[self.cursor:self.cursor +
+                                 B] = label_true_batch
+        self._field('embedding', embedding_batch,
+                    self.folder)[self.cursor:self.cursor + B] = embedding_batch
+        self.cursor += B
+        return
+
+    def close(self, image_writer: 'EmbeddingStoreWriter' = None) -> None:
+        '''
+        `image_writer`: the (already closed) writer of the same data pass that
+        stored the images, if this one got `image_batch=None`.
+        '''
+        assert self.cursor == self.num_samples, \
+            '`EmbeddingStoreWriter`: %d samples written, %d expected.' % (
+                self.cursor, self.num_samples)
+
+        for key in list(self.arrays.keys()):
+            array = self.arrays.pop(key)
+            array.flush()
+            del array
+            if key != 'image':
+                path = os.path.join(self.folder, '%s.npy' % key)
+                os.replace(path + self.suffix, path)
+
+        fields = {}
+        manifest = {'num_samples': self.num_samples}
+        if self.save_images:
+            if self.write_images:
+                self._store_images()
+            elif image_writer is not None and image_writer is not self:
+                assert image_writer.image_key is not None, \
+                    '`EmbeddingStoreWriter`: close the `image_writer` first.'
+                assert image_writer.num_samples == self.num_samples
+                self.image_key = image_writer.image_key
+                self.image_md5 = image_writer.image_md5
+            else:
+                raise ValueError(
+                    '`EmbeddingStoreWriter`: no images written for %s '
+                    'and no `image_writer` provided.' % self.folder)
+            image_folder = os.path.join(self.store_dir, SHARED_IMAGE_FOLDER,
+                                        self.image_key)
+            image_info = _field_info(image_folder, 'image')
+            image_info['file'] = os.path.relpath(
+                os.path.join(image_folder, image_info['file']), self.folder)
+            fields['image'] = image_info
+            manifest['image_md5'] = self.image_md5.hexdigest()
+        fields['label_true'] = _field_info(self.folder, 'label_true')
+        fields['embedding'] = _field_info(self.folder, 'embedding')
+        manifest['fields'] = fields
+
+        _write_manifest(self.folder, manifest)
+        return
+
+    def _store_images(self) -> None:
+        '''
+        Move the images to their content-addressed folder, unless identical images are there already.
+        '''
+        image_md5 = self.image_md5.hexdigest()
+        self.image_key = hashlib.md5(
+            json.dumps(
+                {
+                    'split_signature': self.split_signature,
+                    'image_md5': image_md5,
+                },
+                sort_keys=True,
+                default=str).encode()).hexdigest()
+        image_folder = os.path.join(self.store_dir, SHARED_IMAGE_FOLDER,
+                                    self.image_key)
+
+        os.replace(
+            os.path.join(self.tmp_image_folder, 'image.npy') + self.suffix,
+            os.path.join(self.tmp_image_folder, 'image.npy'))
+        _write_manifest(
+            self.tmp_image_folder, {
+                'num_samples': self.num_samples,
+                'image_md5': image_md5,
+                'split_signature': self.split_signature,
+                'fields': {
+                    'image': _field_info(self.tmp_image_folder, 'image')
+                },
+            })
+        if os.path.isfile(os.path.join(image_folder, MANIFEST_NAME)):
+            shutil.rmtree(self.tmp_image_folder)
+            return
+        try:
+            os.rename(self.tmp_image_folder, image_folder)
+        except OSError:
+            # Stored concurrently by another writer (or a leftover incomplete folder).
+            if not os.path.isfile(os.path.join(image_folder, MANIFEST_NAME)):
+                shutil.rmtree(image_folder)
+                os.rename(self.tmp_image_folder, image_folder)
+            else:
+                shutil.rmtree(self.tmp_image_folder)
+        return
+
+    def _field(self, key: str, batch: np.array, folder: str) -> np.memmap:
+        if key not in self.arrays:
+            os.makedirs(folder, exist_ok=True)
+            self.arrays[key] = np.lib.format.open_memmap(
+                os.path.join(folder, '%s.npy' % key) + self.suffix,
+                mode='w+',
+                dtype=batch.dtype,
+                shape=(self.num_samples, *batch.shape[1:]))
+        return self.arrays[key]
+
+
+def is_embedding_store(folder: str) -> bool:
+    return os.path.isfile(os.path.join(folder, MANIFEST_NAME))
+
+
+def folder_fingerprint(folder: str) -> str:
+    '''
+    Changes whenever a file of the embedding folder is added, removed or rewritten,
+    including the shared image file referenced by the manifest of a store folder.
+    '''
+    files = sorted(os.listdir(folder))
+    if is_embedding_store(folder):
+        with open(os.path.join(folder, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        files += sorted(
+            os.path.normpath(field['file'])
+            for field in manifest['fields'].values()
+            if os.path.dirname(os.path.normpath(field['file'])) != '')
+    stats = [(file, os.stat(os.path.join(folder, file))) for file in files]
+    return hashlib.md5(
+        str([(file, stat.st_size, stat.st_mtime_ns)
+             for (file, stat) in stats]).encode()).hexdigest()
+
+
+def load_embedding_store(
+        folder: str,
+        fields: Iterable[str] = ('image', 'label_true', 'embedding')
+) -> Dict[str, np.memmap]:
+    '''
+    Read-only, zero-copy views (memory maps) of the requested fields of
+    one checkpoint folder written by `EmbeddingStoreWriter`.
+    '''
+    with open(os.path.join(folder, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+
+    data = {}
+    for key in fields:
+        if key not in manifest['fields']:
+            raise KeyError('`load_embedding_store`: field `%s` not in %s.' %
+                           (key, folder))
+        path = os.path.join(folder, manifest['fields'][key]['file'])
+        if key == 'image':
+            _check_images(path, manifest)
+        data[key] = np.load(path, mmap_mode='r')
+        assert data[key].shape[0] == manifest['num_samples']
+    return data
+
+
+def load_embedding_folder(
+        folder: str,
+        fields: Iterable[str] = ('image', 'label_true', 'embedding'),
+        num_workers: int = 8) -> Dict[str, np.array]:
+    '''
+    Shared loader for the embedding folder of one checkpoint, in either format:
+        `EmbeddingStoreWriter` store: zero-copy memory maps (read-only).
+        `save_numpy` batch_XXXXX.npz files: read in parallel (see `load_npz_batches`).
+
+    Only the requested `fields` are read. `label_true` is always returned as int64.
+    '''
+    if is_embedding_store(folder):
+        return load_embedding_store(folder, fields=fields)
+    return load_npz_batches(folder, fields=fields, num_workers=num_workers)
+
+
+def load_npz_batches(folder: str,
+                     fields: Iterable[str] = ('image', 'label_true',
+                                              'embedding'),
+                     num_workers: int = 8) -> Dict[str, np.array]:
+    '''
+    Read the `batch_XXXXX.npz` files of `save_numpy` into one array per field.
+
+    The output arrays are sized from the npy headers inside the npz files and
+    preallocated once. The members are then read by a thread pool straight
+    into their row range of the output, instead of growing the arrays with
+    `np.vstack` once per batch (quadratic in the number of batches).
+    '''
+    files = sorted(glob(os.path.join(folder, 'batch_*.npz')))
+    assert len(files) > 0, \
+        '`load_npz_batches`: no batch_*.npz file in %s.' % folder
+    fields = list(fields)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        headers = list(
+            executor.map(lambda file: _npz_headers(file, fields), files))
+
+        data, offsets = {}, {}
+        for key in fields:
+            shapes = [header[key][0] for header in headers]
+            assert all(shape[1:] == shapes[0][1:] for shape in shapes), \
+                '`load_npz_batches`: inconsistent shapes of `%s` in %s.' % (key, folder)
+            dtype = np.int64 if key == 'label_true' else headers[0][key][1]
+            data[key] = np.empty(
+                (sum(shape[0] for shape in shapes), *shapes[0][1:]),
+                dtype=dtype)
+            offsets[key] = np.cumsum([0] + [shape[0] for shape in shapes])
+
+        jobs = [(file, key, data[key][offsets[key][i]:offsets[key][i + 1]])
+                for (i, file) in enumerate(files) for key in fields]
+        for _ in executor.map(lambda job: _read_npz_member_into(*job), jobs):
+            pass
+    return data
+
+
+def label_names(labels: np.array, int2name: Dict[int, str]) -> np.array:
+    '''
+    Map integer labels to their names with one vectorized lookup (object dtype).
+    '''
+    lookup = np.empty(max(int2name.keys()) + 1, dtype='object')
+    for (i, name) in int2name.items():
+        lookup[i] = name
+    return lookup[np.asarray(labels).astype(np.int64)]
+
+
+def _npz_headers(file: str,
+                 fields: Iterable[str]) -> Dict[str, Tuple[Tuple, np.dtype]]:
+    headers = {}
+    with zipfile.ZipFile(file) as zf:
+        for key in fields:
+            with zf.open('%s.npy' % key) as f:
+                shape, _, dtype = _read_npy_header(f)
+            headers[key] = (shape, dtype)
+    return headers
+
+
+def _read_npy_header(f) -> Tuple[Tuple, bool, np.dtype]:
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def _read_npz_member_into(file: str, key: str, out: np.array) -> None:
+    with zipfile.ZipFile(file) as zf, zf.open('%s.npy' % key) as f:
+        shape, fortran_order, dtype = _read_npy_header(f)
+        if dtype == out.dtype and not fortran_order:
+            buffer = memoryview(out).cast('B')
+            num_read = 0
+            while num_read < buffer.nbytes:
+                n = f.readinto(buffer[num_read:])
+                assert n > 0, '`load_npz_batches`: truncated %s in %s.' % (
+                    key, file)
+                num_read += n
+        else:
+            # e.g., float16 labels into the int64 output.
+            out[...] = np.frombuffer(f.read(), dtype=dtype).reshape(
+                shape, order='F' if fortran_order else 'C')
+    return
+
+
+def _check_images(path: str, manifest: Dict) -> None:
+    '''
+    The shared images referenced by a checkpoint manifest must be the ones it was written with.
+    '''
+    with open(os.path.join(os.path.dirname(path), MANIFEST_NAME)) as f:
+        image_manifest = json.load(f)
+    if manifest.get('image_md5') is None or \
+            image_manifest.get('image_md5') != manifest['image_md5']:
+        raise ValueError(
+            '`load_embedding_store`: the images in %s do not match the manifest '
+            '(md5 %s vs %s).' % (os.path.dirname(path),
+                                 image_manifest.get('image_md5'),
+                                 manifest.get('image_md5')))
+    return
+
+
+def _field_info(folder: str, key: str) -> Dict:
+    array = np.load(os.path.join(folder, '%s.npy' % key), mmap_mode='r')
+    return {
+        'file': '%s.npy' % key,
+        'dtype': str(array.dtype),
+        'shape': list(array.shape),
+    }
+
+
+def _write_manifest(folder: str, manifest: Dict) -> None:
+    path = os.path.join(folder, MANIFEST_NAME)
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+    return
@@ -0,0 +1,190 @@
+import hashlib
+import itertools
+import json
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+
+def grid_cells(**axes: Iterable) -> List[Dict]:
+    '''
+    Declarative experiment grid: one cell (dict) per combination of the axes, e.g.,
+        grid_cells(dim=[20, 100], noise_level=[0.01, 0.1], method=['DSMI'], rep=range(2))
+    Several grids can be concatenated; duplicate cells are only run once by `run_grid`.
+    '''
+    names = list(axes.keys())
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*[_plain(list(axes[name]))
+                                          for name in names])
+    ]
+
+
+def cell_key(cell: Dict) -> str:
+    return json.dumps(_plain(cell), sort_keys=True)
+
+
+def load_table(table_path: str) -> List[Dict]:
+    '''
+    Rows of a tidy JSONL table (one JSON object per line) written by `run_grid`.
+    A truncated last line (crash while writing) is ignored.
+    '''
+    if not os.path.isfile(table_path):
+        return []
+    rows = []
+    with open(table_path) as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                pass
+    return rows
+
+
+def run_grid(cells: List[Dict],
+             task_fn: Callable,
+             table_path: str,
+             num_workers: int = 1,
+             task_kwargs: Dict = None,
+             value_key: str = 'value') -> List[Dict]:
+    '''
+    Compute the missing cells of an experiment grid and return the whole table.
+
+    Each cell is a task `task_fn(cell, **task_kwargs) -> float`, run in a pool of
+    `num_workers` (spawned) processes; `task_fn` must be defined at the top level of a module
+    (or of a `__main__` script guarded by `if __name__ == '__main__'`).
+    Each result is appended to the tidy table `table_path` as soon as it is available:
+    one JSON line per cell, {**cell, `value_key`: result}.
+
+    The cells already in the table are skipped, so a crashed or extended sweep
+    only computes what is missing. A failed cell is reported and left out of
+    the table, i.e., retried by the next run.
+    '''
+    task_kwargs = {} if task_kwargs is None else task_kwargs
+    done = set(
+        cell_key({k: v
+                  for (k, v) in row.items() if k != value_key})
+        for row in load_table(table_path))
+    pending = []
+    for cell in cells:
+        key = cell_key(cell)
+        if key not in done:
+            done.add(key)
+            pending.append(cell)
+    print('`run_grid`: %d cells, %d to compute.' % (len(cells), len(pending)))
+
+    if len(pending) > 0:
+        _drop_partial_line(table_path)
+        with open(table_path, 'a') as f, ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=get_context('spawn')) as executor:
+            futures = {
+                executor.submit(task_fn, cell, **task_kwargs): cell
+                for cell in pending
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                cell = futures[future]
+                try:
+                    value = future.result()
+                except Exception as e:
+                    print('`run_grid`: cell %s failed with %s.' %
+                          (cell_key(cell), repr(e)))
+                    continue
+                row = dict(_plain(cell))
+                row[value_key] = float(value)
+                f.write(json.dumps(row) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    return load_table(table_path)
+
+
+def grid_array(rows: List[Dict],
+               axes: Dict[str, Iterable],
+               value_key: str = 'value',
+               **fixed) -> np.array:
+    '''
+    Gather the rows that match `fixed` into an array with one dimension per axis,
+    e.g., grid_array(rows, {'dim': dim_list, 'rep': range(2)}, method='DSMI') -> [len(dim_list), 2].
+    Missing cells are NaN.
+    '''
+    names = list(axes.keys())
+    positions = {
+        name: {value: i
+               for (i, value) in enumerate(_plain(list(axes[name])))}
+        for name in names
+    }
+    fixed = _plain(fixed)
+    array = np.full([len(positions[name]) for name in names], np.nan)
+    for row in rows:
+        if any(row.get(k) != v for (k, v) in fixed.items()):
+            continue
+        try:
+            index = tuple(positions[name][row[name]] for name in names)
+        except KeyError:
+            continue
+        array[index] = row[value_key]
+    return array
+
+
+def cached_dataset(cache_dir: str,
+                   generate_fn: Callable,
+                   version: str,
+                   **params) -> Tuple[np.array, ...]:
+    '''
+    `generate_fn(**params)` (a tuple of arrays), computed once and stored in
+    `cache_dir` as an npz file named after the function, `version` and the params.
+    `generate_fn` must be deterministic given `params` (i.e., seeded by them).
+
+    The cache cannot see what `generate_fn` does: bump `version` whenever the
+    generated data change (e.g., a constant of the generator), or stale data are reused.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    key = cell_key({'version': version, 'params': params})
+    path = os.path.join(
+        cache_dir, '%s-%s.npz' %
+        (generate_fn.__name__, hashlib.md5(key.encode()).hexdigest()[:16]))
+    if os.path.isfile(path):
+        with np.load(path) as npz_file:
+            return tuple(npz_file['arr_%d' % i]
+                         for i in range(len(npz_file.files)))
+
+    arrays = generate_fn(**params)
+    # Concurrent writers of the same dataset are harmless: the rename is atomic.
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb+') as f:
+        np.savez(f, *arrays)
+    os.replace(tmp_path, path)
+    return tuple(arrays)
+
+
+def _plain(value):
+    '''
+    numpy scalars -> Python scalars (recursively), so that cells are JSON-serializable
+    and compare equal to the rows read back from the table.
+    '''
+    if isinstance(value, dict):
+        return {k: _plain(v) for (k, v) in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _drop_partial_line(table_path: str) -> None:
+    '''
+    Remove a truncated last line before appending to the table.
+    '''
+    if not os.path.isfile(table_path):
+        return
+    with open(table_path, 'rb+') as f:
+        content = f.read()
+        if len(content) > 0 and not content.endswith(b'\n'):
+            f.truncate(content.rfind(b'\n') + 1)
+    return
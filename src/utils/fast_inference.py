@@ -0,0 +1,234 @@
+import copy
+from typing import Callable, Tuple
+
+import numpy as np
+import torch
+
+
+class AcceleratedModel(object):
+    '''
+    Inference-only stand-in for a model with `encode` / `forward_with_latent`,
+    backed by an accelerated graph (see `accelerate_model`).
+
+    Inputs are converted to channels_last when the graph was built for it,
+    and every call runs under `torch.inference_mode`.
+
+    If the graph fails on an input (e.g., a traced graph that baked in a batch-dependent shape),
+    this and every later call run the fp32 `fallback_model` instead.
+    '''
+
+    def __init__(self,
+                 graph: Callable,
+                 fallback_model: torch.nn.Module,
+                 with_logits: bool,
+                 channels_last: bool,
+                 log_fn: Callable[[str], None] = print):
+        self.graph = graph
+        self.fallback = _LatentGraph(fallback_model, with_logits=with_logits)
+        self.with_logits = with_logits
+        self.channels_last = channels_last
+        self.log_fn = log_fn
+        self.failed = False
+
+    def eval(self):
+        return self
+
+    def _run(self, x: torch.Tensor):
+        with torch.inference_mode():
+            if not self.failed:
+                try:
+                    if self.channels_last and x.dim() == 4:
+                        return self.graph(
+                            x.contiguous(memory_format=torch.channels_last))
+                    return self.graph(x)
+                except Exception as e:
+                    self.failed = True
+                    self.log_fn(
+                        '`AcceleratedModel`: graph failed on input of shape %s: %s '
+                        'Using the fp32 model from now on.' %
+                        (tuple(x.shape), repr(e)))
+            return self.fallback(x)
+
+    def encode(self, x: torch.Tensor) -> torch.Tensor:
+        if self.with_logits:
+            return self._run(x)[1]
+        return self._run(x)
+
+    def forward_with_latent(self, x: torch.Tensor, blocks=None):
+        assert self.with_logits, \
+            '`AcceleratedModel`: built with `with_logits=False`.'
+        assert blocks is None, \
+            '`AcceleratedModel`: block outputs are not available in the accelerated graph.'
+        y, h = self._run(x)
+        return y, h, []
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        assert self.with_logits, \
+            '`AcceleratedModel`: built with `with_logits=False`.'
+        return self._run(x)[0]
+
+
+class _LatentGraph(torch.nn.Module):
+    '''
+    Single-output (or pair-output) module for tracing:
+    the embedding, or (logits, embedding) if `with_logits`.
+    A plain module without `encode` is its own encoder.
+    '''
+
+    def __init__(self, model: torch.nn.Module, with_logits: bool):
+        super(_LatentGraph, self).__init__()
+        self.model = model
+        self.with_logits = with_logits
+
+    def forward(self, x: torch.Tensor):
+        if self.with_logits:
+            y, h, _ = self.model.forward_with_latent(x)
+            return y, h
+        if hasattr(self.model, 'encode'):
+            return self.model.encode(x)
+        return self.model(x)
+
+
+def accelerate_model(model: torch.nn.Module,
+                     probe_x: torch.Tensor,
+                     backend: str = 'trace',
+                     quantize_int8: bool = False,
+                     with_logits: bool = False,
+                     batch_size: int = None,
+                     dse_fn: Callable[[np.array], float] = None,
+                     tolerance: float = 0.01,
+                     log_fn: Callable[[str], None] = print
+                     ) -> Tuple[object, dict]:
+    '''
+    Fast CPU inference mode for embedding extraction.
+
+    Builds an accelerated copy of `model` (which is left untouched):
+        - optional dynamic int8 quantization of the Linear layers (`quantize_int8`),
+        - channels_last memory format,
+        - `backend`: 'trace' (torch.jit.trace + torch.jit.freeze) or 'compile' (torch.compile),
+        - `torch.inference_mode` at call time.
+
+    The graph is built on the first `batch_size` inputs of `probe_x` (the batch size of the
+    loader it will run on, default: all of `probe_x`). The fidelity check below runs it
+    on the full probe batch, so a graph that does not generalize to another batch size
+    is caught here. At run time, `AcceleratedModel` falls back to the fp32 model if the graph fails.
+
+    Fidelity check: our downstream quantity is DSE, not accuracy.
+    DSE (`dse_fn`, default: `probe_dse`) of the embeddings of the probe batch `probe_x`
+    is computed with the original fp32 model and with the accelerated one.
+    If the relative deviation exceeds `tolerance`, or the accelerated
+    model cannot be built, the original model is returned instead.
+
+    Only for CPU models: on any other device the original model is returned as is.
+
+    Returns (model to use, report).
+    '''
+    assert backend in ['trace', 'compile']
+    if dse_fn is None:
+        dse_fn = probe_dse
+    device = next(model.parameters()).device
+    report = {'accelerated': False, 'backend': backend, 'int8': quantize_int8}
+    if device.type != 'cpu':
+        report['reason'] = 'Model on %s, fast inference mode is CPU only.' % device
+        log_fn('`accelerate_model`: %s' % report['reason'])
+        return model, report
+
+    model.eval()
+    probe_x = probe_x.to(device)
+    with torch.inference_mode():
+        h_ref = _LatentGraph(model, with_logits=False)(probe_x)
+
+    try:
+        accelerated = copy.deepcopy(model).eval()
+        if quantize_int8:
+            accelerated = torch.ao.quantization.quantize_dynamic(
+                accelerated, {torch.nn.Linear}, dtype=torch.qint8)
+        channels_last = probe_x.dim() == 4
+        example_x = probe_x if batch_size is None else probe_x[:batch_size]
+        if channels_last:
+            accelerated = accelerated.to(memory_format=torch.channels_last)
+            example_x = example_x.contiguous(memory_format=torch.channels_last)
+
+        graph = _LatentGraph(accelerated, with_logits=with_logits).eval()
+        if backend == 'trace':
+            # Tracing needs regular (non-inference) tensors.
+            with torch.no_grad():
+                graph = torch.jit.freeze(
+                    torch.jit.trace(graph, example_x, check_trace=False))
+        else:
+            graph = torch.compile(graph)
+
+        accelerated_model = AcceleratedModel(graph,
+                                             fallback_model=model,
+                                             with_logits=with_logits,
+                                             channels_last=channels_last,
+                                             log_fn=log_fn)
+        h_acc = accelerated_model.encode(probe_x)
+        if accelerated_model.failed:
+            raise RuntimeError('The graph failed on the probe batch.')
+    except Exception as e:
+        report['reason'] = 'Failed to build the accelerated model: %s' % repr(e)
+        log_fn('`accelerate_model`: %s Using the fp32 model.' % report['reason'])
+        return model, report
+
+    h_ref = h_ref.reshape(h_ref.shape[0], -1).float().numpy()
+    h_acc = h_acc.reshape(h_acc.shape[0], -1).float().numpy()
+    if h_ref.shape != h_acc.shape:
+        report['reason'] = 'Embedding shape mismatch: %s vs %s.' % (
+            h_ref.shape, h_acc.shape)
+        log_fn('`accelerate_model`: %s Using the fp32 model.' % report['reason'])
+        return model, report
+
+    dse_ref, dse_acc = dse_fn(h_ref), dse_fn(h_acc)
+    deviation = np.abs(dse_acc - dse_ref) / max(np.abs(dse_ref), 1e-12)
+    report.update({
+        'dse_fp32': float(dse_ref),
+        'dse_accelerated': float(dse_acc),
+        'relative_deviation': float(deviation),
+    })
+    if deviation > tolerance:
+        report['reason'] = 'DSE deviation %.4f > tolerance %.4f.' % (
+            deviation, tolerance)
+        log_fn('`accelerate_model`: %s Using the fp32 model.' % report['reason'])
+        return model, report
+
+    report['accelerated'] = True
+    log_fn('`accelerate_model`: %s%s model, DSE %.4f (fp32: %.4f).' %
+           (backend, ' + int8' if quantize_int8 else '', dse_acc, dse_ref))
+    return accelerated_model, report
+
+
+def probe_dse(embeddings: np.array) -> float:
+    '''
+    DSE (t = 1) of a small probe set, with sigma = sqrt(D) as in `metric_vs_acc.py`.
+    '''
+    from diffusion import compute_diffusion_matrix
+
+    K = compute_diffusion_matrix(embeddings,
+                                 sigma=np.sqrt(embeddings.shape[-1]))
+    eigenvalues = np.abs(np.linalg.eigvalsh(K).astype(np.float64))
+    prob = eigenvalues / eigenvalues.sum() + np.finfo(float).eps
+    return -np.sum(prob * np.log2(prob))
+
+
+def probe_batch(loader: torch.utils.data.DataLoader,
+                num_samples: int = 256,
+                in_channels: int = 3) -> torch.Tensor:
+    '''
+    The first `num_samples` inputs of `loader`, as the probe set of `accelerate_model`.
+
+    The global torch RNG state is restored afterwards: iterating the loader draws its
+    base seed (and, without workers, the random transforms) from it, and the evaluation
+    pass must see the same random crops whether or not a probe was taken.
+    '''
+    batches, count = [], 0
+    with torch.random.fork_rng(devices=[]):
+        for x, _ in loader:
+            if in_channels == 1:
+                # Repeat the channel dimension: 1 channel -> 3 channels.
+                x = x.repeat(1, 3, 1, 1)
+            batches.append(x)
+            count += x.shape[0]
+            if count >= num_samples:
+                break
+    return torch.cat(batches)[:num_samples]
@@ -0,0 +1,78 @@
+import gc
+from typing import Callable, Dict, List
+
+import torch
+from tqdm import tqdm
+
+from embedding_store import EmbeddingStoreWriter, is_embedding_store
+
+
+def extract_features_multi_model(model_fns: Dict[str, Callable],
+                                 loader: torch.utils.data.DataLoader,
+                                 device: torch.device,
+                                 store_dir: str,
+                                 in_channels: int = 3,
+                                 models_per_pass: int = None) -> List[str]:
+    '''
+    Run several frozen encoders over the same data, streaming each batch once
+    through all of them, and write the embeddings of each model to the embedding store
+    (`store_dir`/`name`/, see `EmbeddingStoreWriter`; images are not stored).
+
+    model_fns:
+        name -> function that builds the model, ready to `encode`.
+        Models are built lazily, only for the pass that uses them, and released right after.
+    models_per_pass:
+        Maximum number of models held in memory at the same time.
+        The data is decoded once per pass, i.e. ceil(#models / models_per_pass) times.
+        None: all models in one pass.
+
+    Models whose embeddings are already in the store are skipped.
+    Returns the names of the models that were run.
+    '''
+    pending = [
+        name for name in model_fns.keys()
+        if not is_embedding_store('%s/%s' % (store_dir, name))
+    ]
+    if models_per_pass is None:
+        models_per_pass = max(1, len(pending))
+
+    for group_start in range(0, len(pending), models_per_pass):
+        names = pending[group_start:group_start + models_per_pass]
+        models = [model_fns[name]() for name in names]
+        for model in models:
+            model.eval()
+        writers = [
+            EmbeddingStoreWriter(store_dir=store_dir,
+                                 name=name,
+                                 num_samples=len(loader.dataset),
+                                 save_images=False) for name in names
+        ]
+
+        with torch.no_grad():
+            for x, y_true in tqdm(loader,
+                                  desc='Extracting features (%d models)' %
+                                  len(names)):
+                assert in_channels in [1, 3]
+                if in_channels == 1:
+                    # Repeat the channel dimension: 1 channel -> 3 channels.
+                    x = x.repeat(1, 3, 1, 1)
+                x = x.to(device, non_blocking=True)
+
+                for model, writer in zip(models, writers):
+                    h = model.encode(x)
+                    # shape: [B, d, 1, 1] -> [B, d]
+                    h = h.reshape(h.shape[0], -1)
+                    writer.append(image_batch=None,
+                                  label_true_batch=y_true,
+                                  embedding_batch=h)
+
+        for writer in writers:
+            writer.close()
+
+        # Release the models of this pass before building the next ones.
+        del models
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    return pending
@@ -0,0 +1,133 @@
+import fcntl
+import json
+import os
+import uuid
+from typing import Callable, Dict, Iterable, Tuple
+
+import numpy as np
+import torch
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def load_image_cache(cache_dir: str,
+                     key: str,
+                     build_dataset: Callable[[], torch.utils.data.Dataset],
+                     batch_size: int = 64,
+                     num_workers: int = 8) -> Dict[str, np.memmap]:
+    '''
+    Decoded, preprocessed images stored once as uint8 and read back as memory maps:
+        `cache_dir`/`key`/
+            image.npy       [N, C, H, W], uint8
+            label.npy       [N,], int64
+            manifest.json
+
+    `key` identifies the preprocessing (e.g., resolution, crop, interpolation).
+    If the cache does not exist yet, `build_dataset()` is called and must return
+    a dataset of (uint8 image tensor [C, H, W], label), with a deterministic transform.
+    It is decoded once with `num_workers` loader workers.
+
+    Several processes may ask for the same cache: the first one builds it
+    (under a file lock) while the others wait, then all of them read it.
+    Files are written under temporary names and renamed, manifest last.
+    '''
+    folder = os.path.join(cache_dir, key)
+    os.makedirs(cache_dir, exist_ok=True)
+    if not os.path.isfile(os.path.join(folder, MANIFEST_NAME)):
+        with open(os.path.join(cache_dir, '%s.lock' % key), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.isfile(os.path.join(folder, MANIFEST_NAME)):
+                    _build_image_cache(folder=folder,
+                                       dataset=build_dataset(),
+                                       batch_size=batch_size,
+                                       num_workers=num_workers)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    with open(os.path.join(folder, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    return {
+        field: np.load(os.path.join(folder, '%s.npy' % field), mmap_mode='r')
+        for field in manifest['fields']
+    }
+
+
+def _build_image_cache(folder: str, dataset: torch.utils.data.Dataset,
+                       batch_size: int, num_workers: int) -> None:
+    os.makedirs(folder, exist_ok=True)
+    suffix = '.%s.tmp' % uuid.uuid4().hex
+    loader = torch.utils.data.DataLoader(dataset,
+                                         batch_size=batch_size,
+                                         num_workers=num_workers,
+                                         shuffle=False)
+    arrays, cursor = {}, 0
+    for image_batch, label_batch in loader:
+        assert image_batch.dtype == torch.uint8, \
+            '`load_image_cache`: images must be uint8 tensors.'
+        batch = {
+            'image': image_batch.numpy(),
+            'label': label_batch.numpy().astype(np.int64),
+        }
+        for field, value in batch.items():
+            if field not in arrays:
+                arrays[field] = np.lib.format.open_memmap(
+                    os.path.join(folder, '%s.npy' % field) + suffix,
+                    mode='w+',
+                    dtype=value.dtype,
+                    shape=(len(dataset), *value.shape[1:]))
+            arrays[field][cursor:cursor + len(value)] = value
+        cursor += len(image_batch)
+    assert cursor == len(dataset)
+
+    fields = {}
+    for field in list(arrays.keys()):
+        array = arrays.pop(field)
+        fields[field] = {'dtype': str(array.dtype), 'shape': list(array.shape)}
+        array.flush()
+        del array
+        path = os.path.join(folder, '%s.npy' % field)
+        os.replace(path + suffix, path)
+
+    manifest_path = os.path.join(folder, MANIFEST_NAME)
+    with open(manifest_path + suffix, 'w') as f:
+        json.dump({'num_samples': cursor, 'fields': fields}, f, indent=2)
+    os.replace(manifest_path + suffix, manifest_path)
+    return
+
+
+class CachedImageLoader(object):
+    '''
+    Iterates over uint8 images of `load_image_cache` in order, as
+    (normalized float32 batch [B, C, H, W], label batch), like a val DataLoader
+    without any decoding or resizing.
+    '''
+
+    def __init__(self, images: np.array, labels: np.array, batch_size: int,
+                 mean: Iterable[float], std: Iterable[float]):
+        self.images = images
+        self.labels = labels
+        self.batch_size = batch_size
+        self.mean = torch.tensor(mean, dtype=torch.float32).reshape(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).reshape(1, -1, 1, 1)
+
+    def __len__(self) -> int:
+        return (len(self.images) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self) -> Iterable[Tuple[torch.Tensor, torch.Tensor]]:
+        for start in range(0, len(self.images), self.batch_size):
+            yield (normalize_uint8(self.images[start:start + self.batch_size],
+                                   mean=self.mean,
+                                   std=self.std),
+                   torch.from_numpy(
+                       np.array(self.labels[start:start + self.batch_size])))
+
+
+def normalize_uint8(images: np.array, mean: torch.Tensor,
+                    std: torch.Tensor) -> torch.Tensor:
+    '''
+    uint8 [B, C, H, W] -> (x / 255 - mean) / std, float32.
+    '''
+    # `np.array` copies the (read-only) memory map slice.
+    x = torch.from_numpy(np.array(images)).float().div_(255)
+    return x.sub_(mean).div_(std)
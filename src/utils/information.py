@@ -1,9 +1,10 @@
 from typing import Dict
 
 import numpy as np
+from sklearn.metrics import pairwise_distances
 from tqdm import tqdm
 import random
-from diffusion import compute_diffusion_matrix
+from diffusion import compute_diffusion_matrix, gaussian_kernel, normalize_kernel
 from DiffusionEMD.diffusion_emd import estimate_dos
 from log_utils import log
 
@@ -39,25 +40,39 @@ def simple_bin(cond_x: np.array, num_digit: int):
     return assignments, cnts
 
 
-def comp_diffusion_embedding(X: np.array, sigma: float = 10.0):
+def comp_diffusion_embedding(X: np.array,
+                             sigma: float = 10.0,
+                             num_spectral: int = None):
     '''
         Compute diffusion embedding of X
     Args:
         X: [N, D]
+        num_spectral: number of leading diffusion components to compute.
+            If None (or >= N - 1), all N components are computed.
 
     Returns:
-        diff_embed: [N, N]
+        diff_embed: [N, num_spectral] (or [N, N])
     '''
-    # Diffusion matrix
+    # Diffusion matrix (symmetric)
     diffusion_matrix = compute_diffusion_matrix(X, sigma=sigma)
-    eigenvalues_P, eigenvectors_P = np.linalg.eig(diffusion_matrix)
+    N = diffusion_matrix.shape[0]
+
+    if num_spectral is None or num_spectral >= N - 1:
+        eigenvalues_P, eigenvectors_P = np.linalg.eigh(diffusion_matrix)
+    else:
+        # Only the top `num_spectral` eigenpairs (Lanczos).
+        from scipy.sparse.linalg import eigsh
+        eigenvalues_P, eigenvectors_P = eigsh(diffusion_matrix,
+                                              k=num_spectral,
+                                              which='LA')
 
     # Sort eigenvalues
     sorted_idx = np.argsort(eigenvalues_P)[::-1]
     eigenvalues_P = eigenvalues_P[sorted_idx]
     eigenvectors_P = eigenvectors_P[:, sorted_idx]
-    # Diffusion map embedding
-    diff_embed = eigenvectors_P @ np.diag((eigenvalues_P**0.5))
+    # Diffusion map embedding: scale each column by sqrt(eigenvalue).
+    # The kernel is PSD, so negative eigenvalues are only rounding errors.
+    diff_embed = eigenvectors_P * np.maximum(eigenvalues_P, 0)[None, :]**0.5
 
     return diff_embed
 
@@ -162,7 +177,8 @@ def mutual_information(orig_x: np.array,
         if num_spectral is None:
             num_spectral = min(cond_x.shape[1], cond_x.shape[0])
         if diff_embed is None:
-            diff_embed = comp_diffusion_embedding(X=cond_x)
+            diff_embed = comp_diffusion_embedding(X=cond_x,
+                                                  num_spectral=num_spectral)
 
         # Top components
         diff_embed = diff_embed[:, :num_spectral]
@@ -500,39 +516,45 @@ def mutual_information_per_class_append(embeddings: np.array,
     '''
         I(Z;Y) = H(Z) + H(Y) - H(Z,Y)
 
+        H(Y) and H(Z, Y) are the entropies of the one-hot label embeddings
+        and of [Z, one-hot label embeddings]. Neither is built explicitly:
+            H(Y): closed form from the class counts (`label_diffusion_eigvals`).
+            H(Z, Y): ||[z_i, y_i] - [z_j, y_j]||^2 = ||z_i - z_j||^2 + 2 * [y_i != y_j],
+                so the joint kernel is the kernel of Z with the cross-class entries
+                scaled by exp(-1 / sigma^2), which reuses the distance matrix of Z.
+
     Args:
         embeddings (Z): [N,D]
         labels (Y): [N,1]
     Returns:
         mi: scaler
     '''
+    labels = np.asarray(labels).reshape(-1)
+
+    if joint_entropy is None or z_entropy is None:
+        # Gaussian kernel of Z, shared by H(Z) and H(Z, Y).
+        kernel_Z = gaussian_kernel(pairwise_distances(embeddings), sigma=sigma)
+
     if joint_entropy is None:
-        N, D = embeddings.shape
-        num_classes = int(np.max(labels) + 1)
-        # One hot embedding for labels
-        labels_embeds = np.zeros((N, num_classes))
-        labels_embeds[np.arange(N), labels[:, 0]] = 1
-
-        # H(Z, Y) by appending one-hot label embeds to the Z
-        joint_embeds = np.hstack((embeddings, labels_embeds))
+        same_class = labels[:, None] == labels[None, :]
+        kernel_joint = kernel_Z * np.where(same_class, 1, np.exp(-1 / sigma**2))
         # Diffusion Matrix
-        diffusion_matrix = compute_diffusion_matrix(joint_embeds, sigma=sigma)
+        diffusion_matrix = normalize_kernel(kernel_joint)
+        del kernel_joint
         # Eigenvalues
         eigenvalues_P = exact_eigvals(diffusion_matrix)
         # Von Neumann Entropy
         joint_entropy = von_neumann_entropy(eigenvalues_P, t=vne_t)
 
     if y_entropy is None:
-        # Diffusion Matrix
-        diffusion_matrix = compute_diffusion_matrix(labels_embeds, sigma=sigma)
         # Eigenvalues
-        eigenvalues_P = exact_eigvals(diffusion_matrix)
+        eigenvalues_P = label_diffusion_eigvals(labels, sigma=sigma)
         # Von Neumann Entropy
         y_entropy = von_neumann_entropy(eigenvalues_P, t=vne_t)
 
     if z_entropy is None:
         # Diffusion Matrix
-        diffusion_matrix = compute_diffusion_matrix(embeddings, sigma=sigma)
+        diffusion_matrix = normalize_kernel(kernel_Z)
         # Eigenvalues
         eigenvalues_P = exact_eigvals(diffusion_matrix)
         # Von Neumann Entropy
@@ -543,6 +565,29 @@ def mutual_information_per_class_append(embeddings: np.array,
     return mi
 
 
+def label_diffusion_eigvals(labels: np.array, sigma: float = 10.0):
+    '''
+    Eigenvalues of `compute_diffusion_matrix` on the one-hot embeddings of `labels`,
+    in closed form.
+
+    The one-hot kernel is block-constant: G = g * (U M U^T), with U the [N, C] class
+    indicator and M = (1 - a) I + a 11^T, a = exp(-1 / sigma^2).
+    Its normalized version has rank C, and its nonzero eigenvalues are those of
+    the C x C matrix S^(1/2) M S^(1/2), S = diag(n_c / d_c), where n_c is the count of
+    class c and d_c = (1 - a) n_c + a N is the (scaled) row sum of its rows.
+    The other N - C eigenvalues are 0.
+    '''
+    _, class_cnts = np.unique(labels, return_counts=True)
+    N, C = np.sum(class_cnts), len(class_cnts)
+    a = np.exp(-1 / sigma**2)
+
+    M = (1 - a) * np.eye(C) + a
+    s = np.sqrt(class_cnts / ((1 - a) * class_cnts + a * N))
+    eigenvalues = np.linalg.eigvalsh(s[:, None] * M * s[None, :])
+
+    return np.concatenate((eigenvalues, np.zeros(N - C)))
+
+
 def approx_eigvals(A: np.array, filter_thr: float = 1e-3):
     '''
     Estimate the eigenvalues of a matrix `A` using
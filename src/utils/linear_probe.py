@@ -0,0 +1,282 @@
+from typing import Iterable, Tuple
+
+import torch
+from tqdm import tqdm
+
+from scheduler import LinearWarmupCosineAnnealingLR
+
+
+def extract_features(model: torch.nn.Module,
+                     loader: torch.utils.data.DataLoader,
+                     device: torch.device,
+                     in_channels: int = 3) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''
+    Run the frozen encoder once over `loader` and store the features in a float16 buffer.
+    The two SimCLR views of each image are both kept, as in the online linear probing.
+
+    Returns:
+        features: float16, [2N, D] (on CPU).
+        labels: int64, [2N,] (on CPU).
+    '''
+    model.eval()
+    features, labels = [], []
+    with torch.no_grad():
+        for x, y_true in tqdm(loader, desc='Extracting features'):
+            views = x if isinstance(x, (list, tuple)) else [x]
+            for x_view in views:
+                if in_channels == 1:
+                    # Repeat the channel dimension: 1 channel -> 3 channels.
+                    x_view = x_view.repeat(1, 3, 1, 1)
+                h = model.encode(x_view.to(device))
+                features.append(h.half().cpu())
+                labels.append(y_true.cpu())
+    return torch.cat(features), torch.cat(labels)
+
+
+def fit_linear_sgd(linear: torch.nn.Linear,
+                   features: torch.Tensor,
+                   labels: torch.Tensor,
+                   device: torch.device,
+                   num_epochs: int,
+                   learning_rate: float,
+                   batch_size: int) -> float:
+    '''
+    Mini-batch AdamW on the cached features, with the same optimizer and
+    learning rate schedule as the online linear probing.
+    Returns the accuracy (%) of the last epoch.
+    '''
+    loss_fn = torch.nn.CrossEntropyLoss()
+    opt = torch.optim.AdamW(list(linear.parameters()), lr=learning_rate)
+    lr_scheduler = LinearWarmupCosineAnnealingLR(optimizer=opt,
+                                                 warmup_epochs=min(
+                                                     10, num_epochs // 5),
+                                                 max_epochs=num_epochs)
+    N = features.shape[0]
+    for _ in range(num_epochs):
+        # Because of linear warmup, first step has zero LR. Hence step once before training.
+        lr_scheduler.step()
+        correct = 0
+        for batch_idx in torch.randperm(N).split(batch_size):
+            h = features[batch_idx].to(device).float()
+            y_true = labels[batch_idx].to(device)
+            y_pred = linear(h)
+            loss = loss_fn(y_pred, y_true)
+            correct += torch.sum(torch.argmax(y_pred, dim=-1) == y_true)
+
+            opt.zero_grad(set_to_none=True)
+            loss.backward()
+            opt.step()
+
+    return correct.item() / N * 100
+
+
+def fit_linear_lbfgs(linear: torch.nn.Linear,
+                     features: torch.Tensor,
+                     labels: torch.Tensor,
+                     device: torch.device,
+                     max_iter: int = 100,
+                     weight_decay: float = 1e-4,
+                     chunk_size: int = 8192) -> float:
+    '''
+    Full-batch multinomial logistic regression with L-BFGS on the cached features.
+    The loss and gradients are accumulated over chunks, so only one float32 chunk
+    of the features is on the device at a time.
+    Returns the accuracy (%) on the cached features.
+    '''
+    loss_fn = torch.nn.CrossEntropyLoss(reduction='sum')
+    opt = torch.optim.LBFGS(list(linear.parameters()),
+                            lr=1,
+                            max_iter=max_iter,
+                            history_size=10,
+                            line_search_fn='strong_wolfe')
+    N = features.shape[0]
+
+    def closure():
+        opt.zero_grad(set_to_none=True)
+        total_loss = 0
+        for start in range(0, N, chunk_size):
+            h = features[start:start + chunk_size].to(device).float()
+            y_true = labels[start:start + chunk_size].to(device)
+            loss = loss_fn(linear(h), y_true) / N
+            loss.backward()
+            total_loss += loss.detach()
+        penalty = weight_decay / 2 * linear.weight.pow(2).sum()
+        penalty.backward()
+        return total_loss + penalty.detach()
+
+    opt.step(closure)
+
+    return linear_accuracy(linear=linear,
+                           features=features,
+                           labels=labels,
+                           device=device,
+                           chunk_size=chunk_size)
+
+
+def fit_linear_ridge(linear: torch.nn.Linear,
+                     features: torch.Tensor,
+                     labels: torch.Tensor,
+                     device: torch.device,
+                     weight_decays: Iterable[float] = (1e-4, ),
+                     chunk_size: int = 8192) -> Iterable[float]:
+    '''
+    Closed-form ridge regression onto the one-hot labels, on the cached features:
+        W = argmin (1 / N) ||(X - mean) W - (Y - mean)||^2 + weight_decay ||W||^2.
+    The Gram matrix is accumulated over chunks and diagonalized once,
+    after which every `weight_decay` of the path costs one D x D solve.
+
+    Yields the accuracy (%) on the cached features for each `weight_decay`,
+    with `linear` set to the corresponding solution.
+    '''
+    N, D = features.shape
+    C = linear.out_features
+
+    # Accumulate the (uncentered) moments in float64.
+    sum_x = torch.zeros(D, dtype=torch.float64, device=device)
+    sum_y = torch.zeros(C, dtype=torch.float64, device=device)
+    gram = torch.zeros((D, D), dtype=torch.float64, device=device)
+    cross = torch.zeros((D, C), dtype=torch.float64, device=device)
+    for start in range(0, N, chunk_size):
+        h = features[start:start + chunk_size].to(device).double()
+        y_true = labels[start:start + chunk_size].to(device)
+        y = torch.nn.functional.one_hot(y_true, num_classes=C).double()
+        sum_x += h.sum(dim=0)
+        sum_y += y.sum(dim=0)
+        gram += h.T @ h
+        cross += h.T @ y
+
+    mean_x, mean_y = sum_x / N, sum_y / N
+    gram = gram / N - torch.outer(mean_x, mean_x)
+    cross = cross / N - torch.outer(mean_x, mean_y)
+    eigvals, eigvecs = torch.linalg.eigh(gram)
+    projected_cross = eigvecs.T @ cross
+
+    for weight_decay in weight_decays:
+        W = eigvecs @ (projected_cross / (eigvals + weight_decay)[:, None])
+        with torch.no_grad():
+            linear.weight.copy_(W.T)
+            linear.bias.copy_(mean_y - mean_x @ W)
+        yield linear_accuracy(linear=linear,
+                              features=features,
+                              labels=labels,
+                              device=device,
+                              chunk_size=chunk_size)
+
+
+def linear_accuracy(linear: torch.nn.Linear,
+                    features: torch.Tensor,
+                    labels: torch.Tensor,
+                    device: torch.device,
+                    chunk_size: int = 8192) -> float:
+    '''
+    Accuracy (%) of `linear` on cached features.
+    '''
+    N = features.shape[0]
+    correct = 0
+    with torch.no_grad():
+        for start in range(0, N, chunk_size):
+            h = features[start:start + chunk_size].to(device).float()
+            y_true = labels[start:start + chunk_size].to(device)
+            correct += torch.sum(torch.argmax(linear(h), dim=-1) == y_true)
+    return correct.item() / N * 100
+
+
+def fit_linear_path(linear: torch.nn.Linear,
+                    train_features: torch.Tensor,
+                    train_labels: torch.Tensor,
+                    val_features: torch.Tensor,
+                    val_labels: torch.Tensor,
+                    device: torch.device,
+                    mode: str = 'cached-lbfgs',
+                    weight_decays: Iterable[float] = (1e-2, 1e-3, 1e-4, 1e-5,
+                                                      1e-6),
+                    max_iter: int = 100) -> Tuple[float, float]:
+    '''
+    Fit the linear head on cached train features for each regularization value
+    of `weight_decays` (strongest first), and keep the one with the best val accuracy.
+
+    mode:
+        'cached-lbfgs': multinomial logistic regression (`fit_linear_lbfgs`).
+            Each fit is warm-started from the solution of the previous (stronger) value.
+        'cached-ridge': closed-form ridge regression onto the one-hot labels (`fit_linear_ridge`).
+
+    Returns (best val accuracy (%), its weight decay), with `linear` set to the best solution.
+    '''
+    assert mode in ['cached-lbfgs', 'cached-ridge'], \
+        '`fit_linear_path`: mode (%s) not supported.' % mode
+    weight_decays = sorted(weight_decays, reverse=True)
+
+    if mode == 'cached-ridge':
+        fits = fit_linear_ridge(linear=linear,
+                                features=train_features,
+                                labels=train_labels,
+                                device=device,
+                                weight_decays=weight_decays)
+    else:
+        fits = (fit_linear_lbfgs(linear=linear,
+                                 features=train_features,
+                                 labels=train_labels,
+                                 device=device,
+                                 max_iter=max_iter,
+                                 weight_decay=weight_decay)
+                for weight_decay in weight_decays)
+
+    best_val_acc, best_weight_decay, best_state_dict = -1, None, None
+    for weight_decay, _ in zip(weight_decays, fits):
+        val_acc = linear_accuracy(linear=linear,
+                                  features=val_features,
+                                  labels=val_labels,
+                                  device=device)
+        if val_acc > best_val_acc:
+            best_val_acc, best_weight_decay = val_acc, weight_decay
+            best_state_dict = {
+                key: value.detach().clone()
+                for (key, value) in linear.state_dict().items()
+            }
+
+    linear.load_state_dict(best_state_dict)
+    return best_val_acc, best_weight_decay
+
+
+def cached_linear_probing(model: torch.nn.Module,
+                          train_loader: torch.utils.data.DataLoader,
+                          device: torch.device,
+                          mode: str,
+                          in_channels: int,
+                          num_epochs: int,
+                          learning_rate: float,
+                          batch_size: int) -> float:
+    '''
+    Linear probing where the train set goes through the frozen encoder only once
+    per probe, instead of once per probing epoch.
+
+    mode:
+        'cached-sgd': `num_epochs` epochs of mini-batch AdamW on the cached features.
+        'cached-lbfgs': full-batch L-BFGS multinomial logistic regression.
+
+    NOTE: Unlike the online probing, the features are extracted in eval mode,
+    so the batch norm statistics of the encoder are not updated by the probe.
+    '''
+    assert mode in ['cached-sgd', 'cached-lbfgs'], \
+        '`cached_linear_probing`: mode (%s) not supported.' % mode
+
+    features, labels = extract_features(model=model,
+                                        loader=train_loader,
+                                        device=device,
+                                        in_channels=in_channels)
+    linear = model.linear
+    linear.train()
+    if mode == 'cached-sgd':
+        probing_acc = fit_linear_sgd(linear=linear,
+                                     features=features,
+                                     labels=labels,
+                                     device=device,
+                                     num_epochs=num_epochs,
+                                     learning_rate=learning_rate,
+                                     batch_size=batch_size)
+    else:
+        probing_acc = fit_linear_lbfgs(linear=linear,
+                                       features=features,
+                                       labels=labels,
+                                       device=device)
+    return probing_acc
@@ -0,0 +1,120 @@
+from typing import Tuple
+
+import numpy as np
+import torch
+
+
+class DriftMetricScheduler(object):
+    '''
+    Decides after each epoch whether the expensive metrics (DSE/DSMI) are worth computing.
+
+    A cheap drift statistic is computed on the embeddings of a fixed probe subset
+    (e.g., 512 val images), against the probe embeddings of the last epoch
+    whose metrics were computed:
+        'cka':    1 - linear CKA (Kornblith et al., 2019).
+        'kernel': relative Frobenius change ||K_t - K_ref||_F / ||K_ref||_F of the
+                  Gaussian kernel (median heuristic bandwidth) over the probe points.
+
+    The metrics are computed when
+        (1) no reference exists yet, or
+        (2) drift >= `threshold`, or
+        (3) `max_interval` epochs have elapsed since the last computation, or
+        (4) `force` is set (e.g., the last epoch).
+    '''
+
+    def __init__(self,
+                 threshold: float = 0.05,
+                 max_interval: int = 10,
+                 measure: str = 'cka'):
+        assert measure in ['cka', 'kernel'], \
+            '`DriftMetricScheduler`: measure (%s) not supported.' % measure
+        assert max_interval >= 1
+        self.threshold = threshold
+        self.max_interval = max_interval
+        self.measure = measure
+        self.reference_Z = None
+        self.reference_epoch = None
+
+    def step(self,
+             epoch_idx: int,
+             probe_Z: np.array,
+             force: bool = False) -> Tuple[bool, float]:
+        '''
+        Returns (whether to compute the metrics at this epoch, drift).
+        '''
+        if self.reference_Z is None:
+            drift = np.nan
+            compute = True
+        else:
+            if self.measure == 'cka':
+                drift = 1 - linear_cka(probe_Z, self.reference_Z)
+            else:
+                drift = kernel_drift(probe_Z, self.reference_Z)
+            compute = force or drift >= self.threshold or \
+                epoch_idx - self.reference_epoch >= self.max_interval
+
+        if compute:
+            self.reference_Z = probe_Z
+            self.reference_epoch = epoch_idx
+        return compute, drift
+
+
+def linear_cka(A: np.array, B: np.array) -> float:
+    '''
+    Linear CKA between two sets of embeddings of the same N points, [N, D1] and [N, D2].
+    '''
+    A = A - A.mean(axis=0, keepdims=True)
+    B = B - B.mean(axis=0, keepdims=True)
+    # ||B^T A||_F^2 / (||A^T A||_F ||B^T B||_F), computed in the feature space.
+    cross = np.linalg.norm(B.T @ A, ord='fro')**2
+    norm_A = np.linalg.norm(A.T @ A, ord='fro')
+    norm_B = np.linalg.norm(B.T @ B, ord='fro')
+    return float(cross / (norm_A * norm_B + 1e-12))
+
+
+def kernel_drift(A: np.array, B: np.array) -> float:
+    '''
+    Relative Frobenius change of the Gaussian kernel of A w.r.t. that of B.
+    '''
+    K_A, K_B = _gaussian_kernel(A), _gaussian_kernel(B)
+    return float(
+        np.linalg.norm(K_A - K_B, ord='fro') /
+        (np.linalg.norm(K_B, ord='fro') + 1e-12))
+
+
+def _gaussian_kernel(X: np.array) -> np.array:
+    sq_norms = np.sum(X**2, axis=1)
+    sq_dists = np.maximum(
+        sq_norms[:, None] + sq_norms[None, :] - 2 * X @ X.T, 0)
+    sigma_sq = np.median(sq_dists[np.triu_indices_from(sq_dists, k=1)])
+    return np.exp(-sq_dists / (2 * sigma_sq + 1e-12))
+
+
+def collect_probe_inputs(val_loader: torch.utils.data.DataLoader,
+                         probe_size: int = 512) -> torch.Tensor:
+    '''
+    The first `probe_size` val inputs, drawn once and kept fixed for the whole run
+    (stored as float16 on CPU).
+    '''
+    probe_x, count = [], 0
+    for x, _ in val_loader:
+        probe_x.append(x[:probe_size - count].half())
+        count += probe_x[-1].shape[0]
+        if count >= probe_size:
+            break
+    return torch.cat(probe_x)
+
+
+def encode_probe(model: torch.nn.Module, probe_x: torch.Tensor,
+                 device: torch.device, in_channels: int,
+                 batch_size: int) -> np.array:
+    model.eval()
+    probe_Z = []
+    with torch.no_grad():
+        for x in probe_x.split(batch_size):
+            x = x.float()
+            if in_channels == 1:
+                # Repeat the channel dimension: 1 channel -> 3 channels.
+                x = x.repeat(1, 3, 1, 1)
+            probe_Z.append(model.encode(x.to(device)).float().cpu().numpy())
+    return np.vstack(probe_Z).astype(np.float64)
@@ -0,0 +1,125 @@
+import glob
+import os
+import uuid
+from multiprocessing import get_context
+from typing import Callable, Dict, Iterable, List
+
+import numpy as np
+from scipy.stats import pearsonr, spearmanr
+
+
+class MetricsSink(object):
+    '''
+    Append-only, columnar log of the per-epoch metrics.
+
+    Each row (one epoch) is written once as its own small npz file
+    (`row_XXXXXX.npz`, one member per column), under a temporary name and atomically renamed.
+    Readers (e.g., `PlottingProcess`) only ever see complete rows,
+    and nothing already written is rewritten.
+
+    `sync(results_dict)` appends the rows of an append-only dict of lists
+    (such as `results_dict` in the training scripts) that are not in the log yet.
+    '''
+
+    def __init__(self, log_dir: str):
+        self.log_dir = log_dir
+        os.makedirs(self.log_dir, exist_ok=True)
+        # A new run starts a new log.
+        for path in glob.glob(os.path.join(self.log_dir, 'row_*.npz')):
+            os.remove(path)
+        self.num_rows = 0
+
+    def append(self, row: Dict[str, np.array]) -> None:
+        path = os.path.join(self.log_dir,
+                            'row_%s.npz' % str(self.num_rows).zfill(6))
+        # The temporary name must not match `row_*.npz`.
+        tmp_path = os.path.join(self.log_dir, '.tmp_%s' % uuid.uuid4().hex)
+        with open(tmp_path, 'wb+') as f:
+            np.savez(f,
+                     **{
+                         key: np.asarray(value)
+                         for (key, value) in row.items()
+                     })
+        os.replace(tmp_path, path)
+        self.num_rows += 1
+        return
+
+    def sync(self, results_dict: Dict[str, list]) -> None:
+        num_rows = len(results_dict['epoch'])
+        for i in range(self.num_rows, num_rows):
+            self.append(
+                {key: value[i]
+                 for (key, value) in results_dict.items()})
+        return
+
+
+def read_metrics_log(log_dir: str) -> Dict[str, list]:
+    '''
+    Read a `MetricsSink` log back into a dict of lists, one entry per row.
+    '''
+    data_arrays = {}
+    for path in sorted(glob.glob(os.path.join(log_dir, 'row_*.npz'))):
+        with np.load(path) as row:
+            for key in row.files:
+                value = row[key]
+                if value.ndim == 0:
+                    value = value.item()
+                data_arrays.setdefault(key, []).append(value)
+    return data_arrays
+
+
+class PlottingProcess(object):
+    '''
+    Renders the figures from a `MetricsSink` log in a separate process,
+    at most once every `min_interval` seconds and only when new rows have arrived,
+    so matplotlib never runs on the training critical path.
+
+    `plot_fn(data_arrays=..., **plot_kwargs)` must be picklable, i.e., defined at the top level
+    of a module (or of a `__main__` script guarded by `if __name__ == '__main__'`).
+    `close()` renders once more with the complete log and stops the process.
+    '''
+
+    def __init__(self,
+                 plot_fn: Callable,
+                 log_dir: str,
+                 min_interval: float = 60,
+                 **plot_kwargs):
+        context = get_context('spawn')
+        self.stop_event = context.Event()
+        self.process = context.Process(target=_plotting_loop,
+                                       args=(plot_fn, log_dir, min_interval,
+                                             plot_kwargs, self.stop_event),
+                                       daemon=True)
+        self.process.start()
+
+    def close(self) -> None:
+        self.stop_event.set()
+        self.process.join()
+        return
+
+
+def _plotting_loop(plot_fn: Callable, log_dir: str, min_interval: float,
+                   plot_kwargs: Dict, stop_event) -> None:
+    num_rendered_rows = 0
+    while True:
+        stopping = stop_event.wait(timeout=min_interval)
+        num_rows = len(glob.glob(os.path.join(log_dir, 'row_*.npz')))
+        if num_rows > num_rendered_rows:
+            plot_fn(data_arrays=read_metrics_log(log_dir), **plot_kwargs)
+            num_rendered_rows = num_rows
+        if stopping:
+            return
+
+
+def format_correlations(x: Iterable, ys: Dict[str, Iterable]) -> str:
+    '''
+    'NAME, P.R: ... (p = ...), S.R: ... (p = ...);' for each (NAME, y) in `ys`,
+    with each Pearson / Spearman correlation computed once.
+    '''
+    lines: List[str] = []
+    for name, y in ys.items():
+        pearson_r, pearson_p = pearsonr(x, y)
+        spearman_r, spearman_p = spearmanr(x, y)
+        lines.append('%s, P.R: %.3f (p = %.4f), S.R: %.3f (p = %.4f);\n' %
+                     (name, pearson_r, pearson_p, spearman_r, spearman_p))
+    return ''.join(lines)
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+class ReferenceCache(object):
+    '''
+    Epoch-invariant reference data for DSMI, built once per
+    (dataset, dataset location, val transform) and stored memory-mapped on disk:
+        X: the validation images downsampled to `X_size` x `X_size` and flattened, [N, 3 * X_size^2].
+        Y: the validation labels, [N,].
+        clusters_X: the spectral clusters of X (one file per `n_clusters`).
+
+    Every epoch, every seed and every model that shares the validation split
+    reads the same files, so per-epoch validation only needs to run the encoder.
+
+    NOTE: The cache is only valid if the validation loader is deterministic,
+    i.e., no shuffling and no random transforms, as the rows of X/Y must line up
+    with the latent vectors collected during validation.
+
+    Layout:
+        `cache_dir`/`dataset_name`-`hash`/
+            meta.json
+            X.npy
+            Y.npy
+            clusters_X_k`n_clusters`.npy
+    '''
+
+    def __init__(self,
+                 cache_dir: str,
+                 dataset_name: str,
+                 dataset_dir: str,
+                 val_loader: torch.utils.data.DataLoader,
+                 in_channels: int,
+                 X_size: int = 64):
+        self.X_size = X_size
+        self.in_channels = in_channels
+
+        dataset = val_loader.dataset
+        signature = '%s|%s|%s|%s|%d|%d' % (
+            dataset_name, os.path.realpath(dataset_dir), type(dataset).__name__,
+            repr(getattr(dataset, 'transform', None)), len(dataset), X_size)
+        digest = hashlib.md5(signature.encode()).hexdigest()[:12]
+        self.folder = os.path.join(cache_dir, '%s-%s' % (dataset_name, digest))
+
+        if not os.path.isfile(os.path.join(self.folder, 'meta.json')):
+            self._build(val_loader=val_loader, signature=signature)
+
+        self.X = np.load(os.path.join(self.folder, 'X.npy'), mmap_mode='r')
+        self.Y = np.load(os.path.join(self.folder, 'Y.npy'), mmap_mode='r')
+
+    def clusters(self, n_clusters: int) -> np.array:
+        '''
+        Spectral clusters of X, computed once and stored alongside X.
+        Uses the same spectral clustering as `diffusion_spectral_mutual_information`.
+        '''
+        cluster_path = os.path.join(self.folder,
+                                    'clusters_X_k%d.npy' % n_clusters)
+        if not os.path.isfile(cluster_path):
+            from sklearn.cluster import SpectralClustering
+            cluster_op = SpectralClustering(n_clusters=n_clusters,
+                                            affinity='nearest_neighbors',
+                                            assign_labels='cluster_qr',
+                                            random_state=0).fit(self.X)
+            tmp_path = '%s.%s.tmp.npy' % (cluster_path, uuid.uuid4().hex)
+            np.save(tmp_path, cluster_op.labels_)
+            os.replace(tmp_path, cluster_path)
+        return np.load(cluster_path)
+
+    def _build(self, val_loader: torch.utils.data.DataLoader,
+               signature: str) -> None:
+        # Build in a temporary folder and rename it at the end,
+        # such that concurrent runs never see a half-written cache.
+        tmp_folder = '%s.%s.tmp' % (self.folder, uuid.uuid4().hex)
+        os.makedirs(tmp_folder)
+
+        N = len(val_loader.dataset)
+        D = 3 * self.X_size * self.X_size
+        X = np.lib.format.open_memmap(os.path.join(tmp_folder, 'X.npy'),
+                                      mode='w+',
+                                      dtype=np.float32,
+                                      shape=(N, D))
+        Y = np.lib.format.open_memmap(os.path.join(tmp_folder, 'Y.npy'),
+                                      mode='w+',
+                                      dtype=np.int64,
+                                      shape=(N, ))
+
+        start = 0
+        with torch.no_grad():
+            for x, y_true in tqdm(val_loader,
+                                  desc='Building reference cache'):
+                B = x.shape[0]
+                if self.in_channels == 1:
+                    # Repeat the channel dimension: 1 channel -> 3 channels.
+                    x = x.repeat(1, 3, 1, 1)
+                # Downsample the input image to reduce memory usage.
+                X[start:start + B] = torch.nn.functional.interpolate(
+                    x, size=(self.X_size, self.X_size)).numpy().reshape(B, -1)
+                Y[start:start + B] = y_true.numpy()
+                start += B
+        assert start == N
+        X.flush()
+        Y.flush()
+        del X, Y
+
+        with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+            json.dump({'signature': signature, 'N': N, 'D': D}, f)
+
+        os.makedirs(os.path.dirname(self.folder), exist_ok=True)
+        try:
+            os.rename(tmp_folder, self.folder)
+        except OSError:
+            # Another run has built the same cache in the meantime.
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+        return
@@ -0,0 +1,155 @@
+import os
+import uuid
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+import torch
+
+
+class StratifiedReservoir(object):
+    '''
+    Fixed-size, class-stratified reservoir sample of embeddings
+    seen during the training forward passes.
+
+    Each class keeps a uniform sample of (at most) `per_class` of its embeddings
+    (reservoir sampling, Algorithm R), so memory is bounded by
+    `num_classes` x `per_class` x D in float16, whatever the size of the train set.
+
+    Usage:
+        reservoir = StratifiedReservoir(num_classes=10, per_class=100)
+        for x, y in train_loader:
+            ...
+            reservoir.add(h.detach(), y)
+        Z, Y = reservoir.sample()
+        reservoir.reset()
+    '''
+
+    def __init__(self, num_classes: int, per_class: int, seed: int = 0):
+        assert per_class >= 1
+        self.num_classes = num_classes
+        self.per_class = per_class
+        self.rng = np.random.default_rng(seed)
+        self.buffer = None
+        self.reset()
+
+    def reset(self) -> None:
+        # Number of embeddings seen so far, per class.
+        self.seen = np.zeros(self.num_classes, dtype=np.int64)
+        return
+
+    def add(self, embeddings: torch.Tensor, labels: torch.Tensor) -> None:
+        embeddings = embeddings.reshape(embeddings.shape[0], -1)
+        labels = labels.cpu().numpy()
+        if self.buffer is None:
+            self.buffer = torch.zeros(
+                (self.num_classes, self.per_class, embeddings.shape[1]),
+                dtype=torch.float16)
+
+        batch_idx, class_idx, slot_idx = [], [], []
+        for c in np.unique(labels):
+            idx_c = np.flatnonzero(labels == c)
+            # 0-indexed arrival order of these embeddings within class `c`.
+            arrival = self.seen[c] + np.arange(len(idx_c))
+            self.seen[c] += len(idx_c)
+
+            # Fill phase, then replace slot j ~ U{0, ..., arrival} if j < per_class.
+            slot = np.where(
+                arrival < self.per_class, arrival,
+                np.floor(self.rng.random(len(idx_c)) *
+                         (arrival + 1)).astype(np.int64))
+            keep = np.flatnonzero(slot < self.per_class)
+            # Several arrivals of this batch may draw the same slot:
+            # as in sequential sampling, the last one wins.
+            _, last = np.unique(slot[keep][::-1], return_index=True)
+            keep = keep[len(keep) - 1 - last]
+            batch_idx.append(idx_c[keep])
+            class_idx.append(np.full(len(keep), c))
+            slot_idx.append(slot[keep])
+
+        batch_idx = np.concatenate(batch_idx)
+        if len(batch_idx) == 0:
+            return
+        # Only the accepted rows leave the device.
+        accepted = embeddings[torch.from_numpy(batch_idx).to(
+            embeddings.device)].to('cpu', torch.float16)
+        self.buffer[np.concatenate(class_idx),
+                    np.concatenate(slot_idx)] = accepted
+        return
+
+    def sample(self) -> Tuple[np.array, np.array]:
+        '''
+        Returns the reservoir content: Z [N, D] (float32) and Y [N,].
+        Both are empty (N = 0) if nothing has been added yet.
+        '''
+        if self.buffer is None:
+            return np.zeros((0, 0), dtype=np.float32), np.zeros(0,
+                                                                 dtype=np.int64)
+        counts = np.minimum(self.seen, self.per_class)
+        Z = np.vstack([
+            self.buffer[c, :counts[c]].float().numpy()
+            for c in range(self.num_classes)
+        ])
+        Y = np.repeat(np.arange(self.num_classes), counts)
+        return Z, Y
+
+
+class ReservoirMetrics(object):
+    '''
+    Train-side DSE/DSMI: computed at the end of each epoch on the content of a
+    `StratifiedReservoir` (which is then reset), and saved as an npz file.
+
+    `dse_fn` and `dsmi_fn` are `diffusion_spectral_entropy` and
+    `diffusion_spectral_mutual_information` (from api/).
+    The metrics of an epoch without any train embedding are NaN.
+
+    Usage:
+        reservoir_metrics = ReservoirMetrics(reservoir, dse_fn=..., dsmi_fn=...)
+        for epoch_idx in ...:
+            ...  # reservoir.add(h.detach(), y)
+            metrics = reservoir_metrics.end_epoch(epoch_idx)
+        reservoir_metrics.save(save_path)
+    '''
+
+    keys = ['dse_Z', 'cse_Z', 'dsmi_Z_Y', 'csmi_Z_Y']
+
+    def __init__(self, reservoir: StratifiedReservoir, dse_fn: Callable,
+                 dsmi_fn: Callable):
+        self.reservoir = reservoir
+        self.dse_fn = dse_fn
+        self.dsmi_fn = dsmi_fn
+        self.results = {key: [] for key in ['epoch'] + self.keys}
+
+    def end_epoch(self, epoch_idx: int) -> Dict[str, float]:
+        Z, Y = self.reservoir.sample()
+        self.reservoir.reset()
+        if len(Z) == 0:
+            metrics = {key: np.nan for key in self.keys}
+        else:
+            metrics = {
+                'dse_Z':
+                self.dse_fn(embedding_vectors=Z),
+                'cse_Z':
+                self.dse_fn(embedding_vectors=Z, classic_shannon_entropy=True),
+                'dsmi_Z_Y':
+                self.dsmi_fn(embedding_vectors=Z, reference_vectors=Y)[0],
+                'csmi_Z_Y':
+                self.dsmi_fn(embedding_vectors=Z,
+                             reference_vectors=Y,
+                             classic_shannon_entropy=True)[0],
+            }
+        self.results['epoch'].append(epoch_idx)
+        for key in self.keys:
+            self.results[key].append(metrics[key])
+        return metrics
+
+    def save(self, save_path: str) -> None:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        tmp_path = '%s.%s.tmp' % (save_path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb+') as f:
+            np.savez(f,
+                     **{
+                         key: np.array(value)
+                         for (key, value) in self.results.items()
+                     })
+        os.replace(tmp_path, save_path)
+        return
@@ -0,0 +1,136 @@
+import contextlib
+import time
+from typing import Callable
+
+import torch
+
+
+class TrainEngine(object):
+    '''
+    The shared optimization step of the training scripts, with opt-in performance features:
+        bf16:
+            Run the forward pass under bf16 autocast (on CPU and on GPU).
+            The losses should be computed on `.float()` outputs outside of `autocast`.
+        channels_last:
+            Keep the model and the 4D inputs in `torch.channels_last` memory format.
+        compile:
+            `torch.compile` the sub-modules of the model in place (state dict keys are unchanged)
+            and the losses passed to `compile_loss`, except for the losses marked
+            `compilable = False` (e.g., `NTXentLoss`, which calls sklearn).
+        grad_accum_steps:
+            Accumulate the gradients over this many batches before each optimizer step.
+
+    The gradients are always zeroed with `set_to_none=True`.
+    Throughput (images/s, data loading included) is measured for every step,
+    returned by `step`, logged with `log_fn` every `log_interval` steps (if provided)
+    and averaged over the epoch.
+
+    Usage:
+        engine = TrainEngine(model=model, opt=opt, device=device, bf16=True)
+        engine.start_epoch()
+        for x, y_true in train_loader:
+            x, y_true = engine.to_device(x), y_true.to(device)
+            with engine.autocast():
+                y_pred = model(x)
+            loss = loss_fn(y_pred.float(), y_true)
+            engine.step(loss, batch_size=x.shape[0])
+        images_per_sec = engine.end_epoch()
+    '''
+
+    def __init__(self,
+                 model: torch.nn.Module,
+                 opt: torch.optim.Optimizer,
+                 device: torch.device,
+                 bf16: bool = False,
+                 channels_last: bool = False,
+                 compile: bool = False,
+                 grad_accum_steps: int = 1,
+                 log_interval: int = None,
+                 log_fn: Callable[[str], None] = print):
+        assert grad_accum_steps >= 1
+        self.model = model
+        self.opt = opt
+        self.device = device
+        self.bf16 = bf16
+        self.channels_last = channels_last
+        self.compile = compile
+        self.grad_accum_steps = grad_accum_steps
+        self.log_interval = log_interval
+        self.log_fn = log_fn
+
+        if self.channels_last:
+            self.model.to(memory_format=torch.channels_last)
+        if self.compile:
+            for module in self.model.children():
+                module.compile()
+
+        self.opt.zero_grad(set_to_none=True)
+        self.num_accumulated = 0
+        self.num_steps = 0
+        self.step_images_per_sec = 0
+        self.epoch_images, self.epoch_time = 0, 0
+        self.last_step_end = None
+
+    def compile_loss(self, loss_fn: Callable) -> Callable:
+        if self.compile and getattr(loss_fn, 'compilable', True):
+            return torch.compile(loss_fn)
+        return loss_fn
+
+    def to_device(self, x: torch.Tensor) -> torch.Tensor:
+        x = x.to(self.device, non_blocking=True)
+        if self.channels_last and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def autocast(self):
+        if self.bf16:
+            return torch.autocast(device_type=self.device.type,
+                                  dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def start_epoch(self) -> None:
+        self.epoch_images, self.epoch_time = 0, 0
+        self.last_step_end = time.time()
+        return
+
+    def step(self, loss: torch.Tensor, batch_size: int) -> float:
+        '''
+        Backward pass, and an optimizer step every `grad_accum_steps` calls.
+        Returns the throughput of this step (images/s).
+        '''
+        (loss / self.grad_accum_steps).backward()
+        self.num_accumulated += 1
+        if self.num_accumulated == self.grad_accum_steps:
+            self._optimizer_step()
+
+        now = time.time()
+        if self.last_step_end is None:
+            self.last_step_end = now
+        step_time = now - self.last_step_end
+        self.last_step_end = now
+        if step_time > 0:
+            self.step_images_per_sec = batch_size / step_time
+        self.epoch_images += batch_size
+        self.epoch_time += step_time
+
+        self.num_steps += 1
+        if self.log_interval is not None and self.num_steps % self.log_interval == 0:
+            self.log_fn('Step %d: %.1f images/s.' %
+                        (self.num_steps, self.step_images_per_sec))
+        return self.step_images_per_sec
+
+    def end_epoch(self) -> float:
+        '''
+        Apply the leftover accumulated gradients and return the epoch throughput (images/s).
+        '''
+        if self.num_accumulated > 0:
+            self._optimizer_step()
+        if self.epoch_time == 0:
+            return 0
+        return self.epoch_images / self.epoch_time
+
+    def _optimizer_step(self) -> None:
+        self.opt.step()
+        self.opt.zero_grad(set_to_none=True)
+        self.num_accumulated = 0
+        return
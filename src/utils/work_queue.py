@@ -0,0 +1,231 @@
+import json
+import os
+import resource
+import sqlite3
+import time
+import traceback
+from contextlib import closing
+from multiprocessing import get_context
+from typing import Callable, Dict, Iterable, List, Tuple
+
+
+class SkipTask(Exception):
+    '''
+    Raised by a task that cannot be processed (recorded as `skipped`, not retried).
+    '''
+    pass
+
+
+class ResultLedger(object):
+    '''
+    SQLite ledger of a work queue: one row per task, with its status and its result (JSON).
+
+    Statuses: pending, running, done, skipped, failed, timeout.
+
+    Every change is committed immediately and the database can be shared between
+    processes, so the ledger is an exact record of the progress even after a crash.
+    Tasks left `running` by a crashed supervisor are put back to `pending` by `recover()`.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS tasks ('
+                         'name TEXT PRIMARY KEY, '
+                         'status TEXT NOT NULL, '
+                         'attempts INTEGER NOT NULL DEFAULT 0, '
+                         'worker INTEGER, '
+                         'started REAL, '
+                         'finished REAL, '
+                         'error TEXT, '
+                         'result TEXT)')
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit; transactions are opened explicitly where needed.
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def add(self, names: Iterable[str]) -> None:
+        with closing(self._connect()) as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO tasks (name, status) VALUES (?, ?)',
+                [(name, 'pending') for name in names])
+        return
+
+    def recover(self) -> None:
+        self.requeue(statuses=['running'])
+        return
+
+    def requeue(self, statuses: Iterable[str]) -> None:
+        statuses = list(statuses)
+        with closing(self._connect()) as conn:
+            conn.execute(
+                'UPDATE tasks SET status = \'pending\' WHERE status IN (%s)' %
+                ', '.join('?' * len(statuses)), statuses)
+        return
+
+    def reset(self) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute('DELETE FROM tasks')
+        return
+
+    def claim(self, worker_id: int) -> str:
+        '''
+        Atomically mark the next pending task as running. Returns None if there is none.
+        '''
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT name FROM tasks WHERE status = \'pending\' '
+                'ORDER BY rowid LIMIT 1').fetchone()
+            if row is not None:
+                conn.execute(
+                    'UPDATE tasks SET status = \'running\', attempts = attempts + 1, '
+                    'worker = ?, started = ?, error = NULL WHERE name = ?',
+                    (worker_id, time.time(), row[0]))
+            conn.execute('COMMIT')
+        return None if row is None else row[0]
+
+    def finish(self, name: str, result: Dict) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute(
+                'UPDATE tasks SET status = \'done\', finished = ?, result = ? '
+                'WHERE name = ?', (time.time(), json.dumps(result), name))
+        return
+
+    def fail(self, name: str, status: str, error: str) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute(
+                'UPDATE tasks SET status = ?, finished = ?, error = ? WHERE name = ?',
+                (status, time.time(), error, name))
+        return
+
+    def status(self, name: str) -> str:
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT status FROM tasks WHERE name = ?',
+                               (name, )).fetchone()
+        return None if row is None else row[0]
+
+    def counts(self) -> Dict[str, int]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                'SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall()
+        return dict(rows)
+
+    def results(self) -> List[Tuple[str, Dict]]:
+        '''
+        (name, result) of the finished tasks, in insertion order.
+        '''
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                'SELECT name, result FROM tasks WHERE status = \'done\' '
+                'ORDER BY rowid').fetchall()
+        return [(name, json.loads(result)) for (name, result) in rows]
+
+
+def run_work_queue(ledger_path: str,
+                   task_fn: Callable,
+                   num_workers: int = 1,
+                   cores_per_worker: int = None,
+                   timeout: float = None,
+                   memory_limit_gb: float = None,
+                   task_kwargs: Dict = None,
+                   poll_interval: float = 1.0) -> Dict[str, int]:
+    '''
+    Run every pending task of the ledger with `num_workers` concurrent worker slots.
+
+    Each task runs in a fresh (spawned) process, so a crash, a leak or a kill
+    only affects that task. A worker process is:
+        - pinned to the disjoint core set of its slot (`cores_per_worker` cores),
+        - limited to `memory_limit_gb` of address space (if provided;
+          NOTE: CUDA processes reserve a lot of virtual memory, leave it unset on GPU),
+        - killed after `timeout` seconds (if provided) and recorded as `timeout`.
+
+    `task_fn(name=..., worker_id=..., **task_kwargs)` must be picklable (top-level function),
+    and returns a JSON-serializable dict, recorded as the result of the task.
+    It may raise `SkipTask`. Any other exception, or a process that dies, is recorded as `failed`.
+
+    Returns the number of tasks per status.
+    '''
+    ledger = ResultLedger(ledger_path)
+    ledger.recover()
+    task_kwargs = {} if task_kwargs is None else task_kwargs
+
+    cores = sorted(os.sched_getaffinity(0))
+    if cores_per_worker is None:
+        cores_per_worker = max(1, len(cores) // num_workers)
+    assert cores_per_worker * num_workers <= len(cores), \
+        '`run_work_queue`: %d workers x %d cores > %d available cores.' % (
+            num_workers, cores_per_worker, len(cores))
+    core_sets = [
+        cores[i * cores_per_worker:(i + 1) * cores_per_worker]
+        for i in range(num_workers)
+    ]
+
+    context = get_context('spawn')
+    # worker_id -> (process, task name, start time)
+    slots = {}
+    queue_empty = False
+    while True:
+        for worker_id, (process, name, start) in list(slots.items()):
+            if process.is_alive():
+                if timeout is not None and time.time() - start > timeout:
+                    process.kill()
+                    process.join()
+                    ledger.fail(name, 'timeout',
+                                'Killed after %d seconds.' % timeout)
+                    del slots[worker_id]
+                continue
+            process.join()
+            if ledger.status(name) == 'running':
+                # The process died without recording anything (e.g., killed by the OOM killer).
+                ledger.fail(
+                    name, 'failed',
+                    'Worker exited with code %s.' % process.exitcode)
+            del slots[worker_id]
+
+        for worker_id in range(num_workers):
+            if worker_id in slots or queue_empty:
+                continue
+            name = ledger.claim(worker_id)
+            if name is None:
+                queue_empty = True
+                break
+            process = context.Process(target=_run_task,
+                                      args=(ledger_path, name, worker_id,
+                                            core_sets[worker_id],
+                                            memory_limit_gb, task_fn,
+                                            task_kwargs))
+            process.start()
+            slots[worker_id] = (process, name, time.time())
+
+        if len(slots) == 0:
+            break
+        time.sleep(poll_interval)
+
+    return ledger.counts()
+
+
+def _run_task(ledger_path: str, name: str, worker_id: int, cores: List[int],
+              memory_limit_gb: float, task_fn: Callable,
+              task_kwargs: Dict) -> None:
+    os.sched_setaffinity(0, cores)
+    try:
+        import torch
+        torch.set_num_threads(len(cores))
+    except ImportError:
+        pass
+    if memory_limit_gb is not None:
+        memory_limit = int(memory_limit_gb * 1024**3)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    ledger = ResultLedger(ledger_path)
+    try:
+        result = task_fn(name=name, worker_id=worker_id, **task_kwargs)
+        ledger.finish(name, result)
+    except SkipTask as e:
+        ledger.fail(name, 'skipped', str(e))
+    except BaseException:
+        ledger.fail(name, 'failed', traceback.format_exc()[-4000:])
+    return